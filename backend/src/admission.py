@@ -0,0 +1,360 @@
+"""
+Admission control and load shedding for the chat pipelines.
+
+At most ADMISSION_MAX_IN_FLIGHT pipelines run at once. Further requests wait
+in a queue of ADMISSION_MAX_QUEUE places, for up to ADMISSION_QUEUE_TIMEOUT
+seconds, and are shed with 429 and a Retry-After header when the queue is full
+or the wait runs out, instead of every request slowing down together.
+
+Before that point requests are degraded in tiers as the load (running and
+queued pipelines over ADMISSION_MAX_IN_FLIGHT) rises:
+
+1. from ADMISSION_DEGRADE_RELATED_LOAD, no related questions are generated
+2. from ADMISSION_DEGRADE_SIMPLE_LOAD, pro and auto requests run simple chat
+3. from ADMISSION_DEGRADE_RESULTS_LOAD, max_results is capped at
+   ADMISSION_DEGRADED_MAX_RESULTS
+
+The queue is fair between users: every flow (a /chat user or a compatible
+API key) waits in a queue of its own, and freed slots are handed out by
+deficit round-robin in proportion to the flow weights. With the default
+weights an interactive user gets four slots for every one of a batch API
+client, so heavy API traffic only takes the capacity others leave unused.
+A full queue pushes out the newest request of the flow queueing the most for
+its weight, and degradation follows each flow's load over its fair share, so
+one client's backlog neither sheds nor degrades the others' requests.
+
+Admissions, queued, shed and degraded requests are counted in the metrics.
+"""
+
+import asyncio
+import os
+import weakref
+from collections import deque
+from typing import AsyncIterator, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from fastapi import HTTPException
+
+from api_compat.keys import ApiKeyInfo, KeyPriority
+from metrics import metrics
+from schemas import ChatRequest, SearchMode
+from utils import strtobool
+
+ADMISSION_ENABLED = strtobool(os.getenv("ADMISSION_ENABLED", "true"))
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv("ADMISSION_MAX_IN_FLIGHT", "32"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "64"))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "15"))
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER", "5"))
+ADMISSION_DEGRADE_RELATED_LOAD = float(os.getenv("ADMISSION_DEGRADE_RELATED_LOAD", "0.5"))
+ADMISSION_DEGRADE_SIMPLE_LOAD = float(os.getenv("ADMISSION_DEGRADE_SIMPLE_LOAD", "0.75"))
+ADMISSION_DEGRADE_RESULTS_LOAD = float(os.getenv("ADMISSION_DEGRADE_RESULTS_LOAD", "1.0"))
+ADMISSION_DEGRADED_MAX_RESULTS = int(os.getenv("ADMISSION_DEGRADED_MAX_RESULTS", "4"))
+FAIR_QUEUE_USER_WEIGHT = float(os.getenv("FAIR_QUEUE_USER_WEIGHT", "4"))
+FAIR_QUEUE_KEY_WEIGHT = float(os.getenv("FAIR_QUEUE_KEY_WEIGHT", "1"))
+# Per-flow overrides, e.g. "user:alice=8,key:3f2a9c1b7d4e=2"
+FAIR_QUEUE_WEIGHTS = {
+    flow.strip(): float(weight)
+    for flow, _, weight in (
+        item.rpartition("=") for item in os.getenv("FAIR_QUEUE_WEIGHTS", "").split(",") if "=" in item
+    )
+}
+
+S = TypeVar("S", bound=AsyncIterator)
+
+metrics.register_rate("admission.shed_rate", "admission.shed", "admission.requests")
+metrics.register_rate("admission.degraded_rate", "admission.degraded", "admission.requests")
+
+
+def user_flow(user_id: str) -> str:
+    return f"user:{user_id}"
+
+
+def api_key_flow(key: ApiKeyInfo) -> str:
+    """The flow of a compatible API key, by the key's name, never the key itself."""
+    return f"key:{key.name}"
+
+
+def api_key_weight(key: ApiKeyInfo) -> Optional[float]:
+    """The weight configured for ``key``, or the user weight for interactive keys."""
+    if key.weight is not None:
+        return key.weight
+    return FAIR_QUEUE_USER_WEIGHT if key.priority == KeyPriority.INTERACTIVE else None
+
+
+def flow_weight(flow: str, weight: Optional[float] = None) -> float:
+    if flow in FAIR_QUEUE_WEIGHTS:
+        return FAIR_QUEUE_WEIGHTS[flow]
+    if weight is not None:
+        return weight
+    return FAIR_QUEUE_KEY_WEIGHT if flow.startswith("key:") else FAIR_QUEUE_USER_WEIGHT
+
+
+class Flow:
+    """The running and waiting requests of one user or API key, and its deficit-round-robin state."""
+
+    def __init__(self, name: str, weight: float):
+        self.name = name
+        self.weight = max(weight, 0.01)
+        self.running = 0
+        self.deficit = 0.0
+        self.waiters: Deque[asyncio.Future] = deque()
+        # Whether the flow is in the round-robin
+        self.active = False
+
+    @property
+    def idle(self) -> bool:
+        return not self.running and not self.waiters
+
+
+class AdmissionTicket:
+    """A running pipeline's slot, handed to the next queued request when released."""
+
+    def __init__(self, controller: "AdmissionController", flow: Optional[Flow] = None):
+        self._controller = controller
+        self._flow = flow
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._controller._release(self._flow)
+
+    def guard(self, stream: S) -> S:
+        """Release the slot when ``stream`` is discarded, even if it was never started."""
+        weakref.finalize(stream, self.release)
+        return stream
+
+
+class AdmissionController:
+    """
+    Bounded number of running pipelines with a bounded, per-flow fair queue in front.
+
+    When the queue is full, a new request pushes out the newest request of the
+    flow queueing the most for its weight, and is only shed itself when its
+    own flow is that flow, so a flooding client can't lock the others out.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = ADMISSION_MAX_IN_FLIGHT,
+        max_queue: int = ADMISSION_MAX_QUEUE,
+        queue_timeout: float = ADMISSION_QUEUE_TIMEOUT,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        # Flows with running or waiting requests
+        self._flows: Dict[str, Flow] = {}
+        # Flows with waiting requests, in round-robin order; the first one is being served
+        self._active: Deque[Flow] = deque()
+
+    @property
+    def load(self) -> float:
+        return (self.in_flight + self.queued) / max(self.max_in_flight, 1)
+
+    def fair_share(self, flow: Flow) -> float:
+        """The pipelines ``flow`` is entitled to while the flows with requests share them by weight."""
+        total_weight = sum(other.weight for other in self._flows.values())
+        return max(self.max_in_flight, 1) * flow.weight / total_weight
+
+    def flow_load(self, flow: Flow) -> float:
+        """The requests of ``flow``, with one more, over its fair share."""
+        return (flow.running + len(flow.waiters) + 1) / self.fair_share(flow)
+
+    async def admit(
+        self, request: ChatRequest, flow: str = "anonymous", weight: Optional[float] = None
+    ) -> AdmissionTicket:
+        """
+        Wait for a pipeline slot for ``request`` in the queue of ``flow``,
+        degrading the request to the load. ``weight`` is the flow's share of
+        the pipelines when FAIR_QUEUE_WEIGHTS doesn't set one.
+
+        Raises:
+            HTTPException: 429 with Retry-After when the request is shed, pushed
+                out of the queue, or times out in it
+        """
+        metrics.increment("admission.requests")
+        queue = self._flows.get(flow)
+        if queue is None:
+            queue = self._flows[flow] = Flow(flow, flow_weight(flow, weight))
+        try:
+            if self.in_flight >= self.max_in_flight and self.queued >= self.max_queue:
+                self._make_room(queue)
+        except HTTPException:
+            self._forget(queue)
+            raise
+        self.degrade(request, queue)
+
+        if self.in_flight < self.max_in_flight and not self.queued:
+            self.in_flight += 1
+            queue.running += 1
+            metrics.increment("admission.admitted")
+            return AdmissionTicket(self, queue)
+
+        if not queue.active:
+            queue.active = True
+            if not self._active:
+                # The flow is served first, with a full quantum
+                queue.deficit = queue.weight
+            self._active.append(queue)
+        future = asyncio.get_running_loop().create_future()
+        queue.waiters.append(future)
+        self.queued += 1
+        metrics.increment("admission.queued")
+        try:
+            await asyncio.wait_for(future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self._abandon(queue, future)
+            raise self._shed("timed out in the queue")
+        except asyncio.CancelledError:
+            self._abandon(queue, future)
+            raise
+        except HTTPException:
+            # Pushed out of the queue
+            self._forget(queue)
+            raise
+        metrics.increment("admission.admitted")
+        return AdmissionTicket(self, queue)
+
+    def degrade(self, request: ChatRequest, flow: Optional[Flow] = None) -> List[str]:
+        """
+        Turn off the costly parts of ``request`` that the load calls for, returning their names.
+
+        With ``flow`` given, the load is the smaller of the overall load and the
+        flow's load over its fair share, so a flow within its share isn't
+        degraded for the backlog of the others.
+        """
+        # The load once this request is counted
+        load = self.load + 1 / max(self.max_in_flight, 1)
+        if flow is not None:
+            load = min(load, self.flow_load(flow))
+        degraded = []
+        if load >= ADMISSION_DEGRADE_RELATED_LOAD and request.related_queries:
+            request.related_queries = False
+            degraded.append("related_queries")
+        wants_pro = request.search_mode in (SearchMode.PRO, SearchMode.AUTO) or (
+            request.search_mode is None and request.pro_search
+        )
+        if load >= ADMISSION_DEGRADE_SIMPLE_LOAD and wants_pro:
+            request.search_mode = SearchMode.SIMPLE
+            degraded.append("simple_mode")
+        if load >= ADMISSION_DEGRADE_RESULTS_LOAD and request.max_results > ADMISSION_DEGRADED_MAX_RESULTS:
+            request.max_results = ADMISSION_DEGRADED_MAX_RESULTS
+            degraded.append("max_results")
+
+        if degraded:
+            metrics.increment("admission.degraded")
+            for name in degraded:
+                metrics.increment(f"admission.degraded.{name}")
+            print(f"🚦 Load {load:.2f}, degraded: {', '.join(degraded)}")
+        return degraded
+
+    def _make_room(self, flow: Flow) -> None:
+        """
+        Free a place in the full queue for a request of ``flow`` by pushing out the
+        newest request of the flow queueing the most for its weight.
+
+        Raises:
+            HTTPException: 429 when ``flow`` itself queues the most for its weight
+        """
+        heaviest = max(
+            (other for other in self._flows.values() if other.waiters),
+            key=lambda other: len(other.waiters) / other.weight,
+            default=None,
+        )
+        if heaviest is None or (len(flow.waiters) + 1) / flow.weight >= len(heaviest.waiters) / heaviest.weight:
+            raise self._shed("queue full")
+        while heaviest.waiters:
+            future = heaviest.waiters.pop()
+            self.queued -= 1
+            if not future.done():
+                metrics.increment("admission.pushed_out")
+                future.set_exception(self._shed(f"pushed out of the queue by {flow.name}"))
+                return
+
+    def _shed(self, reason: str) -> HTTPException:
+        metrics.increment("admission.shed")
+        print(f"🚦 Shedding request: {reason} ({self.in_flight} running, {self.queued} queued)")
+        return HTTPException(
+            status_code=429,
+            detail="The server is busy, please retry shortly.",
+            headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+        )
+
+    def _forget(self, flow: Flow) -> None:
+        if flow.idle and not flow.active and self._flows.get(flow.name) is flow:
+            del self._flows[flow.name]
+
+    def _abandon(self, flow: Flow, future: asyncio.Future) -> None:
+        if future.done() and not future.cancelled() and future.exception() is None:
+            # The slot was handed over just as the wait ended
+            self._release(flow)
+            return
+        if future in flow.waiters:
+            flow.waiters.remove(future)
+            self.queued -= 1
+        self._forget(flow)
+
+    def _release(self, flow: Optional[Flow]) -> None:
+        if flow is not None:
+            flow.running -= 1
+            self._forget(flow)
+        waiter = self._next_waiter()
+        if waiter is None:
+            self.in_flight -= 1
+        else:
+            # The slot passes straight to the next request
+            next_flow, future = waiter
+            next_flow.running += 1
+            future.set_result(None)
+
+    def _next_waiter(self) -> Optional[Tuple[Flow, asyncio.Future]]:
+        """
+        Dequeue the next request by deficit round-robin.
+
+        The flow being served spends one unit of its deficit per request; when
+        it runs short, the next flow takes its turn with its weight added.
+        """
+        while self._active:
+            flow = self._active[0]
+            while flow.waiters and flow.waiters[0].done():
+                flow.waiters.popleft()
+                self.queued -= 1
+            if not flow.waiters:
+                self._active.popleft()
+                flow.active = False
+                flow.deficit = 0.0
+                self._forget(flow)
+                if self._active:
+                    self._active[0].deficit += self._active[0].weight
+                continue
+            if flow.deficit >= 1:
+                flow.deficit -= 1
+                self.queued -= 1
+                return flow, flow.waiters.popleft()
+            self._active.rotate(-1)
+            self._active[0].deficit += self._active[0].weight
+        return None
+
+
+admission = AdmissionController()
+
+
+def free_ticket() -> AdmissionTicket:
+    """A ticket holding no slot, for responses that run no pipeline."""
+    return AdmissionTicket(_UnlimitedController())
+
+
+async def admit(
+    request: ChatRequest, flow: str = "anonymous", weight: Optional[float] = None
+) -> AdmissionTicket:
+    """A pipeline slot for ``request`` of ``flow``, or a no-op ticket when admission control is off."""
+    if not ADMISSION_ENABLED:
+        return free_ticket()
+    return await admission.admit(request, flow, weight)
+
+
+class _UnlimitedController(AdmissionController):
+    def _release(self, flow: Optional[Flow]) -> None:
+        pass
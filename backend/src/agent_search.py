@@ -1,15 +1,24 @@
 """Advanced search functionality using Lyzr Agents for multi-step query planning and execution."""
 
 import asyncio
+import os
+from itertools import zip_longest
 from typing import AsyncIterator, List, Optional
 
 from fastapi import HTTPException
 from pydantic import BaseModel, Field
 
 from auth import AuthenticatedUser
-from chat import rephrase_query_with_context, extract_search_terms, apply_date_range_filter
-from llm.lyzr_agent import LyzrSpecializedAgents
+from chat import rephrase_query_with_context, apply_date_range_filter
+from context_packing import estimate_tokens, pack_search_results
+from llm.agent_config import ANSWER_CONTEXT_TOKEN_BUDGET, SEARCH_QUERY_CONTEXT_TOKEN_BUDGET
+from llm.lyzr_agent import LyzrAgentLLM, LyzrSpecializedAgents
+from llm.structured import astream_structured_items
+from metrics import metrics
+from passages import select_relevant_results
+from plan_cache import discard_plan, get_plan, set_plan
 from prompts import CHAT_PROMPT, QUERY_PLAN_PROMPT, SEARCH_QUERY_PROMPT
+from query_analyzer import term_overlap
 from related_queries import generate_related_queries
 from schemas import (
     AgentFinishStream,
@@ -31,8 +40,18 @@ from schemas import (
     StreamEvent,
     TextChunkStream,
 )
-from search.search_service import perform_search
-from utils import PRO_MODE_ENABLED
+from search.enrichment import enrich_search_results
+from search.search_service import SearchCacheKey, canonical_url, perform_search, search_cache_key
+from utils import PRO_MODE_ENABLED, strtobool
+
+PRO_SPECULATIVE_SEARCH_ENABLED = strtobool(os.getenv("PRO_SPECULATIVE_SEARCH_ENABLED", "true"))
+PRO_SPECULATIVE_SEARCH_MIN_OVERLAP = float(os.getenv("PRO_SPECULATIVE_SEARCH_MIN_OVERLAP", "0.3"))
+PRO_SEARCH_BATCH_QUERIES = strtobool(os.getenv("PRO_SEARCH_BATCH_QUERIES", "true"))
+PRO_SEARCH_STEP_DEADLINE = float(os.getenv("PRO_SEARCH_STEP_DEADLINE", "4"))
+
+metrics.register_rate(
+    "pro_speculative_search.fuse_rate", "pro_speculative_search.fused", "pro_speculative_search.started"
+)
 
 
 class QueryPlanStep(BaseModel):
@@ -45,13 +64,267 @@ class QueryPlanStep(BaseModel):
     )
 
 
+MAX_QUERY_PLAN_STEPS = 4
+# Least term overlap of a streamed step and the same step in a plan made again after the stream broke
+PLAN_CONTINUATION_MIN_OVERLAP = 0.5
+
+
 class QueryPlan(BaseModel):
     steps: list[QueryPlanStep] = Field(
-        ..., description="The steps to complete the query", max_length=4
+        ..., description="The steps to complete the query", max_length=MAX_QUERY_PLAN_STEPS
     )
 
 
+def renumber_plan_step(step: QueryPlanStep, index: int, id_map: dict[int, int]) -> QueryPlanStep:
+    """
+    Give the step at ``index`` that index as its id, and keep only dependencies on earlier steps.
+
+    ``id_map`` maps the planner's ids of the earlier steps to their new ids and is
+    updated with this step, so plans numbered from 1, with duplicate ids, or with
+    dependencies on unknown or later steps still execute in order.
+    """
+    dependencies = sorted({id_map[id] for id in step.dependencies if id in id_map})
+    id_map.setdefault(step.id, index)
+    return QueryPlanStep(id=index, step=step.step, dependencies=dependencies)
+
+
+def complete_query_plan(steps: list[QueryPlanStep], query: str) -> list[QueryPlanStep]:
+    """
+    Make sure the plan has a search step and a final step that depends on something.
+
+    A plan with a single step searches for it and adds a final step; a final step
+    without dependencies is made to depend on every earlier step.
+    """
+    steps = list(steps)
+    if not steps:
+        steps.append(QueryPlanStep(id=0, step=query, dependencies=[]))
+    if len(steps) == 1:
+        steps.append(QueryPlanStep(id=1, step=f"Answer: {query}", dependencies=[0]))
+    final = steps[-1]
+    if not final.dependencies:
+        steps[-1] = final.model_copy(update={"dependencies": [step.id for step in steps[:-1]]})
+    return steps
+
+
+def repair_query_plan(query_plan: QueryPlan, query: str) -> QueryPlan:
+    """Renumber, validate and complete a whole plan (see ``renumber_plan_step``)."""
+    id_map: dict[int, int] = {}
+    steps = [
+        renumber_plan_step(step, index, id_map)
+        for index, step in enumerate(query_plan.steps[:MAX_QUERY_PLAN_STEPS])
+    ]
+    return QueryPlan(steps=complete_query_plan(steps, query))
+
+
+class StreamedQueryPlan:
+    """
+    A query plan whose steps become available as the planning agent streams them.
+
+    ``stream`` consumes the planner's output and emits the growing plan; iterating
+    the plan yields ``(index, step, is_last_step)``. A step is handed out once the
+    next step (or the end of the plan) has arrived, since only then is it known
+    whether it is the final, answering step. Steps are repaired as they arrive
+    (see ``renumber_plan_step``) and the plan is completed when the planner is done.
+
+    If the planner's stream breaks, the rest of the plan comes from a new plan
+    only when that one starts with the steps already streamed (same ids and
+    dependencies, similar wording), since those are already being searched.
+    Otherwise the plan ends with an answering step over the streamed steps.
+    """
+
+    def __init__(self, query: str):
+        self.query = query
+        self.steps: list[QueryPlanStep] = []
+        self._id_map: dict[int, int] = {}
+        self._queue: asyncio.Queue[Optional[QueryPlanStep]] = asyncio.Queue()
+        self._error: Optional[Exception] = None
+        self._truncated = False
+        self.complete = False
+        # The planner's plan had to be cut short, truncated or completed here
+        self.repaired = False
+
+    def _plan_event(self) -> ChatResponseEvent:
+        return ChatResponseEvent(
+            event=StreamEvent.AGENT_QUERY_PLAN,
+            data=AgentQueryPlanStream(steps=[step.step for step in self.steps]),
+        )
+
+    async def stream(
+        self, agent: LyzrAgentLLM, prompt: str, session_id: str, user_id: str = None
+    ) -> AsyncIterator[ChatResponseEvent]:
+        try:
+            async for step in astream_structured_items(
+                agent,
+                QueryPlan,
+                "steps",
+                prompt,
+                session_id=session_id,
+                user_id=user_id,
+                inject_schema=not agent.has_json_schema_response,
+                continues=self._continues,
+            ):
+                if len(self.steps) >= MAX_QUERY_PLAN_STEPS:
+                    self.repaired = True
+                    break
+                step = renumber_plan_step(step, len(self.steps), self._id_map)
+                self.steps.append(step)
+                print(f"Query plan step {step}")
+                yield self._plan_event()
+                self._queue.put_nowait(step)
+
+            steps = self.steps
+            if self._truncated and len(steps) < MAX_QUERY_PLAN_STEPS:
+                # The last streamed step searches; the plan still needs an answer
+                answer = QueryPlanStep(
+                    id=len(steps), step=f"Answer: {self.query}", dependencies=[step.id for step in steps]
+                )
+                steps = steps + [answer]
+            completed = complete_query_plan(steps, self.query)
+            added = completed[len(self.steps):]
+            self.repaired = self.repaired or completed != self.steps
+            self.steps = completed
+            if added:
+                print(f"Query plan completed with {added}")
+                yield self._plan_event()
+                for step in added:
+                    self._queue.put_nowait(step)
+            self.complete = True
+        except Exception as e:
+            self._error = e
+            raise
+        finally:
+            self._queue.put_nowait(None)
+
+    def _continues(self, streamed: list[QueryPlanStep], steps: list[QueryPlanStep]) -> bool:
+        """Whether a plan made again after the stream broke starts with the streamed steps."""
+        continued = len(steps) > len(streamed) and all(
+            new.id == old.id
+            and new.dependencies == old.dependencies
+            and term_overlap(new.step, old.step) >= PLAN_CONTINUATION_MIN_OVERLAP
+            for old, new in zip(streamed, steps)
+        )
+        self._truncated = not continued
+        return continued
+
+    async def replay(self, query_plan: QueryPlan) -> AsyncIterator[ChatResponseEvent]:
+        """Emit a whole, already repaired plan at once, instead of streaming it from the planner."""
+        self.steps = list(query_plan.steps)
+        self.complete = True
+        yield self._plan_event()
+        for step in self.steps:
+            self._queue.put_nowait(step)
+        self._queue.put_nowait(None)
+
+    def pending_steps(self) -> list[QueryPlanStep]:
+        """Known steps that may still need searching (the final one is excluded once known)."""
+        return self.steps[:-1] if self.complete else list(self.steps)
+
+    async def __aiter__(self) -> AsyncIterator[tuple[int, QueryPlanStep, bool]]:
+        index = 0
+        step = await self._queue.get()
+        while step is not None:
+            next_step = await self._queue.get()
+            if next_step is None and self._error is not None:
+                raise self._error
+            is_last_step = next_step is None
+            # The completed plan may have given the final step its dependencies
+            yield index, self.steps[index] if is_last_step else step, is_last_step
+            step, index = next_step, index + 1
+
+
+def cached_query_plan(request: ChatRequest, query: str) -> Optional[QueryPlan]:
+    """
+    The cached plan for ``query``, validated and repaired as a new plan would be.
+
+    Follow-up turns are planned from their conversation and never use the cache.
+    """
+    if request.session_id:
+        return None
+    plan = get_plan(query)
+    if plan is None:
+        return None
+    try:
+        query_plan = repair_query_plan(QueryPlan.model_validate(plan), query)
+    except Exception as e:
+        metrics.increment("plan_cache.invalid")
+        print(f"🗺️ Discarding invalid cached query plan: {e}")
+        discard_plan(query)
+        return None
+    print(f"🗺️ Reusing cached query plan with {len(query_plan.steps)} steps")
+    return query_plan
+
+
+async def cache_query_plan(
+    request: ChatRequest, query: str, query_plan: "StreamedQueryPlan", events: AsyncIterator[ChatResponseEvent]
+) -> AsyncIterator[ChatResponseEvent]:
+    """
+    Pass the planner's events through, caching the plan once it is complete.
+
+    Plans the planner didn't get right by itself (truncated by a broken
+    stream, too long, or completed here) answer this request but aren't reused.
+    """
+    async for event in events:
+        yield event
+    if query_plan.repaired:
+        metrics.increment("plan_cache.repaired_skipped")
+        print("🗺️ Not caching a query plan that had to be completed")
+    elif query_plan.complete and not request.session_id:
+        set_plan(query, QueryPlan(steps=query_plan.steps).model_dump())
+
+
+async def merge_event_streams(*streams: AsyncIterator[ChatResponseEvent]) -> AsyncIterator[ChatResponseEvent]:
+    """Yield the events of several streams as they are produced, failing if any stream fails."""
+    queue: asyncio.Queue = asyncio.Queue()
+    finished = object()
+
+    async def pump(stream: AsyncIterator[ChatResponseEvent]):
+        try:
+            async for event in stream:
+                await queue.put(event)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(finished)
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in streams]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is finished:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class StepContext(BaseModel):
+    step: str
+    context: str
+
+
+class ProSearchState(BaseModel):
+    """What a pro search has gathered so far, so a failure can still be answered from it."""
+
+    step_context: dict[int, StepContext] = Field(default_factory=dict)
+    search_result_map: dict[int, list[SearchResult]] = Field(default_factory=dict)
+    context_result_map: dict[int, list[SearchResult]] = Field(default_factory=dict)
+    image_map: dict[int, list[str]] = Field(default_factory=dict)
+    # Search responses by normalized query, and page-enriched results by canonical URL,
+    # so what several steps share is only searched and fetched once
+    search_memo: dict[SearchCacheKey, SearchResponse] = Field(default_factory=dict)
+    enriched_results: dict[str, SearchResult] = Field(default_factory=dict)
+    agent_search_steps: list[AgentSearchStep] = Field(default_factory=list)
+    generated_queries: dict[int, list[str]] = Field(default_factory=dict)
+    answer_started: bool = False
+
+
 class QueryStepExecution(BaseModel):
+    step_id: int | None = Field(None, description="Id of the step the queries are for")
     search_queries: list[str] | None = Field(
         ...,
         description="The search queries to complete the step",
@@ -60,9 +333,10 @@ class QueryStepExecution(BaseModel):
     )
 
 
-class StepContext(BaseModel):
-    step: str
-    context: str
+class BatchQueryStepExecution(BaseModel):
+    steps: list[QueryStepExecution] = Field(
+        ..., description="The search queries for each requested step"
+    )
 
 
 def format_step_context(step_contexts: list[StepContext]) -> str:
@@ -71,50 +345,266 @@ def format_step_context(step_contexts: list[StepContext]) -> str:
     )
 
 
-async def ranked_search_results_and_images_from_queries(
-    queries: list[str],
-    time_range: str = None,
-    num_results: int = 10,
-    start_date: str = None,
-    end_date: str = None,
-) -> tuple[list[SearchResult], list[str]]:
-    # Apply custom date range filters to all queries if provided
-    filtered_queries = [
-        apply_date_range_filter(query, start_date=start_date, end_date=end_date)
-        for query in queries
-    ]
+def format_steps_to_execute(steps: list[QueryPlanStep], step_context: dict[int, StepContext]) -> str:
+    return "\n\n".join(
+        f"Step id: {step.id}\nStep to execute: {step.step}\n"
+        f"Context from previous steps:\n{format_step_context([step_context[id] for id in step.dependencies])}"
+        for step in steps
+    )
+
 
-    search_responses: list[SearchResponse] = await asyncio.gather(
-        *(perform_search(query, time_range=time_range, num_results=num_results) for query in filtered_queries)
+async def generate_search_queries(
+    search_query_agent: LyzrAgentLLM,
+    steps: list[QueryPlanStep],
+    step_context: dict[int, StepContext],
+    query: str,
+    current_datetime: str,
+    session_id: str,
+    user_id: str = None,
+) -> dict[int, list[str]]:
+    """
+    Ask the search query agent for the queries of several steps in one call.
+
+    Returns a map of step id to search queries. Answers without step ids are
+    matched to the steps by position when their count matches.
+    """
+    # Format prompt with actual values (system_prompt_variables don't work in messages)
+    formatted_search_query_prompt = (SEARCH_QUERY_PROMPT
+                                    .replace("{{ user_query }}", query)
+                                    .replace("{{ steps }}", format_steps_to_execute(steps, step_context))
+                                    .replace("{{ current_datetime }}", current_datetime))
+
+    execution = await search_query_agent.astructured_complete(
+        response_model=BatchQueryStepExecution,
+        prompt=formatted_search_query_prompt,
+        session_id=session_id,
+        user_id=user_id
     )
-    all_search_results = [response.results for response in search_responses]
-    all_images = [response.images for response in search_responses]
 
-    # interleave the search results, for fair ranking
-    ranked_results: list[SearchResult] = [
-        result for results in zip(*all_search_results) for result in results if result
-    ]
-    unique_results = list({result.url: result for result in ranked_results}.values())
+    requested_ids = [step.id for step in steps]
+    answered_ids = [step_execution.step_id for step_execution in execution.steps]
+    if set(answered_ids) != set(requested_ids) and len(answered_ids) == len(requested_ids):
+        answered_ids = requested_ids
+    return {
+        step_id: step_execution.search_queries
+        for step_id, step_execution in zip(answered_ids, execution.steps)
+        if step_id in requested_ids and step_execution.search_queries
+    }
+
+
+class StepSearch:
+    """
+    The searches of one step's queries, ranked together as each one returns.
+
+    ``progress`` yields the step's results every time a query completes. Once
+    PRO_SEARCH_STEP_DEADLINE seconds have passed and at least one query has
+    returned, the step moves on without the stragglers; ``merge_late`` takes in
+    the ones that have finished by the time the answer is written and cancels
+    the rest.
+
+    Queries already answered in ``memo`` (the request's earlier steps) are not
+    searched again, and new responses are added to it.
+    """
+
+    def __init__(
+        self,
+        queries: list[str],
+        time_range: str = None,
+        num_results: int = 10,
+        start_date: str = None,
+        end_date: str = None,
+        memo: Optional[dict[SearchCacheKey, SearchResponse]] = None,
+    ):
+        self.queries = queries
+        self.memo = memo if memo is not None else {}
+        self.responses: list[Optional[SearchResponse]] = [None] * len(queries)
+        self.errors: list[Exception] = []
+        self.tasks: dict[asyncio.Task, int] = {}
+        self._keys: list[SearchCacheKey] = []
+        for index, query in enumerate(queries):
+            # Apply custom date range filters to all queries if provided
+            filtered_query = apply_date_range_filter(query, start_date=start_date, end_date=end_date)
+            key = search_cache_key(filtered_query, time_range, num_results)
+            self._keys.append(key)
+            if key in self.memo:
+                metrics.increment("pro_search.memo_hits")
+                self.responses[index] = self.memo[key]
+            elif key in self._keys[:index]:
+                continue  # The same query twice in one step
+            else:
+                task = asyncio.create_task(
+                    perform_search(filtered_query, time_range=time_range, num_results=num_results)
+                )
+                self.tasks[task] = index
 
-    images = list({image: image for images in all_images for image in images}.values())
-    return unique_results, images
+    @property
+    def pending(self) -> bool:
+        return any(not task.done() for task in self.tasks)
 
+    def ranked(self) -> tuple[list[SearchResult], list[str]]:
+        responses = [response for response in self.responses if response is not None]
 
-def build_context_from_search_results(search_results: list[SearchResult]) -> str:
-    context = "\n".join(str(result) for result in search_results)
-    return context[:7000]
+        # interleave the search results, for fair ranking
+        ranked_results: list[SearchResult] = [
+            result for results in zip_longest(*(response.results for response in responses)) for result in results if result
+        ]
+        unique_results = list({canonical_url(result.url): result for result in ranked_results}.values())
+
+        images = list(dict.fromkeys(image for response in responses for image in response.images))
+        return unique_results, images
+
+    def _collect(self, tasks) -> bool:
+        """Store the responses of finished ``tasks``, returning whether any succeeded."""
+        collected = False
+        for task in tasks:
+            if task.cancelled():
+                continue
+            index = self.tasks[task]
+            try:
+                self.responses[index] = self.memo[self._keys[index]] = task.result()
+                collected = True
+            except Exception as e:
+                metrics.increment("pro_search.query_errors")
+                print(f"Search for '{self.queries[index]}' failed: {getattr(e, 'detail', None) or e}")
+                self.errors.append(e)
+        return collected
+
+    async def progress(
+        self, deadline: float = PRO_SEARCH_STEP_DEADLINE
+    ) -> AsyncIterator[tuple[list[SearchResult], list[str]]]:
+        """
+        Yield the ranked results and images each time a query returns.
+
+        Raises the first search error when every query failed.
+        """
+        loop = asyncio.get_running_loop()
+        expires = loop.time() + deadline if deadline > 0 else None
+        pending = set(self.tasks)
+        if any(response is not None for response in self.responses):
+            yield self.ranked()
+        while pending:
+            # Never give up on a step before it has any results
+            has_results = any(response is not None for response in self.responses)
+            timeout = max(expires - loop.time(), 0) if expires is not None and has_results else None
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                metrics.increment("pro_search.straggling_queries", len(pending))
+                print(f"⏱️ Step deadline passed with {len(pending)} of {len(self.tasks)} searches still running")
+                return
+            if self._collect(done):
+                yield self.ranked()
+
+        if not any(response is not None for response in self.responses) and self.errors:
+            raise self.errors[0]
+
+    def merge_late(self) -> bool:
+        """Take in the stragglers that finished since the deadline and cancel the rest."""
+        finished = [
+            task for task, index in self.tasks.items()
+            if task.done() and self.responses[index] is None
+        ]
+        self.cancel()
+        return self._collect(finished)
+
+    def cancel(self) -> None:
+        for task in self.tasks:
+            if not task.done():
+                task.cancel()
+
+
+def start_broad_search(request: ChatRequest, query: str) -> Optional[asyncio.Task]:
+    """
+    Search the whole question while the planner works out the steps.
+
+    The response lands in the search cache either way, and can be fused into
+    the first step's results once its search queries are known. The task is
+    left to finish even when it is not used, so the cache is still seeded.
+    """
+    if not PRO_SPECULATIVE_SEARCH_ENABLED:
+        return None
+    metrics.increment("pro_speculative_search.started")
+    search_query = apply_date_range_filter(query, start_date=request.start_date, end_date=request.end_date)
+    task = asyncio.create_task(
+        perform_search(search_query, time_range=request.time_range, num_results=request.max_results)
+    )
+    # Unused broad searches may fail without anyone awaiting them
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    return task
+
+
+async def fuse_broad_search_results(
+    broad_search: asyncio.Task,
+    query: str,
+    search_queries: list[str],
+    step_results: list[SearchResult],
+    step_images: list[str],
+) -> tuple[list[SearchResult], list[str]]:
+    """
+    Interleave the broad search results into a step's results when relevant.
+
+    The broad results are used when the question shares at least
+    PRO_SPECULATIVE_SEARCH_MIN_OVERLAP of its terms with one of the step's
+    search queries; otherwise the step's own results are returned unchanged.
+    """
+    overlap = max((term_overlap(query, search_query) for search_query in search_queries), default=0.0)
+    if overlap < PRO_SPECULATIVE_SEARCH_MIN_OVERLAP:
+        metrics.increment("pro_speculative_search.discarded")
+        print(f"🎲 Broad search not fused (overlap {overlap:.2f})")
+        return step_results, step_images
+
+    try:
+        broad_response: SearchResponse = await broad_search
+    except Exception as e:
+        metrics.increment("pro_speculative_search.errors")
+        print(f"🎲 Broad search failed: {e}")
+        return step_results, step_images
+
+    seen = {canonical_url(result.url) for result in step_results}
+    extra_results = [result for result in broad_response.results if canonical_url(result.url) not in seen]
+    fused: list[SearchResult] = []
+    for index in range(max(len(step_results), len(extra_results))):
+        fused.extend(step_results[index:index + 1])
+        fused.extend(extra_results[index:index + 1])
+    images = list(dict.fromkeys(step_images + broad_response.images))
+
+    metrics.increment("pro_speculative_search.fused")
+    print(f"🎲 Fused {len(extra_results)} broad search results into the first step (overlap {overlap:.2f})")
+    return fused, images
+
+
+def build_context_from_search_results(
+    search_results: list[SearchResult],
+    token_budget: int = SEARCH_QUERY_CONTEXT_TOKEN_BUDGET,
+) -> str:
+    return pack_search_results(
+        search_results, token_budget, separator="\n", label="step context"
+    ).text
 
 
 def format_context_with_steps(
     search_results_map: dict[int, list[SearchResult]],
     step_contexts: dict[int, StepContext],
+    token_budget: int = ANSWER_CONTEXT_TOKEN_BUDGET,
+    query: str | None = None,
 ) -> str:
-    context = "\n".join(
-        f"Everything below is context for step: {step_contexts[step_id].step}\nContext: {build_context_from_search_results(search_results_map[step_id])}\n{'-'*20}\n"
-        for step_id in sorted(step_contexts.keys())
-    )
-    context = context[:10000]
-    return context
+    """Per-step answer context; with ``query``, only its most relevant passages are kept."""
+    # Split the answer agent's budget evenly between the steps
+    step_ids = sorted(step_contexts.keys())
+    if not step_ids:
+        return ""
+    step_budget = token_budget // len(step_ids)
+
+    sections = []
+    for step_id in step_ids:
+        header = f"Everything below is context for step: {step_contexts[step_id].step}\nContext: "
+        step_results = search_results_map[step_id]
+        if query:
+            step_results, _ = select_relevant_results(step_results, query)
+        context = build_context_from_search_results(
+            step_results, step_budget - estimate_tokens(header)
+        )
+        sections.append(f"{header}{context}\n{'-'*20}\n")
+    return "\n".join(sections)
 
 
 async def stream_pro_search_objects(
@@ -140,234 +630,404 @@ async def stream_pro_search_objects(
     formatted_query_plan_prompt = (QUERY_PLAN_PROMPT
                                    .replace("{{ user_query }}", query)
                                    .replace("{{ current_datetime }}", current_datetime))
-    
-    query_plan = query_planning_agent.structured_complete(
-        response_model=QueryPlan,
-        prompt=formatted_query_plan_prompt,
-        session_id=session_id,
-        user_id=user_id
-    )
-    print(query_plan)
 
-    yield ChatResponseEvent(
-        event=StreamEvent.AGENT_QUERY_PLAN,
-        data=AgentQueryPlanStream(steps=[step.step for step in query_plan.steps]),
+    # Search the whole question while the plan is being made
+    broad_search = start_broad_search(request, query)
+
+    # Steps are executed while the planner is still writing the later ones,
+    # or right away when the question was planned before
+    query_plan = StreamedQueryPlan(query)
+    cached_plan = cached_query_plan(request, query)
+    if cached_plan is not None:
+        plan_events = query_plan.replay(cached_plan)
+    else:
+        plan_events = cache_query_plan(
+            request,
+            query,
+            query_plan,
+            query_plan.stream(query_planning_agent, formatted_query_plan_prompt, session_id, user_id),
+        )
+    state = ProSearchState()
+    try:
+        async for event in merge_event_streams(
+            plan_events,
+            execute_query_plan(
+                query_plan,
+                request,
+                specialized_agents,
+                query,
+                session_id,
+                user_id,
+                current_datetime,
+                broad_search,
+                state,
+            ),
+        ):
+            yield event
+    except Exception as e:
+        # Answer from the steps searched so far instead of starting over, unless
+        # nothing was found yet or the answer had already started streaming
+        if state.answer_started or not state.search_result_map:
+            raise
+        print(f"⚠️ Pro search failed after {len(state.search_result_map)} steps, answering from them: {getattr(e, 'detail', None) or e}")
+        metrics.increment("pro_search.partial_answers")
+        final_step = QueryPlanStep(
+            id=len(query_plan.steps),
+            step=f"Answer: {query}",
+            dependencies=sorted(state.search_result_map),
+        )
+        async for event in synthesize_answer(
+            state, final_step, request, specialized_agents, query, session_id, user_id
+        ):
+            yield event
+
+
+async def enrich_step_results(
+    state: ProSearchState, search_results: list[SearchResult]
+) -> tuple[list[SearchResult], list[SearchResult]]:
+    """
+    Page-enriched copies of a step's results, fetching only URLs no earlier step had.
+
+    Returns the enriched results of the whole step, for its own context, and
+    the ones new to the request, so the answer context has every source once.
+    """
+    new_results: list[SearchResult] = []
+    for result in search_results:
+        url = canonical_url(result.url)
+        if url not in state.enriched_results:
+            # Reserved until enriched, for a duplicate later in the same step
+            state.enriched_results[url] = result
+            new_results.append(result)
+    for result in await enrich_search_results(new_results):
+        state.enriched_results[canonical_url(result.url)] = result
+
+    if len(new_results) < len(search_results):
+        metrics.increment("pro_search.duplicate_results", len(search_results) - len(new_results))
+    return (
+        [state.enriched_results[canonical_url(result.url)] for result in search_results],
+        [state.enriched_results[canonical_url(result.url)] for result in new_results],
     )
 
-    step_context: dict[int, StepContext] = {}
-    search_result_map: dict[int, list[SearchResult]] = {}
-    image_map: dict[int, list[str]] = {}
-    agent_search_steps: list[AgentSearchStep] = []
-
-    for idx, step in enumerate(query_plan.steps):
-        step_id = step.id
-        is_last_step = idx == len(query_plan.steps) - 1
-        dependencies = step.dependencies
-
-        relevant_context = [step_context[id] for id in dependencies]
-
-        if not is_last_step:
-            # Use specialized search query agent
-            search_query_agent = specialized_agents.get_search_query_agent()
-            print(f"Using search query agent for step {step_id}")
-
-            # Format prompt with actual values (system_prompt_variables don't work in messages)
-            formatted_search_query_prompt = (SEARCH_QUERY_PROMPT
-                                            .replace("{{ user_query }}", query)
-                                            .replace("{{ current_step }}", step.step)
-                                            .replace("{{ prev_steps_context }}", format_step_context(relevant_context))
-                                            .replace("{{ current_datetime }}", current_datetime))
-            
-            query_step_execution = search_query_agent.structured_complete(
-                response_model=QueryStepExecution,
-                prompt=formatted_search_query_prompt,
-                session_id=session_id,
-                user_id=user_id
-            )
-            search_queries = query_step_execution.search_queries
-            if not search_queries:
-                raise HTTPException(
-                    status_code=500,
-                    detail="There was an error generating the search queries",
-                )
 
-            yield ChatResponseEvent(
-                event=StreamEvent.AGENT_SEARCH_QUERIES,
-                data=AgentSearchQueriesStream(
-                    queries=search_queries, step_number=step_id
-                ),
-            )
+async def merge_late_search_results(
+    state: ProSearchState, step_searches: dict[int, StepSearch]
+) -> AsyncIterator[ChatResponseEvent]:
+    """Append the results of searches that missed their step's deadline but have finished since."""
+    for step_id, step_search in step_searches.items():
+        if not step_search.merge_late():
+            continue
+        known_urls = {canonical_url(result.url) for result in state.search_result_map[step_id]}
+        search_results, images = step_search.ranked()
+        late_results = [result for result in search_results if canonical_url(result.url) not in known_urls]
+        if not late_results:
+            continue
 
-            (
-                search_results,
-                image_results,
-            ) = await ranked_search_results_and_images_from_queries(
-                search_queries,
-                time_range=request.time_range,
-                num_results=request.max_results,
-                start_date=request.start_date,
-                end_date=request.end_date
-            )
-            search_result_map[step_id] = search_results
-            image_map[step_id] = image_results
-
-            yield ChatResponseEvent(
-                event=StreamEvent.AGENT_READ_RESULTS,
-                data=AgentReadResultsStream(
-                    results=search_results, step_number=step_id
-                ),
-            )
-            context = build_context_from_search_results(search_results)
-            step_context[step_id] = StepContext(step=step.step, context=context)
-
-            agent_search_steps.append(
-                AgentSearchStep(
-                    step_number=step_id,
-                    step=step.step,
-                    queries=search_queries,
-                    results=search_results,
-                    status=AgentSearchStepStatus.DONE,
-                )
-            )
-        else:
-            yield ChatResponseEvent(
-                event=StreamEvent.AGENT_FINISH,
-                data=AgentFinishStream(),
-            )
+        # Appended, so the results the step was searched with keep their ranking
+        state.search_result_map[step_id] = state.search_result_map[step_id] + late_results
+        state.image_map[step_id] = list(dict.fromkeys(state.image_map[step_id] + images))
+        _, new_context_results = await enrich_step_results(state, late_results)
+        state.context_result_map[step_id] = state.context_result_map[step_id] + new_context_results
+        for agent_search_step in state.agent_search_steps:
+            if agent_search_step.step_number == step_id:
+                agent_search_step.results = state.search_result_map[step_id]
 
-            yield ChatResponseEvent(
-                event=StreamEvent.BEGIN_STREAM,
-                data=BeginStream(query=query),
-            )
+        metrics.increment("pro_search.late_results", len(late_results))
+        print(f"⏱️ Merged {len(late_results)} late results into step {step_id}")
+        yield ChatResponseEvent(
+            event=StreamEvent.AGENT_READ_RESULTS,
+            data=AgentReadResultsStream(
+                results=state.search_result_map[step_id], step_number=step_id
+            ),
+        )
 
-            # Get 12 results total, but distribute them evenly across dependencies
-            relevant_result_map: dict[int, list[SearchResult]] = {
-                id: search_result_map[id] for id in dependencies
-            }
-            DESIRED_RESULT_COUNT = 12
-            total_results = sum(
-                len(results) for results in relevant_result_map.values()
-            )
-            results_per_dependency = min(
-                DESIRED_RESULT_COUNT // len(dependencies),
-                total_results // len(dependencies),
-            )
-            for id in dependencies:
-                relevant_result_map[id] = search_result_map[id][:results_per_dependency]
 
-            search_results = [
-                result for results in relevant_result_map.values() for result in results
-            ]
+async def execute_query_plan(
+    query_plan: "StreamedQueryPlan",
+    request: ChatRequest,
+    specialized_agents: LyzrSpecializedAgents,
+    query: str,
+    session_id: str,
+    user_id: str,
+    current_datetime: str,
+    broad_search: Optional[asyncio.Task] = None,
+    state: Optional["ProSearchState"] = None,
+) -> AsyncIterator[ChatResponseEvent]:
+    """Search for each step of the plan as it arrives, then answer in the final step."""
+    state = state if state is not None else ProSearchState()
+    step_context = state.step_context
+    generated_queries = state.generated_queries
+    # Steps whose searches were still running at their deadline
+    step_searches: dict[int, StepSearch] = {}
 
-            # Remove duplicates
-            search_results = list(
-                {result.url: result for result in search_results}.values()
-            )
-            images = [image for id in dependencies for image in image_map[id][:2]]
-
-            related_queries_task = None
-            related_queries_task = asyncio.create_task(
-                generate_related_queries(
-                    query,
-                    search_results,
-                    specialized_agents.get_related_questions_agent(),
-                    session_id  # Pass session_id for context continuity
-                )
-            )
+    try:
+        async for idx, step, is_last_step in query_plan:
+            step_id = step.id
+            dependencies = step.dependencies
 
-            yield ChatResponseEvent(
-                event=StreamEvent.SEARCH_RESULTS,
-                data=SearchResultStream(
-                    results=search_results,
-                    images=images,
-                ),
-            )
+            if not is_last_step:
+                if step_id not in generated_queries:
+                    # Use specialized search query agent, for every step that is ready if batching
+                    search_query_agent = specialized_agents.get_search_query_agent()
+                    ready_steps = [step]
+                    if PRO_SEARCH_BATCH_QUERIES:
+                        ready_steps += [
+                            other
+                            for other in query_plan.pending_steps()
+                            if other.id != step_id
+                            and other.id not in generated_queries
+                            and all(id in step_context for id in other.dependencies)
+                        ]
+                    print(f"Using search query agent for steps {[ready.id for ready in ready_steps]}")
+                    generated_queries.update(
+                        await generate_search_queries(
+                            search_query_agent,
+                            ready_steps,
+                            step_context,
+                            query,
+                            current_datetime,
+                            session_id,
+                            user_id,
+                        )
+                    )
+                    if step_id not in generated_queries and len(ready_steps) > 1:
+                        print(f"Step {step_id} missing from the batched search queries, asking for it alone")
+                        generated_queries.update(
+                            await generate_search_queries(
+                                search_query_agent, [step], step_context, query, current_datetime, session_id, user_id
+                            )
+                        )
+                search_queries = generated_queries.get(step_id)
+                if not search_queries:
+                    raise HTTPException(
+                        status_code=500,
+                        detail="There was an error generating the search queries",
+                    )
 
-            # Use specialized answer generation agent for final synthesis with system_prompt_variables
-            answer_agent = specialized_agents.get_answer_generation_agent()
-            print(f"Using answer generation agent for final synthesis")
-
-            # Build system_prompt_variables for the agent
-            from datetime import datetime
-            now = datetime.now()
-            current_datetime = now.strftime("%A, %B %d, %Y %I:%M %p")
-
-            # Add date range context to user query if date filters are active
-            query_with_context = query
-            if request.start_date or request.end_date:
-                if request.start_date and request.end_date:
-                    query_with_context = f"{query} (searching for results between {request.start_date} and {request.end_date})"
-                elif request.start_date:
-                    query_with_context = f"{query} (searching for results from {request.start_date} onwards)"
-                else:
-                    query_with_context = f"{query} (searching for results up to {request.end_date})"
-
-            final_system_prompt_vars = {
-                "search_context": format_context_with_steps(search_result_map, step_context),
-                "user_query": query_with_context,  # Include date range context
-                "current_datetime": current_datetime
-            }
-
-            # session_id already generated at the start of this function
-
-            full_response = ""
-            # Don't send the query as the message - the agent instructions already include it
-            # Send a simple instruction to trigger the answer generation
-            response_gen = await answer_agent.astream(
-                prompt="Please provide a comprehensive answer to the user's question based on the search context provided above.",
-                system_prompt_variables=final_system_prompt_vars,
-                session_id=session_id,
-                user_id=user_id
-            )
-            async for completion in response_gen:
-                full_response += completion.delta or ""
                 yield ChatResponseEvent(
-                    event=StreamEvent.TEXT_CHUNK,
-                    data=TextChunkStream(text=completion.delta or ""),
+                    event=StreamEvent.AGENT_SEARCH_QUERIES,
+                    data=AgentSearchQueriesStream(
+                        queries=search_queries, step_number=step_id
+                    ),
                 )
 
-            related_queries = await (
-                related_queries_task
-                if related_queries_task
-                else generate_related_queries(
-                    query,
-                    search_results,
-                    specialized_agents.get_related_questions_agent(),
-                    session_id
+                # Sources are shown as each query returns, not when the slowest one does
+                step_search = StepSearch(
+                    search_queries,
+                    time_range=request.time_range,
+                    num_results=request.max_results,
+                    start_date=request.start_date,
+                    end_date=request.end_date,
+                    memo=state.search_memo,
                 )
-            )
+                search_results: list[SearchResult] = []
+                image_results: list[str] = []
+                async for search_results, image_results in step_search.progress():
+                    yield ChatResponseEvent(
+                        event=StreamEvent.AGENT_READ_RESULTS,
+                        data=AgentReadResultsStream(
+                            results=search_results, step_number=step_id
+                        ),
+                    )
+                if step_search.pending:
+                    step_searches[step_id] = step_search
 
-            yield ChatResponseEvent(
-                event=StreamEvent.RELATED_QUERIES,
-                data=RelatedQueriesStream(related_queries=related_queries),
-            )
+                if idx == 0 and broad_search is not None:
+                    fused_results, image_results = await fuse_broad_search_results(
+                        broad_search, query, search_queries, search_results, image_results
+                    )
+                    if fused_results is not search_results:
+                        search_results = fused_results
+                        yield ChatResponseEvent(
+                            event=StreamEvent.AGENT_READ_RESULTS,
+                            data=AgentReadResultsStream(
+                                results=search_results, step_number=step_id
+                            ),
+                        )
+                state.search_result_map[step_id] = search_results
+                state.image_map[step_id] = image_results
 
-            yield ChatResponseEvent(
-                event=StreamEvent.FINAL_RESPONSE,
-                data=FinalResponseStream(message=full_response),
-            )
+                # Page text (if enabled) only feeds the agents, events keep the snippets.
+                # Sources found by an earlier step are in its answer context already
+                context_results, state.context_result_map[step_id] = await enrich_step_results(
+                    state, search_results
+                )
+                context = build_context_from_search_results(context_results)
+                step_context[step_id] = StepContext(step=step.step, context=context)
 
-            agent_search_steps.append(
-                AgentSearchStep(
-                    step_number=step_id,
-                    step=step.step,
-                    queries=[],
-                    results=[],
-                    status=AgentSearchStepStatus.DONE,
+                state.agent_search_steps.append(
+                    AgentSearchStep(
+                        step_number=step_id,
+                        step=step.step,
+                        queries=search_queries,
+                        results=search_results,
+                        status=AgentSearchStepStatus.DONE,
+                    )
                 )
-            )
+            else:
+                async for event in merge_late_search_results(state, step_searches):
+                    yield event
+                async for event in synthesize_answer(
+                    state, step, request, specialized_agents, query, session_id, user_id
+                ):
+                    yield event
+                return
+    finally:
+        for step_search in step_searches.values():
+            step_search.cancel()
+
+
+async def synthesize_answer(
+    state: ProSearchState,
+    step: QueryPlanStep,
+    request: ChatRequest,
+    specialized_agents: LyzrSpecializedAgents,
+    query: str,
+    session_id: str,
+    user_id: str = None,
+) -> AsyncIterator[ChatResponseEvent]:
+    """Answer from the results of the final step's dependencies and end the stream."""
+    dependencies = step.dependencies
+
+    yield ChatResponseEvent(
+        event=StreamEvent.AGENT_FINISH,
+        data=AgentFinishStream(),
+    )
 
-            # Database disabled - no persistence
-            thread_id = None
+    yield ChatResponseEvent(
+        event=StreamEvent.BEGIN_STREAM,
+        data=BeginStream(query=query),
+    )
+
+    # Only steps that were searched can provide context
+    dependencies = [id for id in dependencies if id in state.search_result_map]
+
+    # Get 12 results total, but distribute them evenly across dependencies
+    relevant_result_map: dict[int, list[SearchResult]] = {
+        id: state.search_result_map[id] for id in dependencies
+    }
+    DESIRED_RESULT_COUNT = 12
+    total_results = sum(
+        len(results) for results in relevant_result_map.values()
+    )
+    results_per_dependency = min(
+        DESIRED_RESULT_COUNT // max(len(dependencies), 1),
+        total_results // max(len(dependencies), 1),
+    )
+    for id in dependencies:
+        relevant_result_map[id] = state.search_result_map[id][:results_per_dependency]
 
-            yield ChatResponseEvent(
-                event=StreamEvent.STREAM_END,
-                data=StreamEndStream(
-                    thread_id=thread_id,  # Deprecated but kept for backwards compat
-                    session_id=session_id  # Return session_id so frontend can persist it
-                ),
+    search_results = [
+        result for results in relevant_result_map.values() for result in results
+    ]
+
+    # Remove duplicates
+    search_results = list(
+        {canonical_url(result.url): result for result in search_results}.values()
+    )
+    images = [image for id in dependencies for image in state.image_map[id][:2]]
+
+    # Only the passages relevant to the question go into the related questions prompt
+    related_context_results, _ = select_relevant_results(search_results, query)
+
+    # Related questions are generated alongside the answer, unless turned off under load
+    related_queries_task = None
+    if request.related_queries:
+        related_queries_task = asyncio.create_task(
+            generate_related_queries(
+                query,
+                related_context_results,
+                specialized_agents.get_related_questions_agent(),
+                session_id  # Pass session_id for context continuity
             )
-            return
+        )
+
+    yield ChatResponseEvent(
+        event=StreamEvent.SEARCH_RESULTS,
+        data=SearchResultStream(
+            results=search_results,
+            images=images,
+        ),
+    )
+
+    # Use specialized answer generation agent for final synthesis with system_prompt_variables
+    answer_agent = specialized_agents.get_answer_generation_agent()
+    print(f"Using answer generation agent for final synthesis")
+
+    # Build system_prompt_variables for the agent
+    from datetime import datetime
+    now = datetime.now()
+    current_datetime = now.strftime("%A, %B %d, %Y %I:%M %p")
+
+    # Add date range context to user query if date filters are active
+    query_with_context = query
+    if request.start_date or request.end_date:
+        if request.start_date and request.end_date:
+            query_with_context = f"{query} (searching for results between {request.start_date} and {request.end_date})"
+        elif request.start_date:
+            query_with_context = f"{query} (searching for results from {request.start_date} onwards)"
+        else:
+            query_with_context = f"{query} (searching for results up to {request.end_date})"
+
+    final_system_prompt_vars = {
+        "search_context": format_context_with_steps(
+            state.context_result_map, state.step_context, query=query
+        ),
+        "user_query": query_with_context,  # Include date range context
+        "current_datetime": current_datetime
+    }
+
+    # session_id already generated at the start of this function
+
+    state.answer_started = True
+    # Chunks are joined once at the end, instead of copying the answer for every delta
+    answer_chunks: list[str] = []
+    # Don't send the query as the message - the agent instructions already include it
+    # Send a simple instruction to trigger the answer generation
+    response_gen = await answer_agent.astream(
+        prompt="Please provide a comprehensive answer to the user's question based on the search context provided above.",
+        system_prompt_variables=final_system_prompt_vars,
+        session_id=session_id,
+        user_id=user_id
+    )
+    async for completion in response_gen:
+        answer_chunks.append(completion.delta or "")
+        yield ChatResponseEvent(
+            event=StreamEvent.TEXT_CHUNK,
+            data=TextChunkStream(text=completion.delta or ""),
+        )
+
+    related_queries = await related_queries_task if related_queries_task else []
+
+    yield ChatResponseEvent(
+        event=StreamEvent.RELATED_QUERIES,
+        data=RelatedQueriesStream(related_queries=related_queries),
+    )
+
+    yield ChatResponseEvent(
+        event=StreamEvent.FINAL_RESPONSE,
+        data=FinalResponseStream(message="".join(answer_chunks)),
+    )
+
+    state.agent_search_steps.append(
+        AgentSearchStep(
+            step_number=step.id,
+            step=step.step,
+            queries=[],
+            results=[],
+            status=AgentSearchStepStatus.DONE,
+        )
+    )
+
+    # Database disabled - no persistence
+    thread_id = None
+
+    yield ChatResponseEvent(
+        event=StreamEvent.STREAM_END,
+        data=StreamEndStream(
+            thread_id=thread_id,  # Deprecated but kept for backwards compat
+            session_id=session_id  # Return session_id so frontend can persist it
+        ),
+    )
 
 
 async def stream_pro_search_qa(
@@ -394,30 +1054,37 @@ async def stream_pro_search_qa(
         # Use dedicated query rephrase agent which has MEMORY enabled
         query = request.query
         if request.session_id:  # Only rephrase if we have an existing session (follow-up)
-            query = rephrase_query_with_context(request.query, request.session_id, specialized_agents, user_id)
+            query = await rephrase_query_with_context(request.query, request.session_id, specialized_agents, user_id)
 
         print(f"[Pro Search] Original query: {request.query}")
         if query != request.query:
             print(f"[Pro Search] Rephrased to: {query}")
 
-        # Try pro search, fallback to regular search if it fails
+        # Try pro search, fallback to regular search if it fails before finding anything
+        # (later failures are answered from the steps already searched)
+        answer_started = False
         try:
             async for event in stream_pro_search_objects(
                 request, specialized_agents, query, session, user_id
             ):
+                # From here on the client has part of an answer, which a fallback would repeat
+                answer_started = answer_started or event.event == StreamEvent.AGENT_FINISH
                 yield event
                 await asyncio.sleep(0)
         except Exception as pro_error:
+            if answer_started:
+                raise
             # Pro search failed - log and fallback to regular search
             print(f"⚠️ Pro search failed: {pro_error}")
             print("   Falling back to regular search mode...")
 
-            # Import and use regular search
+            # Import and use regular search, with the question already rephrased
             from chat import stream_qa_objects
             async for event in stream_qa_objects(
                 request=request,
                 session=session,
-                user=user
+                user=user,
+                standalone_query=query,
             ):
                 yield event
                 await asyncio.sleep(0)
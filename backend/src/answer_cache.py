@@ -0,0 +1,126 @@
+"""
+Cache of complete chat answers.
+
+Popular questions are answered again without running the pipeline: the event
+sequence of a completed answer (search results, text, related queries) is
+stored under the normalized query and the options that shape the answer, and
+replayed through the same response generators until ANSWER_CACHE_TTL expires.
+Follow-up turns carry a session_id, depend on their conversation, and always
+bypass the cache, and so do answers without sources, which a search outage
+(returned as no results) would otherwise keep around. A replayed answer ends
+without a session_id: no agent has a memory of it, so the client's next turn
+starts a conversation of its own rather than following up on a session that
+knows nothing of this answer.
+
+Paraphrases of a cached question are answered from a ``SemanticCache`` tier
+checked after the exact key.
+"""
+
+import asyncio
+import os
+from typing import AsyncIterator, Optional, Tuple
+
+from cache import TTLCache
+from metrics import metrics
+from schemas import ChatRequest, ChatResponseEvent, SearchMode, StreamEndStream, StreamEvent
+from semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticCache
+from utils import strtobool
+
+ANSWER_CACHE_ENABLED = strtobool(os.getenv("ANSWER_CACHE_ENABLED", "true"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "300"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "500"))
+ANSWER_CACHE_REPLAY_DELAY = float(os.getenv("ANSWER_CACHE_REPLAY_DELAY", "0"))
+
+# mode, time range, start date, end date, max results, related queries
+AnswerScope = Tuple[str, Optional[str], Optional[str], Optional[str], int, bool]
+AnswerCacheKey = Tuple[str, AnswerScope]
+
+_answer_cache: TTLCache[AnswerCacheKey, Tuple[ChatResponseEvent, ...]] = TTLCache(
+    ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL
+)
+_semantic_answer_cache: SemanticCache[Tuple[ChatResponseEvent, ...]] = SemanticCache(
+    "answers", ANSWER_CACHE_MAX_ENTRIES, ANSWER_CACHE_TTL
+)
+
+metrics.register_rate("answer_cache.hit_rate", "answer_cache.hits", "answer_cache.lookups")
+
+
+def answer_scope(request: ChatRequest, mode: SearchMode) -> AnswerScope:
+    # Domain filters of the compatible API are site: operators in the query itself
+    return (
+        mode.value,
+        request.time_range or None,
+        request.start_date or None,
+        request.end_date or None,
+        request.max_results,
+        request.related_queries,
+    )
+
+
+def answer_cache_key(request: ChatRequest, mode: SearchMode) -> AnswerCacheKey:
+    return " ".join(request.query.lower().split()), answer_scope(request, mode)
+
+
+def is_cacheable(request: ChatRequest) -> bool:
+    return ANSWER_CACHE_ENABLED and not request.session_id and request.thread_id is None
+
+
+def lookup_answer(request: ChatRequest, mode: SearchMode) -> Optional[Tuple[ChatResponseEvent, ...]]:
+    """The cached events answering ``request`` in ``mode``, if any."""
+    if not is_cacheable(request):
+        return None
+    metrics.increment("answer_cache.lookups")
+    events = _answer_cache.get(answer_cache_key(request, mode))
+    if events is None and SEMANTIC_CACHE_ENABLED:
+        events = _semantic_answer_cache.get(request.query, answer_scope(request, mode))
+    if events is not None:
+        metrics.increment("answer_cache.hits")
+        print(f"💾 Answer cache hit for: {request.query}")
+    return events
+
+
+def sessionless_stream_end() -> ChatResponseEvent:
+    """The end of an answer that no agent conversation remembers."""
+    return ChatResponseEvent(event=StreamEvent.STREAM_END, data=StreamEndStream())
+
+
+async def replay_answer(events: Tuple[ChatResponseEvent, ...]) -> AsyncIterator[ChatResponseEvent]:
+    """
+    Stream cached events as if they were being generated.
+
+    With ANSWER_CACHE_REPLAY_DELAY set, text chunks are paced by that many
+    seconds instead of arriving all at once.
+    """
+    for event in events:
+        if event.event == StreamEvent.STREAM_END:
+            event = sessionless_stream_end()
+        elif event.event == StreamEvent.TEXT_CHUNK and ANSWER_CACHE_REPLAY_DELAY > 0:
+            await asyncio.sleep(ANSWER_CACHE_REPLAY_DELAY)
+        yield event
+
+
+async def record_answer(
+    request: ChatRequest, mode: SearchMode, stream: AsyncIterator[ChatResponseEvent]
+) -> AsyncIterator[ChatResponseEvent]:
+    """Pass ``stream`` through, caching its events once it ends without an error and with sources."""
+    if not is_cacheable(request):
+        async for event in stream:
+            yield event
+        return
+
+    events: list[ChatResponseEvent] = []
+    failed = False
+    sourced = False
+    async for event in stream:
+        events.append(event)
+        if event.event == StreamEvent.ERROR:
+            failed = True
+        elif event.event == StreamEvent.SEARCH_RESULTS and event.data.results:
+            sourced = True
+        elif event.event == StreamEvent.STREAM_END and not failed and sourced:
+            answer = tuple(events)
+            _answer_cache.set(answer_cache_key(request, mode), answer)
+            if SEMANTIC_CACHE_ENABLED:
+                _semantic_answer_cache.set(request.query, answer, answer_scope(request, mode))
+            metrics.increment("answer_cache.stored")
+        yield event
@@ -4,13 +4,15 @@ import asyncio
 import json
 import time
 import traceback
-from typing import AsyncGenerator
+from typing import AsyncGenerator, Optional
 
 from fastapi import APIRouter, Depends, Request
-from fastapi.encoders import jsonable_encoder
 from sse_starlette.sse import EventSourceResponse
 
+from admission import api_key_flow, api_key_weight
+from api_compat.keys import ApiKeyInfo
 from api_compat.middleware import verify_api_key
+from api_compat.rate_limit import RateLimitLease, charge_upstream_tokens, enforce_rate_limits
 from api_compat.schemas import (
     ChatCompletionRequest,
     ChatCompletionResponse,
@@ -18,6 +20,9 @@ from api_compat.schemas import (
     SearchResponse,
     SearchResultItem,
 )
+from profiling import maybe_profile
+from traffic import bind_request
+from usage import RequestUsage, metered
 from api_compat.transform import (
     openai_to_internal,
     internal_to_openai_stream,
@@ -25,8 +30,7 @@ from api_compat.transform import (
     apply_domain_filter,
 )
 from chat import apply_date_range_filter
-from chat import stream_qa_objects
-from agent_search import stream_pro_search_qa
+from routing import admit_routed_response
 from schemas import StreamEvent
 from search.search_service import perform_search
 
@@ -38,7 +42,7 @@ router = APIRouter(prefix="/v1", tags=["OpenAI Compatible"])
 async def chat_completions(
     completion_request: ChatCompletionRequest,
     request: Request,
-    api_key: str = Depends(verify_api_key),
+    rate_limit: RateLimitLease = Depends(enforce_rate_limits),
 ):
     """
     OpenAI-compatible chat completions endpoint.
@@ -48,6 +52,7 @@ async def chat_completions(
 
     Authentication: Bearer token via Authorization header
     """
+    api_key = rate_limit.key
     # Generate request metadata
     request_id = f"chatcmpl-{int(time.time() * 1000)}"
     created = int(time.time())
@@ -64,48 +69,53 @@ async def chat_completions(
         return await handle_streaming(
             internal_request=internal_request,
             request=request,
+            flow=api_key_flow(api_key),
+            weight=api_key_weight(api_key),
+            rate_limit=rate_limit,
             request_id=request_id,
             model=model,
             created=created,
             include_images=completion_request.return_images,
             include_related=completion_request.return_related_questions,
-            pro_search=completion_request.pro_search,
         )
     else:
         return await handle_non_streaming(
             internal_request=internal_request,
+            request=request,
+            flow=api_key_flow(api_key),
+            weight=api_key_weight(api_key),
+            rate_limit=rate_limit,
             request_id=request_id,
             model=model,
             created=created,
             include_images=completion_request.return_images,
             include_related=completion_request.return_related_questions,
-            pro_search=completion_request.pro_search,
         )
 
 
 async def handle_streaming(
     internal_request,
     request: Request,
+    flow: str,
+    weight: Optional[float],
+    rate_limit: RateLimitLease,
     request_id: str,
     model: str,
     created: int,
     include_images: bool,
     include_related: bool,
-    pro_search: bool,
 ) -> EventSourceResponse:
     """Handle streaming chat completion."""
+    # Get internal event stream (passing None for session and user, so LYZR_API_KEY
+    # from environment is used), simple or pro search as requested or routed by query complexity
+    ticket, routed = await admit_routed_response(internal_request, flow, weight)
 
     async def event_generator() -> AsyncGenerator[str, None]:
+        bind_request(request_id)
         try:
-            # Choose appropriate stream function
-            stream_fn = stream_pro_search_qa if pro_search else stream_qa_objects
-
-            # Get internal event stream (passing None for session and user)
-            internal_stream = stream_fn(
-                request=internal_request,
-                session=None,
-                user=None  # Will use LYZR_API_KEY from environment
-            )
+            internal_stream = maybe_profile(routed, request_id, request.headers)
+            # The tokens of every agent call count against the key's daily budget
+            internal_stream = charge_upstream_tokens(internal_stream, rate_limit)
 
             # Transform to OpenAI format and yield
             async for sse_data in internal_to_openai_stream(
@@ -133,73 +143,74 @@ async def handle_streaming(
             yield f"data: {json.dumps(error_response)}\n\n"
             yield "data: [DONE]\n\n"
             print(f"Error in streaming endpoint: {traceback.format_exc()}")
+        finally:
+            ticket.release()
 
-    return EventSourceResponse(event_generator(), media_type="text/event-stream")
+    return EventSourceResponse(
+        ticket.guard(event_generator()), media_type="text/event-stream", headers=rate_limit.headers
+    )
 
 
 async def handle_non_streaming(
     internal_request,
+    request: Request,
+    flow: str,
+    weight: Optional[float],
+    rate_limit: RateLimitLease,
     request_id: str,
     model: str,
     created: int,
     include_images: bool,
     include_related: bool,
-    pro_search: bool,
 ) -> ChatCompletionResponse:
     """Handle non-streaming chat completion."""
+    bind_request(request_id)
+    ticket, routed = await admit_routed_response(internal_request, flow, weight)
     try:
-        # Choose appropriate stream function
-        stream_fn = stream_pro_search_qa if pro_search else stream_qa_objects
-
         # Collect all events from internal stream
-        full_message = ""
+        # Text chunks are joined once at the end, instead of copying the answer for every delta
+        message_chunks = []
         search_results = []
         related_questions = []
         images = []
 
-        async for event_data in stream_fn(
-            request=internal_request,
-            session=None,
-            user=None  # Will use LYZR_API_KEY from environment
-        ):
-            # event_data is ChatResponseEvent
-            event_dict = jsonable_encoder(event_data)
-            event_type = event_dict.get("event")
-            data = event_dict.get("data", {})
+        usage = RequestUsage()
+        internal_stream = metered(maybe_profile(routed, request_id, request.headers), usage)
+
+        async for event_data in internal_stream:
+            # event_data is ChatResponseEvent, read as is rather than re-encoded
+            event_type = event_data.event
+            data = event_data.data
 
             if event_type == StreamEvent.TEXT_CHUNK:
-                full_message += data.get("text", "")
+                message_chunks.append(data.text)
 
             elif event_type == StreamEvent.SEARCH_RESULTS:
-                from schemas import SearchResult
-                results = data.get("results", [])
-                # Convert dicts back to SearchResult objects
-                search_results = [
-                    SearchResult(**r) if isinstance(r, dict) else r
-                    for r in results
-                ]
+                search_results = list(data.results)
                 if include_images:
-                    images = data.get("images", [])
+                    images = list(data.images)
 
             elif event_type == StreamEvent.RELATED_QUERIES:
                 if include_related:
-                    related_questions = data.get("related_queries", [])
+                    related_questions = list(data.related_queries)
 
             elif event_type == StreamEvent.STREAM_END:
                 break
 
         # Transform to OpenAI format
         response = internal_to_openai_complete(
-            message=full_message,
+            message="".join(message_chunks),
             request_id=request_id,
             model=model,
             created=created,
+            usage=usage,
             search_results=search_results if search_results else None,
             related_questions=related_questions if related_questions else None,
             images=images if images else None,
             include_images=include_images,
             include_related=include_related,
         )
+        await rate_limit.charge(usage.total_tokens)
 
         return response
 
@@ -212,10 +223,12 @@ async def handle_non_streaming(
                 "code": 500
             }
         }
+    finally:
+        ticket.release()
 
 
 @router.get("/models")
-async def list_models(api_key: str = Depends(verify_api_key)):
+async def list_models(api_key: ApiKeyInfo = Depends(verify_api_key)):
     """
     List available models (OpenAI-compatible endpoint).
 
@@ -238,7 +251,7 @@ async def list_models(api_key: str = Depends(verify_api_key)):
 @router.post("/search")
 async def search(
     search_request: SearchRequest,
-    api_key: str = Depends(verify_api_key),
+    rate_limit: RateLimitLease = Depends(enforce_rate_limits),
 ) -> SearchResponse:
     """
     Perplexity-compatible search endpoint.
@@ -0,0 +1,165 @@
+"""
+API key store of the compatible endpoints.
+
+Keys are loaded once from API_KEYS (comma-separated) and from the JSON file
+named by API_KEYS_FILE, and kept as SHA-256 digests only. A presented key is
+hashed, looked up by digest and compared with ``hmac.compare_digest``, so
+verification takes the same time whatever the key and the number of keys.
+
+The file is reloaded without a restart when its modification time changes
+(checked at most every API_KEYS_RELOAD_INTERVAL seconds) or on the first
+lookup after a SIGHUP. A reload that fails keeps the keys already loaded.
+
+Every key carries an ``ApiKeyInfo``: a name for logs and metrics, and the
+priority class, queue weight, concurrency limit and quotas that the rest of
+the serving layer applies to it. The file looks like::
+
+    {
+      "keys": [
+        {"key": "sk-...", "name": "search-ui", "priority": "interactive"},
+        {"sha256": "9f86d0...", "name": "nightly-batch", "max_concurrency": 4,
+         "requests_per_minute": 60, "daily_tokens": 2000000}
+      ]
+    }
+
+Entries give either the key itself or the hex SHA-256 of it, so the file
+needn't hold the secrets.
+"""
+
+import hashlib
+import hmac
+import json
+import os
+import signal
+import threading
+import time
+from enum import Enum
+from typing import Dict, List, Optional
+
+from pydantic import BaseModel, Field, ValidationError
+
+API_KEYS_FILE = os.getenv("API_KEYS_FILE")
+API_KEYS_RELOAD_INTERVAL = float(os.getenv("API_KEYS_RELOAD_INTERVAL", "5"))
+
+
+class KeyPriority(str, Enum):
+    """Whether a key's traffic has a user waiting on it"""
+    INTERACTIVE = "interactive"
+    BATCH = "batch"
+
+
+class ApiKeyInfo(BaseModel):
+    """A configured API key, without the key itself"""
+    name: str
+    digest: str = Field(repr=False)
+    priority: KeyPriority = KeyPriority.BATCH
+    # Share of queued pipeline slots; None for the default of the priority class
+    weight: Optional[float] = Field(default=None, gt=0)
+    max_concurrency: Optional[int] = Field(default=None, ge=1)
+    requests_per_minute: Optional[int] = Field(default=None, ge=1)
+    daily_tokens: Optional[int] = Field(default=None, ge=1)
+
+
+def key_digest(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def parse_key_entries(entries: List[dict]) -> Dict[str, ApiKeyInfo]:
+    """Key infos by digest from the entries of a keys file."""
+    keys = {}
+    for entry in entries:
+        entry = dict(entry)
+        key = entry.pop("key", None)
+        digest = (entry.pop("sha256", None) or (key_digest(key) if key else "")).lower()
+        if not digest:
+            raise ValueError("every key entry needs a key or a sha256")
+        entry.setdefault("name", digest[:12])
+        keys[digest] = ApiKeyInfo(digest=digest, **entry)
+    return keys
+
+
+class KeyStore:
+    """The configured keys by digest, reloaded when the keys file changes."""
+
+    def __init__(self, env_keys: str = "", path: Optional[str] = None):
+        self.env_keys = env_keys
+        self.path = path
+        self._keys: Dict[str, ApiKeyInfo] = {}
+        self._mtime: Optional[float] = None
+        self._checked = 0.0
+        self._reload_pending = False
+        self._lock = threading.Lock()
+        self.reload()
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def reload(self) -> None:
+        """Load the keys again from the environment and the keys file."""
+        keys = parse_key_entries([{"key": key.strip()} for key in self.env_keys.split(",") if key.strip()])
+        mtime = None
+        if self.path:
+            try:
+                mtime = os.path.getmtime(self.path)
+                with open(self.path) as f:
+                    keys.update(parse_key_entries(json.load(f).get("keys", [])))
+            except (OSError, ValueError, ValidationError) as e:
+                print(f"Could not load API keys from {self.path}, keeping the current keys: {e}")
+                # Not tried again until the file changes
+                self._mtime = mtime
+                return
+        with self._lock:
+            # Replaced in one assignment, so lookups never see a partial store
+            self._keys = keys
+            self._mtime = mtime
+        print(f"🔑 Loaded {len(keys)} API keys")
+
+    def request_reload(self) -> None:
+        """Reload the keys on the next lookup; safe to call from a signal handler."""
+        self._reload_pending = True
+
+    def refresh(self) -> None:
+        """Reload the keys if a reload was requested or the keys file changed since it was loaded."""
+        if self._reload_pending:
+            self._reload_pending = False
+            self.reload()
+            return
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked < API_KEYS_RELOAD_INTERVAL:
+            return
+        self._checked = now
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def lookup(self, key: str) -> Optional[ApiKeyInfo]:
+        """The info of ``key``, or None if it isn't configured."""
+        self.refresh()
+        digest = key_digest(key)
+        info = self._keys.get(digest)
+        if info is None or not hmac.compare_digest(info.digest, digest):
+            return None
+        return info
+
+
+key_store = KeyStore(os.getenv("API_KEYS", ""), API_KEYS_FILE)
+
+
+def install_reload_signal() -> None:
+    """
+    Reload the keys on SIGHUP.
+
+    The handler only flags the reload: it runs between any two bytecodes of
+    the main thread, possibly inside ``reload`` itself, so it mustn't take the
+    store's lock.
+    """
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: key_store.request_reload())
+    except (AttributeError, ValueError):
+        # No SIGHUP on this platform, or not the main thread
+        pass
@@ -1,10 +1,11 @@
 """Authentication middleware for API compatibility layer."""
 
-import os
 from fastapi import Header, HTTPException, status
 
+from api_compat.keys import ApiKeyInfo, key_store
 
-async def verify_api_key(authorization: str = Header(None)):
+
+async def verify_api_key(authorization: str = Header(None)) -> ApiKeyInfo:
     """
     Verify Bearer token from Authorization header.
 
@@ -12,7 +13,7 @@ async def verify_api_key(authorization: str = Header(None)):
         authorization: Authorization header value (should be "Bearer <token>")
 
     Returns:
-        The validated token string
+        The info of the validated key: its name, priority class and limits
 
     Raises:
         HTTPException: If authentication fails
@@ -43,24 +44,21 @@ async def verify_api_key(authorization: str = Header(None)):
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    # Get valid API keys from environment
-    api_keys_str = os.getenv("API_KEYS", "")
-
-    if not api_keys_str:
+    # Keys from API_KEYS and API_KEYS_FILE, loaded once and reloaded when the file changes
+    key_store.refresh()
+    if not len(key_store):
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
             detail="API keys not configured on server",
         )
 
-    # Support comma-separated list of API keys
-    valid_keys = [k.strip() for k in api_keys_str.split(",") if k.strip()]
-
-    # Verify token
-    if token not in valid_keys:
+    # Verify token, by digest and in constant time
+    key_info = key_store.lookup(token)
+    if key_info is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid API key",
             headers={"WWW-Authenticate": "Bearer"},
         )
 
-    return token
+    return key_info
@@ -0,0 +1,288 @@
+"""
+Per-key rate limits of the compatible endpoints.
+
+Every API key gets three limits, from its entry in API_KEYS_FILE or else the
+RATE_LIMIT_* defaults (0 for none):
+
+- requests per minute, as a token bucket holding up to a minute's requests
+  and refilled continuously, so short bursts pass and sustained floods don't
+- concurrent requests, counted until the response has been sent
+- upstream tokens per UTC day, charged once a completion is done: the
+  estimated prompt and completion tokens of every agent call it made, as
+  reported in its ``usage``
+
+Requests over a limit get 429 with Retry-After. All responses carry the
+``x-ratelimit-*`` headers of the OpenAI API, which clients of the compatible
+API already understand.
+
+The state lives in memory, per worker, unless RATE_LIMIT_STATE_FILE names a
+file shared by all the uvicorn workers of the host (a path under /dev/shm
+keeps it in shared memory). It is then read and written under an exclusive
+``flock``, and requests in flight are counted per process, so the counts of
+a worker that died are dropped. Waiting for that lock and the file I/O block,
+so they run in the default thread pool rather than on the event loop.
+"""
+
+import asyncio
+import json
+import math
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+from fastapi import Depends, HTTPException, Response, status
+
+from api_compat.keys import ApiKeyInfo
+from api_compat.middleware import verify_api_key
+from metrics import metrics
+from schemas import ChatResponseEvent
+from usage import RequestUsage, metered
+from utils import strtobool
+
+# Import fcntl only on Unix systems
+if sys.platform != "win32":
+    import fcntl
+
+RATE_LIMIT_ENABLED = strtobool(os.getenv("RATE_LIMIT_ENABLED", "true"))
+RATE_LIMIT_REQUESTS_PER_MINUTE = int(os.getenv("RATE_LIMIT_REQUESTS_PER_MINUTE", "0"))
+RATE_LIMIT_MAX_CONCURRENCY = int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY", "0"))
+RATE_LIMIT_DAILY_TOKENS = int(os.getenv("RATE_LIMIT_DAILY_TOKENS", "0"))
+RATE_LIMIT_STATE_FILE = os.getenv("RATE_LIMIT_STATE_FILE")
+
+metrics.register_rate("rate_limit.rejection_rate", "rate_limit.rejected", "rate_limit.requests")
+
+State = Dict[str, Dict[str, Any]]
+
+
+class MemoryBackend:
+    """Rate limit state of this worker only."""
+
+    blocking = False
+
+    def __init__(self):
+        self._state: State = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def transaction(self) -> Iterator[State]:
+        with self._lock:
+            yield self._state
+
+
+class FileBackend:
+    """Rate limit state shared through a JSON file locked for every change."""
+
+    blocking = True
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @contextmanager
+    def transaction(self) -> Iterator[State]:
+        """The state, written back unless the block raises."""
+        with open(self.path, "a+") as f:
+            if sys.platform != "win32":
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = json.loads(f.read() or "{}")
+                except ValueError:
+                    print(f"Resetting unreadable rate limit state in {self.path}")
+                    state = {}
+                yield state
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                f.flush()
+            finally:
+                if sys.platform != "win32":
+                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _process_alive(pid: str) -> bool:
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, ValueError):
+        pass
+    return True
+
+
+def _seconds_to_midnight(now: datetime) -> int:
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return math.ceil((midnight - now).total_seconds())
+
+
+class RateLimitLease:
+    """One admitted request of a key, holding a concurrency slot until released."""
+
+    def __init__(self, limiter: Optional["RateLimiter"], key: ApiKeyInfo, headers: Dict[str, str]):
+        self.limiter = limiter
+        self.key = key
+        self.headers = headers
+        self._released = False
+
+    async def charge(self, tokens: int) -> None:
+        """Count ``tokens`` upstream tokens against the key's daily budget."""
+        if self.limiter is not None:
+            await self.limiter.charge(self.key, tokens)
+
+    async def release(self) -> None:
+        if self.limiter is not None and not self._released:
+            self._released = True
+            await self.limiter.release(self.key)
+
+
+class RateLimiter:
+    """Requests per minute, concurrency and daily token limits of the API keys."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @property
+    def pid(self) -> str:
+        return str(os.getpid())
+
+    @staticmethod
+    def limits(key: ApiKeyInfo) -> tuple:
+        return (
+            key.requests_per_minute or RATE_LIMIT_REQUESTS_PER_MINUTE,
+            key.max_concurrency or RATE_LIMIT_MAX_CONCURRENCY,
+            key.daily_tokens or RATE_LIMIT_DAILY_TOKENS,
+        )
+
+    async def _run(self, func: Callable, *args) -> Any:
+        """Call ``func``, in the default thread pool if the backend blocks."""
+        if not self.backend.blocking:
+            return func(*args)
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def acquire(self, key: ApiKeyInfo) -> RateLimitLease:
+        """
+        Admit one request of ``key``.
+
+        Raises:
+            HTTPException: 429 with Retry-After when a limit is reached
+        """
+        return await self._run(self._acquire, key)
+
+    async def release(self, key: ApiKeyInfo) -> None:
+        await self._run(self._release, key)
+
+    async def charge(self, key: ApiKeyInfo, tokens: int) -> None:
+        await self._run(self._charge, key, tokens)
+
+    def _acquire(self, key: ApiKeyInfo) -> RateLimitLease:
+        metrics.increment("rate_limit.requests")
+        requests_per_minute, max_concurrency, daily_tokens = self.limits(key)
+        now = time.time()
+        today = datetime.now(timezone.utc)
+
+        with self.backend.transaction() as state:
+            entry = state.setdefault(key.name, {})
+            if entry.get("day") != today.date().isoformat():
+                entry["day"] = today.date().isoformat()
+                entry["used_tokens"] = 0
+            in_flight = {
+                pid: count for pid, count in entry.get("in_flight", {}).items()
+                if count > 0 and _process_alive(pid)
+            }
+            entry["in_flight"] = in_flight
+
+            headers: Dict[str, str] = {}
+            if requests_per_minute:
+                refill = (now - entry.get("updated", now)) * requests_per_minute / 60
+                tokens = min(requests_per_minute, entry.get("tokens", requests_per_minute) + refill)
+                # What the bucket holds once this request is counted, if it is admitted
+                remaining = tokens - 1 if tokens >= 1 else tokens
+                headers["x-ratelimit-limit-requests"] = str(requests_per_minute)
+                headers["x-ratelimit-remaining-requests"] = str(int(remaining))
+                headers["x-ratelimit-reset-requests"] = (
+                    f"{math.ceil((requests_per_minute - remaining) * 60 / requests_per_minute)}s"
+                )
+                if tokens < 1:
+                    raise self._reject(
+                        key, "requests per minute", math.ceil((1 - tokens) * 60 / requests_per_minute), headers
+                    )
+            if daily_tokens:
+                remaining_tokens = max(daily_tokens - entry["used_tokens"], 0)
+                headers["x-ratelimit-limit-tokens"] = str(daily_tokens)
+                headers["x-ratelimit-remaining-tokens"] = str(remaining_tokens)
+                headers["x-ratelimit-reset-tokens"] = f"{_seconds_to_midnight(today)}s"
+                if not remaining_tokens:
+                    raise self._reject(key, "daily token budget", _seconds_to_midnight(today), headers)
+            if max_concurrency and sum(in_flight.values()) >= max_concurrency:
+                raise self._reject(key, "concurrent requests", 1, headers)
+
+            if requests_per_minute:
+                entry["tokens"] = tokens - 1
+                entry["updated"] = now
+            in_flight[self.pid] = in_flight.get(self.pid, 0) + 1
+
+        return RateLimitLease(self, key, headers)
+
+    def _release(self, key: ApiKeyInfo) -> None:
+        with self.backend.transaction() as state:
+            in_flight = state.get(key.name, {}).get("in_flight", {})
+            if in_flight.get(self.pid, 0) > 0:
+                in_flight[self.pid] -= 1
+
+    def _charge(self, key: ApiKeyInfo, tokens: int) -> None:
+        with self.backend.transaction() as state:
+            entry = state.setdefault(key.name, {})
+            entry["used_tokens"] = entry.get("used_tokens", 0) + tokens
+        metrics.increment("rate_limit.charged_tokens", tokens)
+
+    def _reject(self, key: ApiKeyInfo, limit: str, retry_after: int, headers: Dict[str, str]) -> HTTPException:
+        metrics.increment("rate_limit.rejected")
+        print(f"⛔ API key '{key.name}' is over its {limit} limit")
+        return HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail=f"Rate limit reached: {limit}. Retry in {retry_after} seconds.",
+            headers={**headers, "Retry-After": str(max(retry_after, 1))},
+        )
+
+
+rate_limiter = RateLimiter(FileBackend(RATE_LIMIT_STATE_FILE) if RATE_LIMIT_STATE_FILE else MemoryBackend())
+
+
+async def enforce_rate_limits(
+    response: Response,
+    api_key: ApiKeyInfo = Depends(verify_api_key),
+) -> AsyncIterator[RateLimitLease]:
+    """
+    Admit the request under its key's limits and add the rate limit headers.
+
+    The concurrency slot is held until the response, streamed or not, has been
+    sent: FastAPI closes dependencies with yield after the response.
+
+    Raises:
+        HTTPException: 429 with Retry-After when a limit is reached
+    """
+    if not RATE_LIMIT_ENABLED:
+        yield RateLimitLease(None, api_key, {})
+        return
+    lease = await rate_limiter.acquire(api_key)
+    response.headers.update(lease.headers)
+    try:
+        yield lease
+    finally:
+        await lease.release()
+
+
+async def charge_upstream_tokens(
+    stream: AsyncIterator[ChatResponseEvent], rate_limit: RateLimitLease
+) -> AsyncIterator[ChatResponseEvent]:
+    """Pass ``stream`` through, charging the estimated tokens of its agent calls when it ends."""
+    usage = RequestUsage()
+    try:
+        async for event in metered(stream, usage):
+            yield event
+    finally:
+        await rate_limit.charge(usage.total_tokens)
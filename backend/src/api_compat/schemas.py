@@ -56,6 +56,10 @@ class ChatCompletionRequest(BaseModel):
         default=False,
         description="Enable multi-step reasoning (Perplexity OSS extension)"
     )
+    search_mode: Optional[Literal["simple", "pro", "auto"]] = Field(
+        default=None,
+        description="simple, pro or auto (routed by query complexity); overrides pro_search when set (Perplexity OSS extension)"
+    )
     max_results: int = Field(
         default=10,
         ge=1,
@@ -5,6 +5,7 @@ from typing import AsyncGenerator, Dict, List, Optional
 
 from schemas import (
     ChatRequest,
+    FinalResponseMode,
     Message as InternalMessage,
     MessageRole as InternalRole,
     SearchResult,
@@ -27,6 +28,7 @@ from api_compat.schemas import (
     MessageRole,
     SearchResultCompat,
 )
+from usage import RequestUsage
 
 
 def apply_domain_filter(query: str, domains: List[str]) -> str:
@@ -76,10 +78,14 @@ def openai_to_internal(
         session_id=request.session_id,  # Pass through session_id
         query=query,
         pro_search=request.pro_search,
+        search_mode=request.search_mode,
         time_range=request.search_recency_filter,
         max_results=request.max_results,
         start_date=request.start_date,  # Pass through custom date range
-        end_date=request.end_date
+        end_date=request.end_date,
+        # The compatible responses are built from the text chunks alone
+        final_response=FinalResponseMode.OMIT,
+        related_queries=request.return_related_questions,
     )
 
 
@@ -109,7 +115,6 @@ async def internal_to_openai_stream(
     search_results = []
     related_questions = []
     images = []
-    full_message = ""
 
     # Send initial chunk with role
     initial_chunk = ChatCompletionChunk(
@@ -138,7 +143,6 @@ async def internal_to_openai_stream(
         if event_type == StreamEvent.TEXT_CHUNK:
             # Stream text content
             text = data.get("text", "")
-            full_message += text
 
             chunk = ChatCompletionChunk(
                 id=request_id,
@@ -194,11 +198,21 @@ async def internal_to_openai_stream(
     # They could be sent as custom events or in a final summary chunk if needed.
 
 
+def estimate_usage(usage: RequestUsage) -> UsageInfo:
+    """Token usage of a completion: the estimated tokens of every upstream call it made."""
+    return UsageInfo(
+        prompt_tokens=usage.prompt_tokens,
+        completion_tokens=usage.completion_tokens,
+        total_tokens=usage.total_tokens
+    )
+
+
 def internal_to_openai_complete(
     message: str,
     request_id: str,
     model: str,
     created: int,
+    usage: RequestUsage,
     search_results: Optional[List[SearchResult]] = None,
     related_questions: Optional[List[str]] = None,
     images: Optional[List[str]] = None,
@@ -213,6 +227,7 @@ def internal_to_openai_complete(
         request_id: Unique request ID
         model: Model name
         created: Timestamp
+        usage: Upstream token usage of the request
         search_results: Optional search results
         related_questions: Optional related questions
         images: Optional image URLs
@@ -222,16 +237,6 @@ def internal_to_openai_complete(
     Returns:
         OpenAI-compatible ChatCompletionResponse
     """
-    # Estimate token usage (rough approximation)
-    prompt_tokens = 100  # Placeholder
-    completion_tokens = len(message.split()) * 2  # Rough estimate
-
-    usage = UsageInfo(
-        prompt_tokens=prompt_tokens,
-        completion_tokens=completion_tokens,
-        total_tokens=prompt_tokens + completion_tokens
-    )
-
     # Convert search results to compat format
     compat_results = None
     if search_results:
@@ -258,7 +263,7 @@ def internal_to_openai_complete(
                 finish_reason="stop"
             )
         ],
-        usage=usage,
+        usage=estimate_usage(usage),
         search_results=compat_results,
         related_questions=related_questions if include_related else None,
         images=images if include_images else None
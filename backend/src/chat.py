@@ -1,13 +1,19 @@
 """Chat functionality using Lyzr Agents for AI-powered search and response."""
 
 import asyncio
+import os
 from typing import AsyncIterator, List, Optional
 
 from fastapi import HTTPException
 
 from auth import AuthenticatedUser
+from context_packing import cited_result_formatter, pack_search_results
+from llm.agent_config import ANSWER_CONTEXT_TOKEN_BUDGET
 from llm.lyzr_agent import LyzrSpecializedAgents
-from prompts import CHAT_PROMPT, SEARCH_TERM_EXTRACTION_PROMPT
+from metrics import metrics
+from passages import select_relevant_results
+from prompts import CHAT_PROMPT, QUERY_UNDERSTANDING_PROMPT
+from query_analyzer import analyze_query, normalize_query, term_overlap
 from related_queries import generate_related_queries
 from schemas import (
     BeginStream,
@@ -15,14 +21,26 @@ from schemas import (
     ChatResponseEvent,
     FinalResponseStream,
     Message,
+    QueryUnderstanding,
     RelatedQueriesStream,
+    SearchResponse,
     SearchResult,
     SearchResultStream,
     StreamEndStream,
     StreamEvent,
     TextChunkStream,
 )
+from search.enrichment import enrich_search_results
 from search.search_service import perform_search
+from utils import strtobool
+
+SPECULATIVE_SEARCH_ENABLED = strtobool(os.getenv("SPECULATIVE_SEARCH_ENABLED", "true"))
+SPECULATIVE_SEARCH_MIN_OVERLAP = float(os.getenv("SPECULATIVE_SEARCH_MIN_OVERLAP", "0.6"))
+
+metrics.register_rate("speculative_search.hit_rate", "speculative_search.hits", "speculative_search.started")
+
+# First questions being shown to the query rephrase agent, kept until done
+_remembering: set[asyncio.Task] = set()
 
 
 def apply_date_range_filter(query: str, start_date: str = None, end_date: str = None) -> str:
@@ -52,33 +70,105 @@ def apply_date_range_filter(query: str, start_date: str = None, end_date: str =
     return modified_query
 
 
-def extract_search_terms(query: str, specialized_agents: LyzrSpecializedAgents, session_id: str = None, user_id: str = None) -> str:
+def fast_path_understanding(question: str) -> Optional[QueryUnderstanding]:
+    """Understand a first question locally when it is already a short keyword query."""
+    analysis = analyze_query(question)
+    if not analysis.search_ready:
+        return None
+    print(f"Query is search-ready, skipping agent. Search terms: {analysis.search_terms}")
+    return QueryUnderstanding(standalone_question=question, search_terms=analysis.search_terms)
+
+
+def remember_first_question(
+    question: str, session_id: str, specialized_agents: LyzrSpecializedAgents, user_id: str = None
+) -> None:
     """
-    Extract the core search terms from a query using an agent.
-    The agent understands what information to search for while ignoring output format instructions.
+    Show a first question understood locally to the query rephrase agent, in the background.
+
+    The agent's MEMORY is what resolves "it" or "their" in the follow-ups, so
+    it must see the conversation's first question even when the fast path
+    made it unnecessary for understanding that question.
+    """
+    metrics.increment("query_analyzer.remembered")
+    task = asyncio.create_task(
+        understand_query(
+            question, session_id, specialized_agents, user_id, is_follow_up=False, allow_fast_path=False
+        )
+    )
+    _remembering.add(task)
+    task.add_done_callback(_remembering.discard)
+
+
+async def understand_query(
+    question: str,
+    session_id: str,
+    specialized_agents: LyzrSpecializedAgents,
+    user_id: str = None,
+    is_follow_up: bool = True,
+    allow_fast_path: bool = True,
+) -> QueryUnderstanding:
     """
+    Rephrase a query into a standalone question and extract its search terms in one agent call.
+
+    The query rephrase agent has MEMORY enabled, so it can access conversation history
+    to understand contextual references like "it", "that", "their", etc. It returns both
+    outputs as one structured response, so follow-ups pay a single upstream round trip.
+    First questions of a conversation keep their original wording, and when they are
+    already short keyword queries they are understood without waiting for the agent
+    (which still sees them, for the follow-ups).
+    """
+    if not is_follow_up and allow_fast_path:
+        understanding = fast_path_understanding(question)
+        if understanding is not None:
+            if session_id:
+                remember_first_question(question, session_id, specialized_agents, user_id)
+            return understanding
+
     try:
         from datetime import datetime
-        agent = specialized_agents.get_query_rephrase_agent()  # Reuse this agent for extraction
+        agent = specialized_agents.get_query_rephrase_agent()
+        print(f"Using query rephrase agent for standalone question and search terms")
+
         # Format the prompt with the actual query (system_prompt_variables only work in agent instructions, not messages)
         now = datetime.now()
         current_datetime = now.strftime("%A, %B %d, %Y %I:%M %p")
-        formatted_prompt = (SEARCH_TERM_EXTRACTION_PROMPT
-                           .replace("{{ user_query }}", query)
+        formatted_prompt = (QUERY_UNDERSTANDING_PROMPT
+                           .replace("{{ user_query }}", question)
                            .replace("{{ current_datetime }}", current_datetime))
-        print(f"Using agent to extract search terms from query")
-        search_terms = agent.complete(
-            formatted_prompt,
+
+        understanding = await agent.astructured_complete(
+            response_model=QueryUnderstanding,
+            prompt=formatted_prompt,
             session_id=session_id,
             user_id=user_id
-        ).text.strip().replace('"', '')
-        return search_terms if search_terms else query
+        )
+
+        standalone_question = understanding.standalone_question.strip() if is_follow_up else question
+        search_terms = understanding.search_terms.strip().replace('"', '')
+
+        print(f"Original: {question}")
+        print(f"Standalone: {standalone_question}")
+        print(f"Search terms: {search_terms}")
+        return QueryUnderstanding(
+            standalone_question=standalone_question or question,
+            search_terms=search_terms or standalone_question or question,
+        )
     except Exception as e:
-        print(f"Error in search term extraction, using original query: {e}")
-        return query
+        print(f"Error in query understanding, using original query: {e}")
+        # Don't fail completely - just use original query
+        return QueryUnderstanding(standalone_question=question, search_terms=question)
+
+
+async def extract_search_terms(query: str, specialized_agents: LyzrSpecializedAgents, session_id: str = None, user_id: str = None) -> str:
+    """
+    Extract the core search terms from a query using an agent.
+    The agent understands what information to search for while ignoring output format instructions.
+    """
+    understanding = await understand_query(query, session_id, specialized_agents, user_id, is_follow_up=False)
+    return understanding.search_terms
 
 
-def rephrase_query_with_context(
+async def rephrase_query_with_context(
     question: str, session_id: str, specialized_agents: LyzrSpecializedAgents, user_id: str = None
 ) -> str:
     """
@@ -87,41 +177,100 @@ def rephrase_query_with_context(
     The query rephrase agent has MEMORY enabled, so it can access conversation history
     to understand contextual references like "it", "that", "their", etc.
     """
+    understanding = await understand_query(question, session_id, specialized_agents, user_id)
+    return understanding.standalone_question
+
+
+def start_speculative_search(request: ChatRequest) -> Optional[asyncio.Task]:
+    """
+    Search the raw query while the query rephrase agent is still working.
+
+    Most queries' search terms end up close to the query itself, so the
+    SearXNG round trip can overlap with the agent call instead of following it.
+    """
+    if not SPECULATIVE_SEARCH_ENABLED:
+        return None
+    metrics.increment("speculative_search.started")
+    search_query = apply_date_range_filter(
+        request.query, start_date=request.start_date, end_date=request.end_date
+    )
+    return asyncio.create_task(
+        perform_search(search_query, time_range=request.time_range, num_results=request.max_results)
+    )
+
+
+async def discard_speculative_search(task: asyncio.Task) -> None:
+    task.cancel()
     try:
-        # Use dedicated query rephrase agent (has MEMORY enabled for context)
-        agent = specialized_agents.get_query_rephrase_agent()
-        print(f"Using query rephrase agent with conversation context")
+        await task
+    except BaseException:
+        pass
 
-        # The query rephrase agent has conversation memory and knows how to handle contextual queries
-        # Just pass the query directly - the agent's instructions handle the rest
-        rephrased = agent.complete(question, session_id=session_id, user_id=user_id).text.strip()
 
-        # Clean up common prefixes
-        rephrased = rephrased.replace('"', '').replace("'", '')
-        for prefix in ['Rephrased query:', 'Rephrased Query:', 'Rephrased question:', 'Rephrased Question:', 'The rephrased question is:', 'Here is the rephrased question:']:
-            if rephrased.startswith(prefix):
-                rephrased = rephrased[len(prefix):].strip()
+async def resolve_speculative_search(
+    task: Optional[asyncio.Task], raw_query: str, search_terms: str
+) -> Optional[SearchResponse]:
+    """
+    Return the speculative search results if they are usable for ``search_terms``.
 
-        print(f"Original: {question}")
-        print(f"Rephrased: {rephrased}")
-        return rephrased if rephrased else question
+    The results are kept when the extracted terms normalize to the raw query or
+    share at least SPECULATIVE_SEARCH_MIN_OVERLAP of their terms with it, and
+    discarded (returning None) otherwise or when the speculative search failed.
+    """
+    if task is None:
+        return None
+
+    exact = normalize_query(raw_query) == normalize_query(search_terms)
+    overlap = 1.0 if exact else term_overlap(raw_query, search_terms)
+    metrics.increment(f"speculative_search.overlap.{min(int(overlap * 10), 9) / 10:.1f}")
+
+    if overlap < SPECULATIVE_SEARCH_MIN_OVERLAP:
+        metrics.increment("speculative_search.misses")
+        print(f"🎲 Speculative search discarded (overlap {overlap:.2f})")
+        await discard_speculative_search(task)
+        return None
+
+    try:
+        search_response = await task
     except Exception as e:
-        print(f"Error in query rephrasing: {e}")
-        # Don't fail completely - just use original query
-        return question
+        metrics.increment("speculative_search.errors")
+        print(f"🎲 Speculative search failed, searching again: {e}")
+        return None
 
+    metrics.increment("speculative_search.hits")
+    print(f"🎲 Speculative search used ({'exact' if exact else f'overlap {overlap:.2f}'})")
+    return search_response
 
-def format_context(search_results: List[SearchResult]) -> str:
-    """Format search results into a context string for the LLM."""
-    return "\n\n".join(
-        [f"Citation {i+1}. {str(result)}" for i, result in enumerate(search_results)]
-    )
+
+def format_context(
+    search_results: List[SearchResult],
+    token_budget: int = ANSWER_CONTEXT_TOKEN_BUDGET,
+    citations: Optional[List[int]] = None,
+) -> str:
+    """Format search results into a token-budgeted context string for the LLM."""
+    return pack_search_results(
+        search_results,
+        token_budget,
+        formatter=cited_result_formatter,
+        citations=citations,
+        label="answer context",
+    ).text
 
 
 async def stream_qa_objects(
-    request: ChatRequest, session: Optional[any] = None, user: Optional[AuthenticatedUser] = None
+    request: ChatRequest,
+    session: Optional[any] = None,
+    user: Optional[AuthenticatedUser] = None,
+    standalone_query: Optional[str] = None,
 ) -> AsyncIterator[ChatResponseEvent]:
-    """Stream chat responses using Lyzr agents for search and answer generation."""
+    """
+    Stream chat responses using Lyzr agents for search and answer generation.
+
+    ``standalone_query`` is the question already rephrased by the caller (pro
+    search falling back to this mode). It is then searched as is, so query
+    understanding is skipped and the pro search's broad search of the same
+    question is joined or read from the search cache instead of run again.
+    """
     try:
         # Initialize specialized agents with user credentials
         # Use LYZR_API_KEY from env with user.api_key fallback
@@ -142,14 +291,37 @@ async def stream_qa_objects(
         # Generate or use provided session_id
         session_id = request.session_id or str(uuid.uuid4())
 
-        # First, rephrase the query with conversation context if this is a follow-up
-        # Use dedicated query rephrase agent which has MEMORY enabled
-        query = request.query
-        if request.session_id:  # Only rephrase if we have an existing session (follow-up)
-            query = rephrase_query_with_context(request.query, session_id, specialized_agents, user_id)
-
-        # Extract search terms from the contextualized query using an agent
-        search_query = extract_search_terms(query, specialized_agents, session_id, user_id)
+        # Rephrase the query with conversation context (follow-ups only) and extract its
+        # search terms in a single call to the query rephrase agent, which has MEMORY enabled.
+        # Unless the query is already search-ready, the raw query is searched meanwhile.
+        is_follow_up = bool(request.session_id)
+        if standalone_query is not None:
+            understanding = QueryUnderstanding(standalone_question=standalone_query, search_terms=standalone_query)
+        else:
+            understanding = None if is_follow_up else fast_path_understanding(request.query)
+            if understanding is not None:
+                remember_first_question(request.query, session_id, specialized_agents, user_id)
+        speculative_search = None
+        if understanding is None:
+            speculative_search = start_speculative_search(request)
+            try:
+                understanding = await understand_query(
+                    request.query,
+                    session_id,
+                    specialized_agents,
+                    user_id,
+                    is_follow_up=is_follow_up,
+                    allow_fast_path=False,
+                )
+            except BaseException:
+                if speculative_search is not None:
+                    speculative_search.cancel()
+                raise
+        query = understanding.standalone_question
+        search_query = understanding.search_terms
+        search_response = await resolve_speculative_search(
+            speculative_search, request.query, search_query
+        )
 
         # Apply custom date range filters if provided
         search_query = apply_date_range_filter(
@@ -162,25 +334,32 @@ async def stream_qa_objects(
         print(f"Session ID: {session_id}")
         print(f"Search terms extracted: {search_query}")
 
-        search_response = await perform_search(
-            search_query,  # Use extracted search terms for SearXNG
-            time_range=request.time_range,
-            num_results=request.max_results
-        )
+        if search_response is None:
+            search_response = await perform_search(
+                search_query,  # Use extracted search terms for SearXNG
+                time_range=request.time_range,
+                num_results=request.max_results
+            )
 
         search_results = search_response.results
         images = search_response.images
 
-        # Only create the task first if the model is not local
+        # Optionally extend the top snippets with their pages' main text, then keep
+        # only the passages relevant to the question for the agents' prompts
+        context_results = await enrich_search_results(search_results)
+        context_results, citations = select_relevant_results(context_results, query)
+
+        # Related questions are generated alongside the answer, unless turned off under load
         related_queries_task = None
-        related_queries_task = asyncio.create_task(
-            generate_related_queries(
-                query,
-                search_results,
-                specialized_agents.get_related_questions_agent(),
-                session_id  # Pass session_id for context continuity
+        if request.related_queries:
+            related_queries_task = asyncio.create_task(
+                generate_related_queries(
+                    query,
+                    context_results,
+                    specialized_agents.get_related_questions_agent(),
+                    session_id  # Pass session_id for context continuity
+                )
             )
-        )
 
         yield ChatResponseEvent(
             event=StreamEvent.SEARCH_RESULTS,
@@ -210,12 +389,13 @@ async def stream_qa_objects(
                 query_with_context = f"{query} (searching for results up to {request.end_date})"
 
         system_prompt_vars = {
-            "search_context": format_context(search_results),
+            "search_context": format_context(context_results, citations=citations),
             "user_query": query_with_context,  # Include date range context
             "current_datetime": current_datetime
         }
 
-        full_response = ""
+        # Chunks are joined once at the end, instead of copying the answer for every delta
+        answer_chunks: list[str] = []
         # Don't send the query as the message - the agent instructions already include it
         # Send a simple instruction to trigger the answer generation
         response_gen = await answer_agent.astream(
@@ -224,21 +404,14 @@ async def stream_qa_objects(
             session_id=session_id,
             user_id=user_id
         )
-        print("Response gen", response_gen)
         async for completion in response_gen:
-            full_response += completion.delta or ""
+            answer_chunks.append(completion.delta or "")
             yield ChatResponseEvent(
                 event=StreamEvent.TEXT_CHUNK,
                 data=TextChunkStream(text=completion.delta or ""),
             )
 
-        related_queries = await (
-            related_queries_task
-            if related_queries_task
-            else generate_related_queries(
-                query, search_results, specialized_agents.get_related_questions_agent(), session_id
-            )
-        )
+        related_queries = await related_queries_task if related_queries_task else []
 
         yield ChatResponseEvent(
             event=StreamEvent.RELATED_QUERIES,
@@ -250,7 +423,7 @@ async def stream_qa_objects(
 
         yield ChatResponseEvent(
             event=StreamEvent.FINAL_RESPONSE,
-            data=FinalResponseStream(message=full_response),
+            data=FinalResponseStream(message="".join(answer_chunks)),
         )
 
         yield ChatResponseEvent(
@@ -0,0 +1,124 @@
+"""
+Coalescing of identical in-flight chat requests.
+
+When many clients ask the same first-turn question at once, only the first
+runs the pipeline. Its events are kept in a replay log that every identical
+request arriving before it ends subscribes to, so late joiners catch up on
+what was already streamed and then follow live. Requests carrying a
+session_id continue their own conversation and are never shared.
+
+Every client receives the same event objects, and ``encode_sse`` encodes an
+event only once, whatever the number of clients it is sent to. The agents'
+conversation belongs to the client that started the pipeline: joiners get a
+STREAM_END without a session_id, so their next turn starts a conversation of
+its own instead of landing in another client's.
+"""
+
+import asyncio
+import json
+import os
+from typing import AsyncIterator, Callable, Dict, List, Optional
+
+from fastapi.encoders import jsonable_encoder
+from sse_starlette.sse import ServerSentEvent
+
+from answer_cache import AnswerCacheKey, answer_cache_key, sessionless_stream_end
+from metrics import metrics
+from schemas import ChatRequest, ChatResponseEvent, SearchMode, StreamEvent
+from utils import strtobool
+
+REQUEST_COALESCING_ENABLED = strtobool(os.getenv("REQUEST_COALESCING_ENABLED", "true"))
+
+
+def encode_sse(event: ChatResponseEvent) -> bytes:
+    """The server-sent event bytes of ``event``, encoded on first use."""
+    if event._sse is None:
+        event._sse = ServerSentEvent(json.dumps(jsonable_encoder(event))).encode()
+    return event._sse
+
+
+class SharedStream:
+    """One running pipeline and the log of the events it has produced so far."""
+
+    def __init__(self, key: AnswerCacheKey, stream: AsyncIterator[ChatResponseEvent]):
+        self.key = key
+        self.events: List[ChatResponseEvent] = []
+        self.done = False
+        self.error: Optional[Exception] = None
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self._run(stream))
+
+    async def _run(self, stream: AsyncIterator[ChatResponseEvent]) -> None:
+        try:
+            async for event in stream:
+                self.events.append(event)
+                self._notify()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            if _in_flight.get(self.key) is self:
+                del _in_flight[self.key]
+
+    def _notify(self) -> None:
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    async def subscribe(self, owner: bool) -> AsyncIterator[ChatResponseEvent]:
+        """
+        Stream the log from its start, then the events as they are produced.
+
+        Raises the pipeline's error once the log is exhausted. The pipeline is
+        cancelled when its last subscriber goes away. A subscription only
+        counts once it is iterated, so one never started (its client gone
+        before streaming began) doesn't keep the pipeline alive.
+        """
+        index = 0
+        self.subscribers += 1
+        try:
+            while True:
+                while index < len(self.events):
+                    event = self.events[index]
+                    index += 1
+                    if event.event == StreamEvent.STREAM_END and not owner:
+                        event = sessionless_stream_end()
+                    yield event
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                print(f"🔗 All clients left, cancelling the pipeline for: {self.key[0]}")
+                self.task.cancel()
+
+
+_in_flight: Dict[AnswerCacheKey, SharedStream] = {}
+
+
+def coalesce(
+    request: ChatRequest,
+    mode: SearchMode,
+    start: Callable[[], AsyncIterator[ChatResponseEvent]],
+) -> AsyncIterator[ChatResponseEvent]:
+    """
+    Stream the answer to ``request`` from an identical in-flight pipeline, or
+    from the one ``start`` creates.
+    """
+    if not REQUEST_COALESCING_ENABLED or request.session_id or request.thread_id is not None:
+        return start()
+
+    key = answer_cache_key(request, mode)
+    shared = _in_flight.get(key)
+    owner = shared is None
+    if owner:
+        shared = _in_flight[key] = SharedStream(key, start())
+        metrics.increment("coalescing.pipelines")
+    else:
+        metrics.increment("coalescing.joined")
+        print(f"🔗 Joined the in-flight pipeline ({len(shared.events)} events so far) for: {request.query}")
+    return shared.subscribe(owner)
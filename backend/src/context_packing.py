@@ -0,0 +1,119 @@
+"""
+Token-budgeted packing of search results into agent prompts.
+
+Search results are added whole, in rank order, until the next one would
+exceed the token budget, so citations are never cut mid-record and prompt
+size (and with it upstream latency and cost) stays bounded.
+
+Token counts come from a fast local estimator rather than the model's real
+tokenizer: ASCII words are counted as one token per four characters
+(rounded up, so every word costs at least one), non-ASCII text as one token
+per character and punctuation as one token each. English averages about
+four characters per token including the spaces, which aren't counted here,
+so the estimate errs on the side of over-counting for English and CJK text.
+"""
+
+import re
+from typing import Callable, List, Optional
+
+from pydantic import BaseModel
+
+from schemas import SearchResult
+
+_TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+def _piece_tokens(piece: str) -> int:
+    if piece.isascii():
+        return (len(piece) + 3) // 4
+    return len(piece)
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimate how many model tokens ``text`` costs."""
+    return sum(_piece_tokens(piece) for piece in _TOKEN_RE.findall(text))
+
+
+def truncate_to_tokens(text: str, token_budget: int) -> str:
+    """Cut ``text`` at the last whole word/punctuation that fits in ``token_budget``."""
+    used = 0
+    end = 0
+    for match in _TOKEN_RE.finditer(text):
+        used += _piece_tokens(match.group())
+        if used > token_budget:
+            break
+        end = match.end()
+    return text[:end]
+
+
+class PackedContext(BaseModel):
+    text: str
+    tokens_used: int
+    token_budget: int
+    results_included: int
+    results_total: int
+
+
+def default_result_formatter(citation: int, result: SearchResult) -> str:
+    return str(result)
+
+
+def cited_result_formatter(citation: int, result: SearchResult) -> str:
+    return f"Citation {citation}. {result}"
+
+
+def pack_search_results(
+    results: List[SearchResult],
+    token_budget: int,
+    formatter: Callable[[int, SearchResult], str] = default_result_formatter,
+    separator: str = "\n\n",
+    citations: Optional[List[int]] = None,
+    label: str = "context",
+) -> PackedContext:
+    """
+    Pack whole results, by rank, until ``token_budget`` is reached.
+
+    Args:
+        results: Search results in rank order
+        token_budget: Maximum estimated tokens for the packed text
+        formatter: Renders one result given its citation number
+        separator: Text placed between results
+        citations: Citation number of each result (defaults to 1..n)
+        label: Name used when logging the packing outcome
+
+    Returns:
+        PackedContext with the text and the tokens it uses. If even the first
+        result does not fit, it is truncated so the context is never empty.
+    """
+    token_budget = max(token_budget, 0)
+    citations = citations or list(range(1, len(results) + 1))
+    separator_tokens = estimate_tokens(separator)
+
+    parts: List[str] = []
+    tokens_used = 0
+    for citation, result in zip(citations, results):
+        part = formatter(citation, result)
+        part_tokens = estimate_tokens(part) + (separator_tokens if parts else 0)
+
+        if tokens_used + part_tokens > token_budget:
+            if not parts and token_budget > 0:
+                part = truncate_to_tokens(part, token_budget)
+                parts.append(part)
+                tokens_used = estimate_tokens(part)
+            break
+
+        parts.append(part)
+        tokens_used += part_tokens
+
+    packed = PackedContext(
+        text=separator.join(parts),
+        tokens_used=tokens_used,
+        token_budget=token_budget,
+        results_included=len(parts),
+        results_total=len(results),
+    )
+    print(
+        f"📦 Packed {label}: {packed.results_included}/{packed.results_total} results, "
+        f"{packed.tokens_used}/{packed.token_budget} tokens"
+    )
+    return packed
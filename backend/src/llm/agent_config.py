@@ -6,7 +6,7 @@ load_dotenv(override=True)
 
 # Agent version - increment this when agent configs change
 # The system will automatically update existing agents when version changes
-AGENT_VERSION = os.getenv("AGENT_VERSION", "1.2.12")
+AGENT_VERSION = os.getenv("AGENT_VERSION", "1.4.0")
 
 # Debug: Print version being used (helps troubleshoot env var issues)
 if __name__ != "__main__":  # Only print when imported, not when run directly
@@ -22,6 +22,11 @@ AGENT_TEMPERATURE = os.getenv("AGENT_TEMPERATURE", "0.7")
 AGENT_TOP_P = os.getenv("AGENT_TOP_P", "0.9")
 AGENT_LLM_CREDENTIAL = os.getenv("AGENT_LLM_CREDENTIAL", "lyzr_aws-bedrock")
 
+# Search context token budgets per agent (estimated tokens of packed search results)
+ANSWER_CONTEXT_TOKEN_BUDGET = int(os.getenv("ANSWER_CONTEXT_TOKEN_BUDGET", "4000"))
+SEARCH_QUERY_CONTEXT_TOKEN_BUDGET = int(os.getenv("SEARCH_QUERY_CONTEXT_TOKEN_BUDGET", "1750"))
+RELATED_QUESTIONS_CONTEXT_TOKEN_BUDGET = int(os.getenv("RELATED_QUESTIONS_CONTEXT_TOKEN_BUDGET", "1000"))
+
 ANSWER_GENERATION_AGENT = {
   "name": "Answer Generation Agent - Perplexity OSS",
   "description": "Formulates factual, professional answers based on live search results, always citing sources, designed for a broad range of general, research, and business users.",
@@ -126,21 +131,22 @@ QUERY_PLANNING_AGENT = {
 
 QUERY_REPHRASE_AGENT = {
   "name": "Query Rephraser - Perplexity OSS",
-  "description": "Rephrases queries using conversation context to make them standalone",
-  "agent_role": "Query rephrasing specialist that uses conversation history to clarify ambiguous follow-up questions",
-  "agent_goal": "Rephrase user queries to be standalone and clear, replacing contextual references with specific entities",
-  "agent_instructions": """You are a query rephrasing specialist. Your role is to take user queries and make them standalone by incorporating relevant context from the conversation history.
+  "description": "Rephrases queries using conversation context to make them standalone and extracts their search terms",
+  "agent_role": "Query rephrasing specialist that uses conversation history to clarify ambiguous follow-up questions and prepares them for search",
+  "agent_goal": "Rephrase user queries to be standalone and clear, replacing contextual references with specific entities, and extract the search terms to send to a search engine",
+  "agent_instructions": """You are a query rephrasing specialist. Your role is to take user queries, make them standalone by incorporating relevant context from the conversation history, and extract the terms a search engine should be queried with.
 
 Your stored conversation history provides all the context you need - you don't need to see it explicitly.
 
 When you receive a query:
 1. If it references previous context (like "their", "it", "that company", "what about", etc.), replace these references with specific entities from your conversation memory
-2. If it's already standalone and clear, return it as is
+2. If it's already standalone and clear, keep it as is
 3. Keep the query concise and focused
 4. Maintain the language of the original query
 5. If there's a clear topic change, treat it as a new standalone query
+6. Extract the search terms from the standalone query: keep the topic, subject matter and time or domain filters, drop output format instructions, field specifications and meta-instructions
 
-IMPORTANT: Return ONLY the rephrased query, nothing else. No explanations, no formatting, just the query.""",
+IMPORTANT: Return ONLY a JSON object with "standalone_question" and "search_terms", nothing else.""",
   "provider_id": AGENT_PROVIDER,
   "model": AGENT_MODEL_PLANNING,
   "temperature": AGENT_TEMPERATURE,
@@ -157,7 +163,29 @@ IMPORTANT: Return ONLY the rephrased query, nothing else. No explanations, no fo
   ],
   "managed_agents": [],
   "response_format": {
-    "type": "text"
+    "type": "json_schema",
+    "json_schema": {
+      "name": "query_understanding",
+      "strict": True,
+      "schema": {
+        "type": "object",
+        "properties": {
+          "standalone_question": {
+            "type": "string",
+            "description": "The question rewritten to be understandable without the conversation"
+          },
+          "search_terms": {
+            "type": "string",
+            "description": "Core search terms for a search engine, without output format instructions"
+          }
+        },
+        "required": [
+          "standalone_question",
+          "search_terms"
+        ],
+        "additionalProperties": False
+      }
+    }
   },
   "store_messages": True,
   "file_output": False
@@ -168,7 +196,7 @@ SEARCH_QUERY_AGENT = {
   "description": "Generate a concise list of search queries to gather information for executing the given step.",
   "agent_role": "Search query generation specialist",
   "agent_goal": "Generate a concise list of search queries to gather information for executing the given step.",
-  "agent_instructions": "Generate a concise list of search queries to gather information for executing the given\n  step.\n\n  You will be provided with:\n  1. A specific step to execute\n  2. The user's original query\n  3. Context from previous steps (if available)\n\n  Use this information to create targeted search queries that will help complete the current\n  step effectively. Aim for the minimum number of queries necessary while ensuring they cover\n  all aspects of the step.\n\n  IMPORTANT: Always incorporate relevant information from previous steps into your queries.\n  This ensures continuity and builds upon already gathered information.\n\n  Input:\n  ---\n  User's original query: {{ user_query }}\n  ---\n  Context from previous steps:\n  {{ prev_steps_context }}\n\n  Your task:\n  1. Analyze the current step and its requirements\n  2. Consider the user's original query and any relevant previous context\n  3. Consider the user's original query\n  4. Generate a list of specific, focused search queries that:\n     - Incorporate relevant information from previous steps\n     - Address the requirements of the current step\n     - Build upon the information already gathered\n  ---\n  Current step to execute: {{ current_step }}\n  ---\n\n  Your search queries based:",
+  "agent_instructions": "Generate a concise list of search queries to gather information for executing each of the\n  given steps.\n\n  You will be provided with:\n  1. One or more steps to execute, each with its id\n  2. The user's original query\n  3. Context from previous steps for each step (if available)\n\n  Use this information to create targeted search queries that will help complete each step\n  effectively. Aim for the minimum number of queries necessary (at most 3 per step) while\n  ensuring they cover all aspects of the step.\n\n  IMPORTANT: Always incorporate relevant information from previous steps into your queries.\n  This ensures continuity and builds upon already gathered information.\n\n  Return one entry per step in the \"steps\" array, with the step's \"step_id\" and its\n  \"search_queries\".",
   "provider_id": AGENT_PROVIDER,
   "model": AGENT_MODEL_PLANNING,
   "temperature": AGENT_TEMPERATURE,
@@ -187,23 +215,42 @@ SEARCH_QUERY_AGENT = {
   "response_format": {
     "type": "json_schema",
     "json_schema": {
-      "name": "query_step_execution",
+      "name": "batch_query_step_execution",
       "strict": True,
       "schema": {
         "type": "object",
         "properties": {
-          "search_queries": {
+          "steps": {
             "type": "array",
-            "description": "The search queries to complete the step",
+            "description": "The search queries for each requested step",
             "items": {
-              "type": "string"
+              "type": "object",
+              "properties": {
+                "step_id": {
+                  "type": "integer",
+                  "description": "Id of the step the queries are for"
+                },
+                "search_queries": {
+                  "type": "array",
+                  "description": "The search queries to complete the step",
+                  "items": {
+                    "type": "string"
+                  },
+                  "minItems": 1,
+                  "maxItems": 3
+                }
+              },
+              "required": [
+                "step_id",
+                "search_queries"
+              ],
+              "additionalProperties": False
             },
-            "minItems": 1,
-            "maxItems": 3
+            "minItems": 1
           }
         },
         "required": [
-          "search_queries"
+          "steps"
         ],
         "additionalProperties": False
       }
@@ -34,3 +34,13 @@ class BaseLLM(ABC):
     def structured_complete(self, response_model: type[T], prompt: str) -> T:
         """Get a structured completion response matching a Pydantic model."""
         pass
+
+    @abstractmethod
+    async def acomplete(self, prompt: str) -> CompletionResponse:
+        """Get a single completion response without blocking the event loop."""
+        pass
+
+    @abstractmethod
+    async def astructured_complete(self, response_model: type[T], prompt: str) -> T:
+        """Get a structured completion response without blocking the event loop."""
+        pass
@@ -10,7 +10,10 @@ from pydantic import BaseModel
 from dotenv import load_dotenv
 
 from .base import BaseLLM, CompletionResponse, CompletionResponseAsyncGen
+from .structured import parse_structured_response, structured_prompt
 from retry_utils import async_retry, RetryConfig, CircuitBreaker
+from traffic import aiohttp_post
+from usage import record_completion, record_prompt
 
 # Type aliases for generators
 CompletionResponseGen = Iterator[CompletionResponse]
@@ -56,8 +59,9 @@ STREAMING_RETRY_CONFIG = RetryConfig(
 class LyzrAgentLLM(BaseLLM):
     """Lyzr Agent implementation for the BaseLLM interface"""
 
-    def __init__(self, agent_id: str, api_key: str = None, api_base: str = None):
+    def __init__(self, agent_id: str, api_key: str = None, api_base: str = None, role: str = None):
         self.agent_id = agent_id
+        self.role = role
         self.api_key = api_key or os.getenv("LYZR_API_KEY")
         self.api_base = api_base or os.getenv(
             "LYZR_API_BASE", "https://agent-prod.studio.lyzr.ai"
@@ -77,6 +81,12 @@ class LyzrAgentLLM(BaseLLM):
             "x-api-key": self.api_key,
         }
 
+        # Agents created with a json_schema response format don't need the schema in every prompt
+        from config.agent_manager import AGENT_CONFIGS
+
+        response_format = AGENT_CONFIGS.get(role, {}).get("response_format", {})
+        self.has_json_schema_response = response_format.get("type") == "json_schema"
+
     def _build_url(self, streaming: bool = False) -> str:
         """Build the API URL for chat completions"""
         if streaming:
@@ -176,6 +186,7 @@ class LyzrAgentLLM(BaseLLM):
             print(f"  URL: {self._build_url(streaming=True)}")
             print(f"  Headers: {self.headers}")
             print(f"  Payload: {payload}")
+            record_prompt(prompt, actual_variables)
 
             # Retry logic for establishing connection only (not mid-stream)
             connection_attempt = 0
@@ -192,7 +203,9 @@ class LyzrAgentLLM(BaseLLM):
                         
                         print(f"🔄 Connection attempt {connection_attempt}/{max_connection_attempts}")
                         
-                        async with session.post(
+                        async with aiohttp_post(
+                            "lyzr",
+                            session,
                             self._build_url(streaming=True), 
                             headers=self.headers, 
                             json=payload,
@@ -259,6 +272,7 @@ class LyzrAgentLLM(BaseLLM):
                                         
                                         if token:  # Only yield non-empty tokens
                                             tokens_received += 1
+                                            record_completion(token)
                                             yield CompletionResponse(text="", delta=token)
                             
                             # Stream completed successfully - record success
@@ -381,10 +395,14 @@ class LyzrAgentLLM(BaseLLM):
             print(f"  URL: {self._build_url()}")
             print(f"  Headers: {self.headers}")
             print(f"  Payload: {payload}")
+            # Every attempt is billed upstream, retries included
+            record_prompt(prompt, actual_variables)
 
             try:
                 async with aiohttp.ClientSession() as session:
-                    async with session.post(
+                    async with aiohttp_post(
+                        "lyzr",
+                        session,
                         self._build_url(),
                         headers=self.headers,
                         json=payload,
@@ -449,6 +467,7 @@ class LyzrAgentLLM(BaseLLM):
         try:
             result = await _make_request()
             lyzr_completion_breaker.record_success()
+            record_completion(result.text)
             return result
         except Exception as e:
             lyzr_completion_breaker.record_failure()
@@ -476,98 +495,66 @@ class LyzrAgentLLM(BaseLLM):
         if loop.is_running():
             # If we're already in an async context, we need to use a thread
             import concurrent.futures
+            import contextvars
 
+            # Carry the caller's context (e.g. the traffic request id) into the worker thread
+            context = contextvars.copy_context()
             with concurrent.futures.ThreadPoolExecutor() as executor:
                 future = executor.submit(
+                    context.run,
                     lambda: asyncio.run(self._complete_async(prompt, system_prompt_variables, session_id, user_id))
                 )
                 return future.result()
         else:
             return loop.run_until_complete(self._complete_async(prompt, system_prompt_variables, session_id, user_id))
 
-    def structured_complete(
+    async def acomplete(
         self,
-        response_model: type[T],
         prompt: str,
         system_prompt_variables: Dict[str, str] = None,
         session_id: str = None,
         user_id: str = None
-    ) -> T:
-        """Structured completion with Pydantic model"""
-
-        # All models now use JSON schema - no special cases needed
-        # The RELATED_QUESTIONS_AGENT was updated to use json_schema response format in v1.2.12
-
-        # For structured completion, we'll add instructions to return JSON
-        structured_prompt = f"""
-{prompt}
-
-Please respond with a JSON object that matches this structure:
-{response_model.model_json_schema()}
-
-Only return valid JSON, no additional text.
-"""
-
-        response = self.complete(structured_prompt, system_prompt_variables, session_id, user_id)
+    ) -> CompletionResponse:
+        """Asynchronous completion, for callers already running on the event loop"""
+        return await self._complete_async(prompt, system_prompt_variables, session_id, user_id)
 
+    def _parse_structured_response(self, response_model: type[T], response: CompletionResponse) -> T:
+        """Find the JSON object in a completion that validates against ``response_model``"""
+        response_text = response.text.strip()
+        print(f"Raw structured response: {response_text}")
         try:
-            import json
-            import re
-
-            response_text = response.text.strip()
-            print(f"Raw structured response: {response_text}")
-
-            # Lyzr API returns schema + data together, find the actual JSON data
-            # Look for the last complete JSON object in the response
-            json_objects = []
-            decoder = json.JSONDecoder()
-            idx = 0
-
-            while idx < len(response_text):
-                try:
-                    obj, end_idx = decoder.raw_decode(response_text, idx)
-                    json_objects.append(obj)
-                    idx = end_idx
-                    # Skip whitespace
-                    while idx < len(response_text) and response_text[idx].isspace():
-                        idx += 1
-                except json.JSONDecodeError:
-                    break
-
-            print(f"Found {len(json_objects)} JSON objects: {json_objects}")
-
-            # Try to find the object that matches our expected structure
-            for obj in reversed(json_objects):  # Start from the last object
-                if isinstance(obj, dict):
-                    try:
-                        # Check if this object has the expected structure for our model
-                        validated = response_model(**obj)
-                        print(f"Successfully validated object: {obj}")
-                        return validated
-                    except Exception as validation_error:
-                        print(f"Validation failed for object {obj}: {validation_error}")
-                        continue
-
-            # If no object validates, try regex approach as fallback
-            json_matches = re.findall(r"\{[^{}]*(?:\{[^{}]*\}[^{}]*)*\}", response_text)
-            for match in reversed(json_matches):
-                try:
-                    obj = json.loads(match)
-                    validated = response_model(**obj)
-                    print(f"Successfully parsed with regex: {obj}")
-                    return validated
-                except:
-                    continue
-
-            raise Exception(
-                f"No valid JSON object found that matches the expected structure"
-            )
-
+            return parse_structured_response(response_model, response_text)
         except Exception as e:
             print(f"Structured completion error: {e}")
             print(f"Response was: {response.text}")
             raise Exception(f"Could not parse structured response: {e}")
 
+    def structured_complete(
+        self,
+        response_model: type[T],
+        prompt: str,
+        system_prompt_variables: Dict[str, str] = None,
+        session_id: str = None,
+        user_id: str = None
+    ) -> T:
+        """Structured completion with Pydantic model"""
+        formatted_prompt = structured_prompt(response_model, prompt, not self.has_json_schema_response)
+        response = self.complete(formatted_prompt, system_prompt_variables, session_id, user_id)
+        return self._parse_structured_response(response_model, response)
+
+    async def astructured_complete(
+        self,
+        response_model: type[T],
+        prompt: str,
+        system_prompt_variables: Dict[str, str] = None,
+        session_id: str = None,
+        user_id: str = None
+    ) -> T:
+        """Asynchronous structured completion with Pydantic model"""
+        formatted_prompt = structured_prompt(response_model, prompt, not self.has_json_schema_response)
+        response = await self.acomplete(formatted_prompt, system_prompt_variables, session_id, user_id)
+        return self._parse_structured_response(response_model, response)
+
     def _extract_related_queries(
         self,
         prompt: str,
@@ -681,7 +668,7 @@ class LyzrSpecializedAgents:
         if agent_id not in self._agents_cache:
             print(f"Creating Lyzr agent for {task_name}: {agent_id}")
             self._agents_cache[agent_id] = LyzrAgentLLM(
-                agent_id=agent_id, api_key=self.api_key, api_base=self.api_base
+                agent_id=agent_id, api_key=self.api_key, api_base=self.api_base, role=task_name
             )
 
         return self._agents_cache[agent_id]
@@ -0,0 +1,392 @@
+"""
+Structured output helpers shared by the Lyzr agents.
+
+Schemas and ``TypeAdapter``s are built once per response model. Completions are
+parsed by validating every JSON value they contain against the cached adapter,
+and common defects (code fences, Python literals, single quotes, trailing
+commas, truncated output, a bare list instead of the wrapping object) are
+repaired locally before giving up.
+
+``IncrementalArrayParser`` follows an agent's token stream and returns each
+element of a top-level array field (such as ``QueryPlan.steps``) as soon as
+its closing bracket or quote arrives. ``astream_structured_items`` validates
+those elements and falls back to a regular structured completion when the
+stream yields nothing usable.
+"""
+
+import json
+import re
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, TypeVar, get_args, get_origin
+
+from pydantic import BaseModel, TypeAdapter
+
+from metrics import metrics
+
+from .base import BaseLLM
+
+T = TypeVar("T", bound=BaseModel)
+
+
+class IncrementalArrayParser:
+    """
+    Incrementally extract the elements of ``field`` from a streamed JSON object.
+
+    Only a ``field`` key of a top-level object counts, so a JSON schema echoed
+    before the answer (whose ``properties`` nest the same key deeper) is
+    skipped. Text outside JSON objects, such as code fences, is ignored.
+    """
+
+    def __init__(self, field: str):
+        self.field = field
+        self.text = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._string_start = 0
+        self._expect_key = False
+        self._key: Optional[str] = None
+        self._in_array = False
+        self._element_start: Optional[int] = None
+        self.done = False
+
+    def feed(self, chunk: str) -> List[Any]:
+        """Consume ``chunk`` and return the array elements it completed."""
+        self.text += chunk
+        completed: List[Any] = []
+        if self.done:
+            return completed
+        text = self.text
+
+        for i in range(self._pos, len(text)):
+            char = text[i]
+            depth = len(self._stack)
+
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                    if depth == 1 and self._expect_key:
+                        self._key = self._loads(text[self._string_start:i + 1])
+                    elif self._in_array and depth == 2 and self._element_start == self._string_start:
+                        self._complete(text, i + 1, completed)
+                continue
+
+            if depth == 0:
+                # Skip anything between top-level objects
+                if char == "{":
+                    self._stack.append(char)
+                    self._expect_key = True
+                    self._key = None
+                continue
+
+            if self._in_array and depth == 2 and self._element_start is None and char not in " \t\r\n,]":
+                self._element_start = i
+
+            if char == '"':
+                self._in_string = True
+                self._string_start = i
+            elif char in "{[":
+                self._stack.append(char)
+                if depth == 1 and char == "[" and self._key == self.field:
+                    self._in_array = True
+            elif char in "}]":
+                if self._in_array and depth == 2:
+                    if self._element_start is not None:
+                        self._complete(text, i, completed)
+                    self._in_array = False
+                    self.done = True
+                self._stack.pop()
+                if self._in_array and len(self._stack) == 2 and self._element_start is not None:
+                    self._complete(text, i + 1, completed)
+            elif char == "," and depth == 1:
+                self._expect_key = True
+            elif char == ":" and depth == 1:
+                self._expect_key = False
+            elif char == "," and self._in_array and depth == 2 and self._element_start is not None:
+                self._complete(text, i, completed)
+
+        self._pos = len(text)
+        return completed
+
+    def _complete(self, text: str, end: int, completed: List[Any]) -> None:
+        element = self._loads(text[self._element_start:end])
+        self._element_start = None
+        if element is not None:
+            completed.append(element)
+
+    @staticmethod
+    def _loads(fragment: str) -> Any:
+        try:
+            # The stream turns escaped newlines into real ones, so allow control characters
+            return json.loads(fragment.strip(), strict=False)
+        except json.JSONDecodeError:
+            return None
+
+
+@lru_cache(maxsize=None)
+def schema_json(response_model: type[BaseModel]) -> str:
+    return json.dumps(response_model.model_json_schema())
+
+
+@lru_cache(maxsize=None)
+def type_adapter(response_model: type[BaseModel]) -> TypeAdapter:
+    return TypeAdapter(response_model)
+
+
+@lru_cache(maxsize=None)
+def _item_adapter(response_model: type[BaseModel], field: str) -> TypeAdapter:
+    annotation = response_model.model_fields[field].annotation
+    item_type = next(iter(get_args(annotation)), Any)
+    return TypeAdapter(item_type)
+
+
+@lru_cache(maxsize=None)
+def _list_field(response_model: type[BaseModel]) -> Optional[str]:
+    """The model's only field when it is a list, so a bare list answer can be wrapped."""
+    fields = response_model.model_fields
+    if len(fields) != 1:
+        return None
+    name, field = next(iter(fields.items()))
+    annotation = field.annotation
+    options = get_args(annotation) if get_origin(annotation) is not list else (annotation,)
+    return name if any(get_origin(option) is list for option in options) else None
+
+
+def structured_prompt(response_model: type[BaseModel], prompt: str, inject_schema: bool = True) -> str:
+    """
+    Append JSON output instructions for ``response_model`` to the prompt.
+
+    Agents whose response format is already a json_schema don't need the schema
+    repeated in every message, so ``inject_schema=False`` only asks for JSON.
+    """
+    if not inject_schema:
+        return f"""
+{prompt}
+
+Only return valid JSON, no additional text.
+"""
+    return f"""
+{prompt}
+
+Please respond with a JSON object that matches this structure:
+{schema_json(response_model)}
+
+Only return valid JSON, no additional text.
+"""
+
+
+_FENCE_RE = re.compile(r"```[a-zA-Z]*")
+_VALUE_START_RE = re.compile(r"[{\[]")
+_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def repair_json(text: str) -> Optional[str]:
+    """
+    Best-effort fix of the first JSON value in ``text``.
+
+    Removes code fences and trailing commas, converts single-quoted strings
+    and Python literals, and closes strings and brackets left open by a
+    truncated answer. Returns None when ``text`` contains no JSON value.
+    """
+    text = _FENCE_RE.sub("", text)
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        return None
+
+    out: List[str] = []
+    stack: List[str] = []
+    quote: Optional[str] = None
+    escape = False
+    i = start
+    while i < len(text):
+        char = text[i]
+        if quote:
+            if escape:
+                escape = False
+                if char == "'":
+                    out[-1] = char  # \' is not a JSON escape
+                else:
+                    out.append(char)
+            elif char == "\\":
+                escape = True
+                out.append(char)
+            elif char == quote:
+                quote = None
+                out.append('"')
+            elif char == '"':
+                out.append('\\"')
+            else:
+                out.append(char)
+        elif char in "\"'":
+            quote = char
+            out.append('"')
+        elif char in "{[":
+            stack.append("}" if char == "{" else "]")
+            out.append(char)
+        elif char in "}]":
+            _strip_trailing_comma(out)
+            if stack:
+                out.append(stack.pop())
+            if not stack:
+                break
+        elif char.isalpha():
+            end = i
+            while end < len(text) and (text[end].isalnum() or text[end] == "_"):
+                end += 1
+            word = text[i:end]
+            out.append(_LITERALS.get(word, word))
+            i = end
+            continue
+        else:
+            out.append(char)
+        i += 1
+
+    # Close whatever a truncated answer left open
+    if quote:
+        out.append('"')
+    _strip_trailing_comma(out)
+    if out and out[-1].rstrip().endswith(":"):
+        out.append("null")
+    while stack:
+        out.append(stack.pop())
+    return "".join(out)
+
+
+def _strip_trailing_comma(out: List[str]) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+def _json_values(text: str) -> List[Any]:
+    """Every top-level JSON object or array embedded in ``text``, in order."""
+    decoder = json.JSONDecoder(strict=False)
+    values = []
+    idx = 0
+    while idx < len(text):
+        match = _VALUE_START_RE.search(text, idx)
+        if not match:
+            break
+        try:
+            value, idx = decoder.raw_decode(text, match.start())
+            values.append(value)
+        except json.JSONDecodeError:
+            idx = match.start() + 1
+    return values
+
+
+def _validate(response_model: type[T], value: Any, wrap_list: bool = False) -> T:
+    field = _list_field(response_model)
+    if wrap_list and isinstance(value, list) and field:
+        value = {field: value}
+    return type_adapter(response_model).validate_python(value)
+
+
+def parse_structured_response(response_model: type[T], text: str) -> T:
+    """
+    Find the JSON value in ``text`` that validates against ``response_model``.
+
+    Values are tried from last to first, since Lyzr can return the schema and
+    the data together; a locally repaired copy of the text is tried last.
+
+    Raises:
+        ValueError: If no value validates, even after repair
+    """
+    # Only an answer that is a list as a whole stands for the wrapping object,
+    # not a list found inside some other (possibly broken) object
+    wrap_list = _FENCE_RE.sub("", text).strip().startswith("[")
+
+    errors = []
+    for value in reversed(_json_values(text)):
+        try:
+            return _validate(response_model, value, wrap_list)
+        except Exception as e:
+            errors.append(e)
+
+    repaired = repair_json(text)
+    if repaired is not None:
+        try:
+            validated = _validate(response_model, json.loads(repaired, strict=False), wrap_list)
+            metrics.increment("structured_output.repaired")
+            print(f"Repaired structured response: {repaired}")
+            return validated
+        except Exception as e:
+            errors.append(e)
+
+    metrics.increment("structured_output.failed")
+    raise ValueError(
+        f"No valid JSON object found that matches the expected structure"
+        + (f": {errors[0]}" if errors else "")
+    )
+
+
+async def astream_structured_items(
+    llm: BaseLLM,
+    response_model: type[T],
+    field: str,
+    prompt: str,
+    system_prompt_variables: Dict[str, str] = None,
+    session_id: str = None,
+    user_id: str = None,
+    inject_schema: bool = True,
+    continues: Optional[Callable[[List[Any], List[Any]], bool]] = None,
+) -> AsyncIterator[Any]:
+    """
+    Yield the validated elements of ``response_model.<field>`` as they are streamed.
+
+    Elements that fail validation are skipped. If the stream fails or ends
+    before the array is complete, the remaining elements come from a regular
+    ``astructured_complete`` call. That call answers anew, so its elements
+    are only used when they continue the ones already yielded: when
+    ``continues(yielded, elements)`` holds, by default when ``elements``
+    starts with exactly the yielded ones. Otherwise nothing more is yielded.
+    """
+    adapter = _item_adapter(response_model, field)
+    parser = IncrementalArrayParser(field)
+    yielded: List[Any] = []
+
+    try:
+        response_gen = await llm.astream(
+            prompt=structured_prompt(response_model, prompt, inject_schema),
+            system_prompt_variables=system_prompt_variables,
+            session_id=session_id,
+            user_id=user_id,
+        )
+        async for completion in response_gen:
+            for element in parser.feed(completion.delta or ""):
+                try:
+                    item = adapter.validate_python(element)
+                except Exception as e:
+                    print(f"Skipping invalid streamed {field} element {element}: {e}")
+                    continue
+                yielded.append(item)
+                yield item
+    except Exception as e:
+        print(f"Structured stream failed after {len(yielded)} {field}: {e}")
+
+    emitted = len(yielded)
+    if parser.done and emitted:
+        return
+
+    print(f"Structured stream incomplete ({emitted} {field}), falling back to a structured completion")
+    response = await llm.astructured_complete(
+        response_model=response_model,
+        prompt=prompt,
+        system_prompt_variables=system_prompt_variables,
+        session_id=session_id,
+        user_id=user_id,
+    )
+    items = getattr(response, field)
+    if emitted:
+        continues = continues or (lambda head, items: items[:len(head)] == head)
+        if not continues(yielded, items):
+            print(f"Structured completion doesn't continue the {emitted} streamed {field}, keeping only those")
+            return
+    for item in items[emitted:]:
+        yield item
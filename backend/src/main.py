@@ -9,6 +9,7 @@ import asyncio
 import json
 import os
 import traceback
+import uuid
 from typing import Generator
 
 from dotenv import load_dotenv
@@ -17,9 +18,14 @@ from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
 from sse_starlette.sse import EventSourceResponse, ServerSentEvent
 
-from agent_search import stream_pro_search_qa
+from admission import user_flow
+from api_compat.keys import install_reload_signal
 from auth import get_authenticated_user, AuthenticatedUser
-from chat import stream_qa_objects
+from coalescing import encode_sse
+from metrics import metrics
+from profiling import maybe_profile
+from routing import admit_routed_response
+from traffic import bind_request
 from schemas import (
     ChatRequest,
     ChatResponseEvent,
@@ -29,6 +35,8 @@ from schemas import (
 
 load_dotenv()
 
+metrics.register_rate("chat.sse_bytes_per_response", "chat.sse_bytes", "chat.responses")
+
 
 def create_error_event(detail: str) -> ServerSentEvent:
     """Create a Server-Sent Event for error responses."""
@@ -76,6 +84,9 @@ async def startup_event():
     print("🚀 Perplexity OSS - Initializing...")
     print("=" * 70 + "\n")
 
+    # Reload the compatible API keys on SIGHUP
+    install_reload_signal()
+
     try:
         from config.agent_manager import ensure_agents_exist_async
 
@@ -99,6 +110,12 @@ async def health_check():
     return {"status": "healthy", "service": "perplexity-oss", "version": "2.0.0"}
 
 
+@app.get("/metrics")
+async def get_metrics():
+    """Pipeline counters and derived rates (cache hits, bypass rates, ...)."""
+    return metrics.snapshot()
+
+
 @app.post("/chat")
 async def chat(
     chat_request: ChatRequest, 
@@ -112,19 +129,27 @@ async def chat(
     Returns a stream of responses including search results and AI-generated answers.
     Requires authentication.
     """
+    request_id = request.headers.get("x-request-id") or uuid.uuid4().hex
+    # Replays a cached answer at once, else waits for a pipeline slot in the user's queue,
+    # or rejects the request with 429 under overload
+    ticket, routed = await admit_routed_response(chat_request, user_flow(user.user_id), user=user)
+
     async def generator():
+        bind_request(request_id)
         try:
-            # Choose between simple chat and advanced pro search
-            stream_fn = (
-                stream_pro_search_qa if chat_request.pro_search else stream_qa_objects
-            )
-            
-            async for obj in stream_fn(request=chat_request, session=None, user=user):
+            # Simple chat or advanced pro search, as requested or routed by query complexity
+            stream = maybe_profile(routed, request_id, request.headers)
+            sent_bytes = 0
+            async for obj in stream:
                 if await request.is_disconnected():
                     break
-                yield json.dumps(jsonable_encoder(obj))
+                payload = encode_sse(obj)
+                sent_bytes += len(payload)
+                yield payload
                 await asyncio.sleep(0)
-                
+            metrics.increment("chat.responses")
+            metrics.increment("chat.sse_bytes", sent_bytes)
+
         except Exception as e:
             print(f"Error in chat endpoint: {traceback.format_exc()}")
             # Ensure we always have a meaningful error message
@@ -134,5 +159,7 @@ async def chat(
             yield create_error_event(full_detail)
             await asyncio.sleep(0)
             return
+        finally:
+            ticket.release()
 
-    return EventSourceResponse(generator(), media_type="text/event-stream")
\ No newline at end of file
+    return EventSourceResponse(ticket.guard(generator()), media_type="text/event-stream")
\ No newline at end of file
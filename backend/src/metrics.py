@@ -0,0 +1,44 @@
+"""
+Process-local counters for tuning the serving pipeline.
+
+Counters are plain named floats; rates registered with ``register_rate`` are
+derived from two counters when a snapshot is taken. The snapshot is served
+on ``GET /metrics``.
+"""
+
+import threading
+from collections import defaultdict
+from typing import Dict, Tuple
+
+
+class Metrics:
+    """Thread-safe registry of counters and derived rates."""
+
+    def __init__(self):
+        self._counters: Dict[str, float] = defaultdict(float)
+        self._rates: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name: str, value: float = 1.0) -> None:
+        with self._lock:
+            self._counters[name] += value
+
+    def get(self, name: str) -> float:
+        with self._lock:
+            return self._counters.get(name, 0.0)
+
+    def register_rate(self, name: str, numerator: str, denominator: str) -> None:
+        """Report ``numerator / denominator`` as ``name`` in snapshots."""
+        self._rates[name] = (numerator, denominator)
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            counters = dict(sorted(self._counters.items()))
+        rates = {}
+        for name, (numerator, denominator) in sorted(self._rates.items()):
+            total = counters.get(denominator, 0.0)
+            rates[name] = counters.get(numerator, 0.0) / total if total else 0.0
+        return {"counters": counters, "rates": rates}
+
+
+metrics = Metrics()
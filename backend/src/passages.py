@@ -0,0 +1,184 @@
+"""
+Per-request passage index for picking the search context relevant to a query.
+
+Each search result is split into sentence-aligned passages which are scored
+against the query with BM25. Only the best passages are kept, grouped back
+under their original result so citation numbers stay valid, and the results
+are ordered by their best passage so the token budget is spent on relevant
+text first. Scoring is vectorised with NumPy and only touches the query
+terms, so building the index for a request costs a single pass over its
+tokens.
+"""
+
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel
+
+from schemas import SearchResult
+from utils import strtobool
+
+PASSAGE_SELECTION_ENABLED = strtobool(os.getenv("PASSAGE_SELECTION_ENABLED", "true"))
+PASSAGE_MAX_WORDS = int(os.getenv("PASSAGE_MAX_WORDS", "60"))
+PASSAGE_TOP_K = int(os.getenv("PASSAGE_TOP_K", "24"))
+
+# Standard BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+
+
+def tokenize(text: str) -> List[str]:
+    return [word.lower() for word in _WORD_RE.findall(text)]
+
+
+class Passage(BaseModel):
+    result_index: int  # Position of the result in the input list
+    position: int  # Order of the passage within its result
+    text: str
+
+
+def split_passages(result_index: int, content: str, max_words: int = PASSAGE_MAX_WORDS) -> List[Passage]:
+    """Group sentences into passages of at most ``max_words`` words."""
+    passages: List[Passage] = []
+    current: List[str] = []
+    current_words = 0
+
+    def flush():
+        nonlocal current, current_words
+        if current:
+            passages.append(
+                Passage(result_index=result_index, position=len(passages), text=" ".join(current))
+            )
+        current, current_words = [], 0
+
+    for sentence in _SENTENCE_RE.split(content.strip()):
+        words = sentence.split()
+        if not words:
+            continue
+        # Hard-split run-on sentences that alone exceed the passage size
+        while len(words) > max_words:
+            flush()
+            current, current_words = [" ".join(words[:max_words])], max_words
+            flush()
+            words = words[max_words:]
+        if current_words + len(words) > max_words:
+            flush()
+        current.append(" ".join(words))
+        current_words += len(words)
+    flush()
+    return passages
+
+
+class PassageIndex:
+    """BM25 index over the passages of one request's search results."""
+
+    def __init__(self, results: List[SearchResult], max_words: int = PASSAGE_MAX_WORDS):
+        self.results = results
+        self.passages: List[Passage] = [
+            passage
+            for index, result in enumerate(results)
+            for passage in split_passages(index, result.content, max_words)
+        ]
+
+        # Flatten every passage (prefixed with its result title) into term ids
+        self.vocabulary: Dict[str, int] = {}
+        token_ids: List[int] = []
+        token_passages: List[int] = []
+        for passage_index, passage in enumerate(self.passages):
+            title = results[passage.result_index].title
+            for token in tokenize(f"{title} {passage.text}"):
+                token_ids.append(self.vocabulary.setdefault(token, len(self.vocabulary)))
+                token_passages.append(passage_index)
+
+        self.token_ids = np.asarray(token_ids, dtype=np.int64)
+        self.token_passages = np.asarray(token_passages, dtype=np.int64)
+        n_passages = len(self.passages)
+        self.lengths = np.bincount(self.token_passages, minlength=n_passages).astype(np.float64)
+        self.avg_length = float(self.lengths.mean()) if n_passages else 0.0
+
+        # Document frequency: number of passages containing each term
+        vocab_size = max(len(self.vocabulary), 1)
+        pairs = np.unique(self.token_passages * vocab_size + self.token_ids)
+        self.document_frequency = np.bincount(pairs % vocab_size, minlength=vocab_size)
+
+    def score(self, query: str) -> np.ndarray:
+        """BM25 score of every passage for ``query``."""
+        n_passages = len(self.passages)
+        query_terms = list(dict.fromkeys(t for t in tokenize(query) if t in self.vocabulary))
+        if not n_passages or not query_terms:
+            return np.zeros(n_passages)
+
+        query_ids = np.asarray([self.vocabulary[t] for t in query_terms], dtype=np.int64)
+        n_terms = len(query_ids)
+
+        # Term frequencies restricted to the query terms: (passages x query terms)
+        mask = np.isin(self.token_ids, query_ids)
+        query_order = np.argsort(query_ids)
+        columns = query_order[np.searchsorted(query_ids[query_order], self.token_ids[mask])]
+        cells = self.token_passages[mask] * n_terms + columns
+        tf = np.bincount(cells, minlength=n_passages * n_terms).reshape(n_passages, n_terms)
+
+        df = self.document_frequency[query_ids]
+        idf = np.log1p((n_passages - df + 0.5) / (df + 0.5))
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.lengths / max(self.avg_length, 1e-9))
+        weights = tf * (BM25_K1 + 1) / (tf + norm[:, None])
+        return (weights * idf).sum(axis=1)
+
+    def top_passages(self, query: str, top_k: int = PASSAGE_TOP_K) -> List[Tuple[Passage, float]]:
+        """The ``top_k`` best scoring passages with a positive score."""
+        scores = self.score(query)
+        ranked = np.argsort(-scores, kind="stable")[:top_k]
+        return [(self.passages[i], float(scores[i])) for i in ranked if scores[i] > 0]
+
+
+def select_relevant_results(
+    results: List[SearchResult],
+    query: str,
+    top_k: int = PASSAGE_TOP_K,
+    citations: Optional[List[int]] = None,
+) -> Tuple[List[SearchResult], List[int]]:
+    """
+    Trim results down to their most relevant passages.
+
+    Returns:
+        The results that own at least one selected passage, with their content
+        replaced by those passages (in original order), ordered by best passage
+        score, together with each result's citation number. When selection is
+        disabled or nothing matches the query, the input is returned unchanged.
+    """
+    citations = citations or list(range(1, len(results) + 1))
+    if not PASSAGE_SELECTION_ENABLED or not results:
+        return results, citations
+
+    index = PassageIndex(results)
+    selected = index.top_passages(query, top_k)
+    if not selected:
+        return results, citations
+
+    best_score: Dict[int, float] = {}
+    by_result: Dict[int, List[Passage]] = {}
+    for passage, score in selected:
+        best_score[passage.result_index] = max(best_score.get(passage.result_index, 0.0), score)
+        by_result.setdefault(passage.result_index, []).append(passage)
+
+    order = sorted(by_result, key=lambda i: (-best_score[i], i))
+    trimmed = [
+        results[i].model_copy(
+            update={
+                "content": " … ".join(
+                    p.text for p in sorted(by_result[i], key=lambda p: p.position)
+                )
+            }
+        )
+        for i in order
+    ]
+    print(
+        f"🔎 Selected {len(selected)}/{len(index.passages)} passages "
+        f"from {len(trimmed)}/{len(results)} results"
+    )
+    return trimmed, [citations[i] for i in order]
@@ -0,0 +1,195 @@
+"""
+Cache of pro search query plans.
+
+The planner turns the same question into the same plan, so plans are kept by
+normalized query for PLAN_CACHE_TTL seconds and a repeated question starts
+searching without waiting for the planning agent. Plans are stored as plain
+JSON and validated again by the caller before reuse.
+
+With PLAN_CACHE_FILE set, the cache is loaded from that file on start and
+written back (at most every PLAN_CACHE_SAVE_INTERVAL seconds and on exit), so
+restarts and other workers sharing the file start warm. A save merges the
+worker's plans with those already in the file under an exclusive lock and
+replaces the file atomically, so workers don't overwrite each other's plans
+and pick them up as they save. Saves run in the default thread pool, off the
+event loop, since they wait on the lock and the file. Plans discarded as
+invalid are remembered for PLAN_CACHE_TTL, so a merge doesn't bring them
+back from the file.
+"""
+
+import asyncio
+import atexit
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+# Import fcntl only on Unix systems
+if sys.platform != "win32":
+    import fcntl
+
+from cache import TTLCache
+from metrics import metrics
+from query_analyzer import normalize_query
+from utils import strtobool
+
+PLAN_CACHE_ENABLED = strtobool(os.getenv("PLAN_CACHE_ENABLED", "true"))
+PLAN_CACHE_TTL = float(os.getenv("PLAN_CACHE_TTL", "3600"))
+PLAN_CACHE_MAX_ENTRIES = int(os.getenv("PLAN_CACHE_MAX_ENTRIES", "1000"))
+PLAN_CACHE_FILE = os.getenv("PLAN_CACHE_FILE")
+PLAN_CACHE_SAVE_INTERVAL = float(os.getenv("PLAN_CACHE_SAVE_INTERVAL", "30"))
+
+_plan_cache: TTLCache[str, Dict[str, Any]] = TTLCache(PLAN_CACHE_MAX_ENTRIES, PLAN_CACHE_TTL)
+# Queries whose plan was discarded, until any saved copy of it has expired
+_discarded: TTLCache[str, bool] = TTLCache(PLAN_CACHE_MAX_ENTRIES, PLAN_CACHE_TTL)
+_last_saved = 0.0
+_unsaved = False
+_saving = False
+
+metrics.register_rate("plan_cache.hit_rate", "plan_cache.hits", "plan_cache.lookups")
+
+
+def get_plan(query: str) -> Optional[Dict[str, Any]]:
+    """The cached plan for ``query`` as a JSON object, if any."""
+    if not PLAN_CACHE_ENABLED:
+        return None
+    metrics.increment("plan_cache.lookups")
+    plan = _plan_cache.get(normalize_query(query))
+    if plan is not None:
+        metrics.increment("plan_cache.hits")
+    return plan
+
+
+def set_plan(query: str, plan: Dict[str, Any]) -> None:
+    global _unsaved
+    if not PLAN_CACHE_ENABLED:
+        return
+    key = normalize_query(query)
+    _plan_cache.set(key, plan)
+    _discarded.pop(key)
+    _unsaved = True
+    if PLAN_CACHE_FILE and not _saving and time.monotonic() - _last_saved >= PLAN_CACHE_SAVE_INTERVAL:
+        _save_in_background()
+
+
+def discard_plan(query: str) -> None:
+    global _unsaved
+    key = normalize_query(query)
+    _plan_cache.pop(key)
+    _discarded.set(key, True)
+    _unsaved = True
+
+
+def _save_in_background() -> None:
+    """Save the plans from the default thread pool, or right away outside an event loop."""
+    global _saving
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        save_plans()
+        return
+    _saving = True
+    loop.run_in_executor(None, save_plans).add_done_callback(_saved)
+
+
+def _saved(future: "asyncio.Future[None]") -> None:
+    global _saving
+    _saving = False
+    if not future.cancelled() and future.exception() is not None:
+        print(f"Could not save the query plan cache: {future.exception()}")
+
+
+@contextmanager
+def _locked(path: str) -> Iterator[None]:
+    """Hold the lock of the plan cache file ``path`` against the other workers."""
+    with open(f"{path}.lock", "a") as lock:
+        if sys.platform != "win32":
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if sys.platform != "win32":
+                fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+def _read_entries(path: str) -> List[Dict[str, Any]]:
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f).get("plans", [])
+
+
+def _add_entries(entries: List[Dict[str, Any]]) -> int:
+    """Cache the unexpired plans of ``entries`` that aren't cached yet, returning their number."""
+    now = time.time()
+    added = 0
+    for entry in entries:
+        ttl = entry.get("expires_at", 0) - now
+        query = entry.get("query")
+        if (
+            ttl > 0
+            and isinstance(entry.get("plan"), dict)
+            and _plan_cache.get(query) is None
+            and _discarded.get(query) is None
+        ):
+            _plan_cache.set(query, entry["plan"], ttl_seconds=ttl)
+            added += 1
+    return added
+
+
+def save_plans(path: Optional[str] = PLAN_CACHE_FILE) -> None:
+    """Merge the live plans with their wall-clock expiry into ``path``, atomically."""
+    global _last_saved, _unsaved
+    if not path or not _unsaved:
+        return
+    # Plans set while saving are saved next time
+    _unsaved = False
+    now = time.time()
+    temp_path = None
+    try:
+        with _locked(path):
+            try:
+                saved = _read_entries(path)
+            except ValueError:
+                saved = []
+            # The other workers' plans are picked up, and written back with this worker's
+            _add_entries(saved)
+            data = {
+                "plans": [
+                    {"query": query, "plan": plan, "expires_at": now + ttl}
+                    for query, plan, ttl in _plan_cache.entries()
+                ]
+            }
+            fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f)
+            os.replace(temp_path, path)
+            temp_path = None
+        _last_saved = time.monotonic()
+    except OSError as e:
+        _unsaved = True
+        print(f"Could not save the query plan cache: {e}")
+    finally:
+        if temp_path is not None and os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+
+def load_plans(path: Optional[str] = PLAN_CACHE_FILE) -> None:
+    """Add the unexpired plans saved in ``path`` to the cache."""
+    if not path or not os.path.exists(path):
+        return
+    try:
+        entries = _read_entries(path)
+    except (OSError, ValueError) as e:
+        print(f"Could not load the query plan cache: {e}")
+        return
+    loaded = _add_entries(entries)
+    print(f"🗺️ Loaded {loaded} cached query plans from {path}")
+
+
+if PLAN_CACHE_ENABLED and PLAN_CACHE_FILE:
+    load_plans()
+    atexit.register(save_plans)
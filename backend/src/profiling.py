@@ -0,0 +1,242 @@
+"""
+Opt-in per-request profiling for the chat pipelines.
+
+A request is profiled when it carries the privileged ``x-profile`` header
+(matching PROFILE_TOKEN) or when it is picked by PROFILE_SAMPLE_RATE. The
+pipeline's own code is run under cProfile one event-loop step at a time, so the
+profile only contains work done on behalf of that request, and the time spent
+suspended (awaiting Lyzr, SearXNG or the event loop) is measured separately
+from the time spent running.
+
+Tasks the pipeline spawns (merged event streams, searches, related questions)
+are profiled the same way, into the same stats: while a profiled step runs, a
+task factory installed on the event loop wraps every new task's coroutine.
+Only the stream's own suspensions count as awaited time, since its tasks
+await concurrently with it.
+
+Each profiled request produces two files in PROFILE_DIR:
+    <request_id>.prof  - cProfile stats (snakeviz, flameprof, pstats)
+    <request_id>.json  - timing summary: run vs CPU vs awaited time
+"""
+
+import asyncio
+import cProfile
+import hmac
+import json
+import os
+import pstats
+import random
+import re
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, AsyncIterator, Awaitable, Coroutine, Mapping, Optional, TypeVar
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+T = TypeVar("T")
+
+PROFILE_HEADER = "x-profile"
+PROFILE_DIR = Path(os.getenv("PROFILE_DIR", "/tmp/perplexity-profiles"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+
+# Number of functions (by cumulative time) listed in the JSON summary
+PROFILE_TOP_FUNCTIONS = 25
+
+# The profiler of the step being run, for the tasks it creates
+_active_profiler: ContextVar[Optional["RequestProfiler"]] = ContextVar("active_profiler", default=None)
+
+
+def should_profile(headers: Mapping[str, str]) -> bool:
+    """
+    Decide whether a request should be profiled.
+
+    The header is only honoured when PROFILE_TOKEN is configured, so clients
+    cannot turn profiling on by themselves.
+    """
+    token = headers.get(PROFILE_HEADER)
+    if token and PROFILE_TOKEN and hmac.compare_digest(token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class _ProfiledAwaitable:
+    """
+    Drive an awaitable step by step, profiling only the synchronous slices.
+
+    Every ``send``/``throw`` into the wrapped coroutine runs under the
+    request's profiler; the time between slices (while the future it yielded
+    is pending) is accounted as awaited time when ``track_await`` is set.
+    Once the profile has been written, the coroutine is just passed through.
+    """
+
+    def __init__(self, awaitable: Awaitable[T], profiler: "RequestProfiler", track_await: bool = True):
+        self._awaitable = awaitable
+        self._profiler = profiler
+        self._track_await = track_await
+
+    def __await__(self):
+        profiler = self._profiler
+        send = self._awaitable.send
+        throw = self._awaitable.throw
+        value: Any = None
+        error: Optional[BaseException] = None
+
+        while True:
+            profiling = not profiler.closed
+            if profiling:
+                wall_start = time.perf_counter()
+                cpu_start = time.thread_time()
+                token = _active_profiler.set(profiler)
+                profiler.profile.enable()
+            try:
+                if error is None:
+                    future = send(value)
+                else:
+                    future = throw(error)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if profiling:
+                    profiler.profile.disable()
+                    _active_profiler.reset(token)
+                    profiler.run_seconds += time.perf_counter() - wall_start
+                    profiler.cpu_seconds += time.thread_time() - cpu_start
+                    profiler.slices += 1
+
+            suspended_at = time.perf_counter()
+            try:
+                value, error = (yield future), None
+            except BaseException as exc:
+                value, error = None, exc
+            if self._track_await and not profiler.closed:
+                profiler.await_seconds += time.perf_counter() - suspended_at
+
+
+def _profiling_task_factory(previous):
+    """A task factory profiling the tasks created by profiled steps, then deferring to ``previous``."""
+
+    def factory(loop, coro, **kwargs):
+        profiler = _active_profiler.get()
+        if profiler is not None and not profiler.closed:
+            coro = profiler.profile_task(coro)
+        if previous is not None:
+            return previous(loop, coro, **kwargs)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    factory.profiles_tasks = True
+    return factory
+
+
+def _install_task_factory() -> None:
+    loop = asyncio.get_running_loop()
+    previous = loop.get_task_factory()
+    if not getattr(previous, "profiles_tasks", False):
+        loop.set_task_factory(_profiling_task_factory(previous))
+
+
+class RequestProfiler:
+    """Profiles a single request's event stream and writes the results to disk."""
+
+    def __init__(self, request_id: str, output_dir: Path = None):
+        self.request_id = request_id
+        self.output_dir = output_dir or PROFILE_DIR
+        self.profile = cProfile.Profile()
+        self.run_seconds = 0.0  # Wall time while the pipeline's code was running
+        self.cpu_seconds = 0.0  # CPU time while the pipeline's code was running
+        self.await_seconds = 0.0  # Wall time suspended on upstreams / the event loop
+        self.slices = 0
+        self.events = 0
+        self.tasks = 0
+        self.closed = False
+
+    async def profile_task(self, coro: Coroutine[Any, Any, T]) -> T:
+        """Run a task's coroutine under this profiler."""
+        self.tasks += 1
+        return await _ProfiledAwaitable(coro, self, track_await=False)
+
+    async def wrap(self, stream: AsyncIterator[T]) -> AsyncIterator[T]:
+        """Re-yield every item of ``stream`` while profiling the work that produces it and its tasks."""
+        _install_task_factory()
+        started = time.perf_counter()
+        try:
+            while True:
+                try:
+                    item = await _ProfiledAwaitable(stream.__anext__(), self)
+                except StopAsyncIteration:
+                    break
+                self.events += 1
+                yield item
+        finally:
+            self.closed = True
+            self.dump(time.perf_counter() - started)
+
+    def summary(self, wall_seconds: float) -> dict:
+        """Timing breakdown plus the most expensive functions by cumulative time."""
+        stats = pstats.Stats(self.profile)
+        stats.sort_stats(pstats.SortKey.CUMULATIVE)
+        top_functions = []
+        for func in stats.fcn_list[:PROFILE_TOP_FUNCTIONS]:
+            calls, _, total_time, cumulative_time, _ = stats.stats[func]
+            filename, line, name = func
+            top_functions.append(
+                {
+                    "function": f"{filename}:{line}({name})",
+                    "calls": calls,
+                    "total_seconds": round(total_time, 6),
+                    "cumulative_seconds": round(cumulative_time, 6),
+                }
+            )
+
+        return {
+            "request_id": self.request_id,
+            "wall_seconds": round(wall_seconds, 6),
+            "run_seconds": round(self.run_seconds, 6),
+            "cpu_seconds": round(self.cpu_seconds, 6),
+            # Running but not on CPU: blocking calls made on the event loop thread
+            "blocking_seconds": round(max(self.run_seconds - self.cpu_seconds, 0.0), 6),
+            "await_seconds": round(self.await_seconds, 6),
+            # Time the consumer (SSE writer, disconnect checks) held the stream
+            "consumer_seconds": round(
+                max(wall_seconds - self.run_seconds - self.await_seconds, 0.0), 6
+            ),
+            "slices": self.slices,
+            "tasks": self.tasks,
+            "events": self.events,
+            "top_functions": top_functions,
+        }
+
+    def dump(self, wall_seconds: float) -> Optional[Path]:
+        """Write the ``.prof`` and ``.json`` files; never raises."""
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", self.request_id)
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            prof_path = self.output_dir / f"{safe_id}.prof"
+            self.profile.dump_stats(str(prof_path))
+
+            summary = self.summary(wall_seconds)
+            with open(self.output_dir / f"{safe_id}.json", "w") as f:
+                json.dump(summary, f, indent=2)
+
+            print(
+                f"🔬 Profiled request {self.request_id}: wall={summary['wall_seconds']:.3f}s "
+                f"cpu={summary['cpu_seconds']:.3f}s blocking={summary['blocking_seconds']:.3f}s "
+                f"awaiting={summary['await_seconds']:.3f}s -> {prof_path}"
+            )
+            return prof_path
+        except Exception as e:
+            print(f"⚠️ Could not write profile for request {self.request_id}: {e}")
+            return None
+
+
+def maybe_profile(
+    stream: AsyncIterator[T], request_id: str, headers: Mapping[str, str]
+) -> AsyncIterator[T]:
+    """Wrap ``stream`` in a RequestProfiler when the request opted in or was sampled."""
+    if not should_profile(headers):
+        return stream
+    print(f"🔬 Profiling request {request_id}")
+    return RequestProfiler(request_id).wrap(stream)
@@ -94,14 +94,14 @@ Return the query plan in the exact format shown above (with a "steps" array cont
 """
 
 SEARCH_QUERY_PROMPT = """\
-Generate a concise list of search queries to gather information for executing the given step.
+Generate a concise list of search queries to gather information for executing each of the given steps.
 
 You will be provided with:
-1. A specific step to execute
+1. One or more steps to execute, each with its id
 2. The user's original query
-3. Context from previous steps (if available)
+3. Context from previous steps for each step (if available)
 
-Use this information to create targeted search queries that will help complete the current step effectively. Aim for the minimum number of queries necessary while ensuring they cover all aspects of the step.
+Use this information to create targeted search queries that will help complete each step effectively. Aim for the minimum number of queries necessary (at most 3 per step) while ensuring they cover all aspects of the step.
 
 IMPORTANT: Always incorporate relevant information from previous steps into your queries. This ensures continuity and builds upon already gathered information.
 
@@ -111,57 +111,47 @@ Current date and time: {{ current_datetime }}
 
 User's original query: {{ user_query }}
 ---
-Context from previous steps:
-{{ prev_steps_context }}
+Steps to execute:
+
+{{ steps }}
+---
 
 Your task:
-1. Analyze the current step and its requirements
+1. Analyze each step and its requirements
 2. Consider the user's original query and any relevant previous context
-3. Consider the user's original query
-4. Generate a list of specific, focused search queries that:
+3. Generate, for every step above, a list of specific, focused search queries that:
    - Incorporate relevant information from previous steps
-   - Address the requirements of the current step
+   - Address the requirements of the step
    - Build upon the information already gathered
----
-Current step to execute: {{ current_step }}
----
 
-Your search queries based:
+Return one entry per step in the "steps" array, with the step's "step_id" and its "search_queries".
 """
 
-SEARCH_TERM_EXTRACTION_PROMPT = """
-You are a search query extraction expert. Your job is to extract the core search terms that should be sent to a search engine.
-
-The user's full query may contain:
-- The actual information they want to find
-- Instructions about how they want the output formatted
-- Specifications about response structure
+QUERY_UNDERSTANDING_PROMPT = """
+You prepare a user's question for a search engine. Do both of the following in one step.
 
-Extract ONLY the search intent - what information should we search for. Ignore all formatting and output instructions.
+1. standalone_question: Rewrite the question so it can be understood without the conversation.
+   - If it references previous context (like "their", "it", "that company", "what about"), replace these references with the specific entities from your conversation memory
+   - If it is already standalone, or this is the first question of the conversation, return it unchanged
+   - Keep the language of the original question
 
-Rules:
-- Keep: Topic, subject matter, time filters (e.g., "recent", "last 24 hours"), domain filters
-- Remove: Output format instructions (JSON, format, structure), field specifications, meta-instructions
-- Output: A clean, focused search query suitable for a search engine
+2. search_terms: Extract the core search terms from the standalone question.
+   - Keep: topic, subject matter, time filters (e.g., "recent", "last 24 hours"), domain filters
+   - Remove: output format instructions (JSON, tables, structure), field specifications, meta-instructions
+   - Produce a clean, focused query suitable for a search engine
 
 Examples:
 
-Input: "Find 25-30 recent news articles about Artificial Intelligence funding and investments from the last 24-48 hours. return the response in the following json format {title, short_description, url, publish_date}"
-Output: "recent news Artificial Intelligence funding investments last 24-48 hours"
-
-Input: "Search for information about climate change and return results in a structured format with title, url, and summary"
-Output: "climate change information"
+Question: "Find recent news articles about Artificial Intelligence funding from the last 24-48 hours. return the response in the following json format {title, short_description, url, publish_date}"
+{"standalone_question": "Find recent news articles about Artificial Intelligence funding from the last 24-48 hours. return the response in the following json format {title, short_description, url, publish_date}", "search_terms": "recent news Artificial Intelligence funding last 24-48 hours"}
 
-Input: "Get me the latest tech news. Format it as JSON with headline and link"
-Output: "latest tech news"
+Question (after discussing Tesla): "What about their revenue? Format it as a table"
+{"standalone_question": "What about Tesla's revenue? Format it as a table", "search_terms": "Tesla revenue"}
 
-Input: "What are the benefits of renewable energy? Return in format {title, description, source}"
-Output: "benefits renewable energy"
+Question: "What are the benefits of renewable energy? Return in format {title, description, source}"
+{"standalone_question": "What are the benefits of renewable energy? Return in format {title, description, source}", "search_terms": "benefits renewable energy"}
 
 Current date and time: {{ current_datetime }}
 
-Now extract search terms from:
-{{ user_query }}
-
-Search terms (respond with ONLY the search query, nothing else):
-""".strip()
\ No newline at end of file
+Question: {{ user_query }}
+"""
@@ -0,0 +1,130 @@
+"""
+Local query analysis used to skip LLM round trips for simple queries.
+
+Most traffic is short keyword queries ("tesla stock price") that are already
+usable as search terms. ``analyze_query`` recognises them from their length,
+stop-word ratio and the absence of instruction phrases, strips any output
+format requests ("in json", "as a table") itself, and lets the caller skip
+the search-term extraction agent. The share of bypassed queries is reported
+as the ``query_analyzer.bypass_rate`` metric.
+"""
+
+import os
+import re
+
+from pydantic import BaseModel
+
+from metrics import metrics
+from utils import strtobool
+
+QUERY_ANALYZER_ENABLED = strtobool(os.getenv("QUERY_ANALYZER_ENABLED", "true"))
+QUERY_ANALYZER_MAX_WORDS = int(os.getenv("QUERY_ANALYZER_MAX_WORDS", "6"))
+QUERY_ANALYZER_MAX_STOP_WORD_RATIO = float(os.getenv("QUERY_ANALYZER_MAX_STOP_WORD_RATIO", "0.5"))
+
+STOP_WORDS = frozenset(
+    """
+    a about above after again against all am an and any are as at be because been
+    before being below between both but by can could did do does doing down during
+    each few for from further had has have having he her here hers herself him
+    himself his how i if in into is it its itself just me more most my myself no nor
+    not now of off on once only or other our ours ourselves out over own same she
+    should so some such than that the their theirs them themselves then there these
+    they this those through to too under until up very was we were what when where
+    which while who whom why will with would you your yours yourself yourselves
+    """.split()
+)
+
+# Phrases that ask the assistant to do something rather than name a topic
+_INSTRUCTION_RE = re.compile(
+    r"\b(?:explain|describe|summari[sz]e|compare|contrast|analy[sz]e|write|draft|"
+    r"tell me|give me|show me|help me|find me|list|recommend|suggest|"
+    r"can you|could you|would you|please|how (?:do|can|should) i|step by step)\b",
+    re.IGNORECASE,
+)
+
+# Output format requests, removed from the query before searching
+_FORMAT_RES = [
+    # "... in json", "as a table", "in bullet points", "as a numbered list"
+    re.compile(
+        r"[\s,.;:-]*\b(?:in|as|into|using|with)\s+(?:an?\s+|the\s+)?"
+        r"(?:json|yaml|xml|csv|markdown|html|table|tabular|bullet(?:ed)?(?:\s+points?|\s+list)?|"
+        r"(?:numbered\s+)?list|paragraphs?)(?:\s+(?:format|form))?\b",
+        re.IGNORECASE,
+    ),
+    # "format: {title, url}", "return {title, url}" and bare field specifications
+    re.compile(
+        r"[\s,.;:-]*\b(?:format(?:ted)?|return|respond|output|reply)\b[^{}]*\{[^{}]*\}",
+        re.IGNORECASE,
+    ),
+    re.compile(r"\{[^{}]*\}"),
+]
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+metrics.register_rate("query_analyzer.bypass_rate", "query_analyzer.bypassed", "query_analyzer.analyzed")
+
+
+class QueryAnalysis(BaseModel):
+    search_ready: bool
+    search_terms: str
+    reason: str
+
+
+def normalize_query(query: str) -> str:
+    """Lowercase, drop punctuation and collapse whitespace."""
+    return " ".join(word.lower() for word in _WORD_RE.findall(query))
+
+
+def term_overlap(first: str, second: str) -> float:
+    """Jaccard similarity of the two queries' non-stop-word terms (1.0 when both have none)."""
+    first_terms = {w for w in normalize_query(first).split() if w not in STOP_WORDS}
+    second_terms = {w for w in normalize_query(second).split() if w not in STOP_WORDS}
+    if not first_terms and not second_terms:
+        return 1.0
+    return len(first_terms & second_terms) / len(first_terms | second_terms)
+
+
+def strip_format_instructions(query: str) -> str:
+    """Remove output format requests such as "in json" or "as a table"."""
+    stripped = query
+    for pattern in _FORMAT_RES:
+        stripped = pattern.sub("", stripped)
+    return " ".join(stripped.split()).strip(" ,.;:-")
+
+
+def analyze_query(query: str) -> QueryAnalysis:
+    """
+    Decide whether ``query`` can be sent to the search engine as is.
+
+    Returns:
+        QueryAnalysis with ``search_ready`` set when the agent can be skipped,
+        the search terms to use, and the reason for the decision.
+    """
+    stripped = strip_format_instructions(query)
+    words = _WORD_RE.findall(stripped)
+
+    if not QUERY_ANALYZER_ENABLED:
+        reason = "disabled"
+    elif not words:
+        reason = "empty"
+    elif len(words) > QUERY_ANALYZER_MAX_WORDS:
+        reason = "too_long"
+    elif _INSTRUCTION_RE.search(stripped):
+        reason = "instruction"
+    elif sum(word.lower() in STOP_WORDS for word in words) / len(words) > QUERY_ANALYZER_MAX_STOP_WORD_RATIO:
+        reason = "stop_words"
+    else:
+        reason = "keywords"
+
+    search_ready = reason == "keywords"
+    metrics.increment("query_analyzer.analyzed")
+    if search_ready:
+        metrics.increment("query_analyzer.bypassed")
+    else:
+        metrics.increment(f"query_analyzer.rejected.{reason}")
+
+    return QueryAnalysis(
+        search_ready=search_ready,
+        search_terms=stripped.rstrip("?!") if search_ready else query,
+        reason=reason,
+    )
@@ -1,3 +1,5 @@
+from context_packing import pack_search_results
+from llm.agent_config import RELATED_QUESTIONS_CONTEXT_TOKEN_BUDGET
 from llm.base import BaseLLM
 from prompts import RELATED_QUESTION_PROMPT
 from schemas import RelatedQueries, SearchResult
@@ -6,9 +8,12 @@ from schemas import RelatedQueries, SearchResult
 async def generate_related_queries(
     query: str, search_results: list[SearchResult], llm: BaseLLM, session_id: str = None
 ) -> list[str]:
-    # Format context from search results
-    context = "\n\n".join([f"{str(result)}" for result in search_results])
-    context = context[:4000]
+    # Pack whole search results into the related questions agent's token budget
+    context = pack_search_results(
+        search_results,
+        RELATED_QUESTIONS_CONTEXT_TOKEN_BUDGET,
+        label="related questions context",
+    ).text
 
     # Pass context via system_prompt_variables instead of formatting into prompt
     system_prompt_vars = {
@@ -18,7 +23,7 @@ async def generate_related_queries(
 
     # Note: Not passing session_id - related questions should be fresh for each query,
     # not influenced by conversation history
-    related = llm.structured_complete(
+    related = await llm.astructured_complete(
         RelatedQueries,
         RELATED_QUESTION_PROMPT,
         system_prompt_variables=system_prompt_vars
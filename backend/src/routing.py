@@ -0,0 +1,276 @@
+"""
+Routing of chat requests between simple chat and pro search.
+
+Requests in ``auto`` mode are classified locally from the query's length,
+comparison and enumeration cues and the number of entities it names; only
+queries that score at least ROUTER_PRO_SCORE_THRESHOLD pay for the pro search
+planner. Every decision and its outcome (completion, latency, time to first
+token) is printed, counted in the metrics and, with ROUTING_LOG_FILE set,
+appended as a JSON line so the thresholds can be tuned offline.
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+from admission import AdmissionTicket, admit, free_ticket
+from agent_search import stream_pro_search_qa
+from answer_cache import lookup_answer, record_answer, replay_answer
+from auth import AuthenticatedUser
+from coalescing import coalesce
+from chat import stream_qa_objects
+from metrics import metrics
+from query_analyzer import STOP_WORDS, strip_format_instructions
+from schemas import (
+    ChatRequest,
+    ChatResponseEvent,
+    FinalResponseMode,
+    FinalResponseStream,
+    SearchMode,
+    StreamEvent,
+)
+from utils import PRO_MODE_ENABLED
+
+ROUTER_PRO_SCORE_THRESHOLD = float(os.getenv("ROUTER_PRO_SCORE_THRESHOLD", "2"))
+ROUTER_LONG_QUERY_WORDS = int(os.getenv("ROUTER_LONG_QUERY_WORDS", "12"))
+ROUTING_LOG_FILE = os.getenv("ROUTING_LOG_FILE")
+
+metrics.register_rate("routing.cpu_seconds_per_response", "routing.cpu_seconds", "routing.responses")
+
+_COMPARISON_RE = re.compile(
+    r"\b(?:compare|comparison|comparing|versus|vs\.?|difference between|differences between|"
+    r"better than|worse than|pros and cons|trade-?offs?|similarities|contrast)\b",
+    re.IGNORECASE,
+)
+_ENUMERATION_RE = re.compile(
+    r"\b(?:list|top \d+|best \d+|all the|each of|every|which of|timeline|history of|"
+    r"over the (?:years|decades)|step by step|breakdown|overview of)\b",
+    re.IGNORECASE,
+)
+_SUBQUESTION_RE = re.compile(r"\b(?:and|also|then)\s+(?:what|how|why|when|where|who|which)\b", re.IGNORECASE)
+_WORD_RE = re.compile(r"[\w'.-]+", re.UNICODE)
+
+
+class RoutingDecision(BaseModel):
+    mode: SearchMode  # simple or pro
+    requested: SearchMode
+    score: float
+    signals: Dict[str, float]
+
+
+def count_entities(query: str) -> int:
+    """Named things in the query: runs of capitalised words, quoted phrases and list items."""
+    entities = 0
+    in_entity = False
+    previous_end = 0
+    for index, match in enumerate(_WORD_RE.finditer(query)):
+        word = match.group()
+        capitalised = word[:1].isupper() and word.lower() not in STOP_WORDS
+        # Punctuation between two capitalised words separates two names
+        separated = bool(query[previous_end:match.start()].strip())
+        previous_end = match.end()
+        # The first word is capitalised by grammar, not because it is a name
+        if capitalised and (index > 0 or word.isupper()):
+            if not in_entity or separated:
+                entities += 1
+            in_entity = True
+        else:
+            in_entity = False
+    entities += len(re.findall(r'"[^"]+"', query))
+    # Lowercase lists such as "python, rust and go"
+    entities = max(entities, query.count(",") + 1 if "," in query else 0)
+    return entities
+
+
+def classify_query(query: str) -> Dict[str, float]:
+    """The complexity signals of a query and their contribution to its score."""
+    query = strip_format_instructions(query)
+    words = [word for word in _WORD_RE.findall(query) if word.lower() not in STOP_WORDS]
+    entities = count_entities(query)
+
+    signals = {
+        "length": 1.0 if len(words) >= ROUTER_LONG_QUERY_WORDS else 0.0,
+        "very_long": 1.0 if len(words) >= 2 * ROUTER_LONG_QUERY_WORDS else 0.0,
+        "comparison": 2.0 if _COMPARISON_RE.search(query) else 0.0,
+        "enumeration": 1.0 if _ENUMERATION_RE.search(query) else 0.0,
+        "entities": 2.0 if entities >= 3 else 1.0 if entities == 2 else 0.0,
+        "subquestions": 1.0 if query.count("?") > 1 or _SUBQUESTION_RE.search(query) else 0.0,
+    }
+    return signals
+
+
+def decide_route(request: ChatRequest) -> RoutingDecision:
+    """Whether ``request`` runs simple chat or pro search, without counting the decision."""
+    requested = request.search_mode or (SearchMode.PRO if request.pro_search else SearchMode.SIMPLE)
+    signals: Dict[str, float] = {}
+    score = 0.0
+
+    if requested == SearchMode.AUTO:
+        signals = classify_query(request.query)
+        score = sum(signals.values())
+        pro = PRO_MODE_ENABLED and score >= ROUTER_PRO_SCORE_THRESHOLD
+        mode = SearchMode.PRO if pro else SearchMode.SIMPLE
+    else:
+        mode = requested
+
+    return RoutingDecision(mode=mode, requested=requested, score=score, signals=signals)
+
+
+def _count_route(decision: RoutingDecision) -> None:
+    metrics.increment(f"routing.{decision.requested.value}.{decision.mode.value}")
+    print(
+        f"🧭 Routing {decision.requested.value} -> {decision.mode.value} "
+        f"(score {decision.score:g}, signals {decision.signals})"
+    )
+
+
+def route_request(request: ChatRequest) -> RoutingDecision:
+    """Decide whether ``request`` runs simple chat or pro search."""
+    decision = decide_route(request)
+    _count_route(decision)
+    return decision
+
+
+def shape_final_response(event: ChatResponseEvent, mode: FinalResponseMode) -> Optional[ChatResponseEvent]:
+    """The final-response event in the form the client asked for, or None to leave it out."""
+    if mode == FinalResponseMode.FULL:
+        return event
+    if mode == FinalResponseMode.OMIT:
+        return None
+    message = event.data.message or ""
+    return ChatResponseEvent(
+        event=StreamEvent.FINAL_RESPONSE,
+        data=FinalResponseStream(digest=hashlib.sha256(message.encode()).hexdigest(), length=len(message)),
+    )
+
+
+def _record_outcome(request: ChatRequest, decision: RoutingDecision, outcome: Dict) -> None:
+    key = f"routing.outcome.{decision.requested.value}.{decision.mode.value}"
+    metrics.increment(f"{key}.{outcome['status']}")
+    metrics.increment(f"{key}.seconds", outcome["seconds"])
+    metrics.increment("routing.responses")
+    metrics.increment("routing.cpu_seconds", outcome["cpu_seconds"])
+    print(f"🧭 Routed {decision.mode.value} request {outcome['status']} in {outcome['seconds']:.2f}s")
+
+    if not ROUTING_LOG_FILE:
+        return
+    record = {
+        "time": time.time(),
+        "query": request.query,
+        **decision.model_dump(mode="json"),
+        **outcome,
+    }
+    try:
+        with open(ROUTING_LOG_FILE, "a") as log_file:
+            log_file.write(json.dumps(record) + "\n")
+    except OSError as e:
+        print(f"Could not write routing log: {e}")
+
+
+def cached_response(request: ChatRequest) -> Optional[AsyncIterator[ChatResponseEvent]]:
+    """
+    The cached answer to ``request`` replayed, or None when there is none.
+
+    Meant to be checked before admission: a replay costs nothing upstream, so
+    it needn't wait for a pipeline slot, and the request hasn't been degraded
+    yet, so it is looked up under the options the client asked for.
+    """
+    decision = decide_route(request)
+    cached_events = lookup_answer(request, decision.mode)
+    if cached_events is None:
+        return None
+    _count_route(decision)
+    return _track_outcome(request, decision, replay_answer(cached_events), cached=True)
+
+
+async def stream_routed_response(
+    request: ChatRequest, session=None, user: Optional[AuthenticatedUser] = None, lookup_cache: bool = True
+) -> AsyncIterator[ChatResponseEvent]:
+    """
+    Stream the response of the pipeline chosen by ``route_request``, recording its outcome.
+
+    A cached answer to the same question is replayed instead when there is one
+    (unless ``lookup_cache`` is off, for requests ``cached_response`` already
+    looked up), and an identical request that is still running is joined.
+    """
+    decision = route_request(request)
+    cached_events = lookup_answer(request, decision.mode) if lookup_cache else None
+    if cached_events is not None:
+        stream = replay_answer(cached_events)
+    else:
+        stream_fn = stream_pro_search_qa if decision.mode == SearchMode.PRO else stream_qa_objects
+        # Identical requests already being answered share that pipeline
+        stream = coalesce(
+            request,
+            decision.mode,
+            lambda: record_answer(request, decision.mode, stream_fn(request=request, session=session, user=user)),
+        )
+    async for event in _track_outcome(request, decision, stream, cached=cached_events is not None):
+        yield event
+
+
+async def admit_routed_response(
+    request: ChatRequest,
+    flow: str,
+    weight: Optional[float] = None,
+    session=None,
+    user: Optional[AuthenticatedUser] = None,
+) -> Tuple[AdmissionTicket, AsyncIterator[ChatResponseEvent]]:
+    """
+    The admission ticket and routed response stream of ``request``.
+
+    A cached answer is replayed on a ticket holding no slot. Otherwise the
+    request is admitted, which may degrade it, and the cache is checked again
+    only if that changed its key. Either way, answers are cached under the
+    options of the request that actually ran, so a degraded answer is never
+    served to a full-quality request.
+    """
+    stream = cached_response(request)
+    if stream is not None:
+        return free_ticket(), stream
+    requested = request.model_copy()
+    ticket = await admit(request, flow, weight)
+    return ticket, stream_routed_response(request, session, user, lookup_cache=request != requested)
+
+
+async def _track_outcome(
+    request: ChatRequest, decision: RoutingDecision, stream: AsyncIterator[ChatResponseEvent], cached: bool
+) -> AsyncIterator[ChatResponseEvent]:
+    """Pass ``stream`` through in the client's final response form, recording its outcome."""
+    started = time.monotonic()
+    # Event loop thread time: exact for a lone request, an upper bound under concurrency
+    cpu_started = time.thread_time()
+    first_token: Optional[float] = None
+    status = "abandoned"
+    try:
+        async for event in stream:
+            if first_token is None and event.event == StreamEvent.TEXT_CHUNK:
+                first_token = time.monotonic() - started
+            if event.event == StreamEvent.STREAM_END:
+                status = "completed"
+            elif event.event == StreamEvent.FINAL_RESPONSE:
+                # Caches and shared pipelines keep the full event, each client gets its own form
+                event = shape_final_response(event, request.final_response)
+                if event is None:
+                    continue
+            yield event
+    except Exception:
+        status = "failed"
+        raise
+    finally:
+        _record_outcome(
+            request,
+            decision,
+            {
+                "status": status,
+                "seconds": time.monotonic() - started,
+                "first_token_seconds": first_token,
+                "cpu_seconds": time.thread_time() - cpu_started,
+                "cached": cached,
+            },
+        )
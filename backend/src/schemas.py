@@ -1,10 +1,10 @@
 import os
 from enum import Enum
-from typing import List, Union
+from typing import List, Optional, Union
 
 from dotenv import load_dotenv
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 from utils import strtobool
 
@@ -24,6 +24,18 @@ class Message(BaseModel):
 LOCAL_MODELS_ENABLED = strtobool(os.getenv("ENABLE_LOCAL_MODELS", False))
 
 
+class SearchMode(str, Enum):
+    SIMPLE = "simple"
+    PRO = "pro"
+    AUTO = "auto"  # Let the local complexity router choose
+
+
+class FinalResponseMode(str, Enum):
+    FULL = "full"  # The whole answer again
+    DIGEST = "digest"  # Its sha256 digest and length, to check the streamed text
+    OMIT = "omit"  # No final-response event
+
+
 class ChatRequest(BaseModel):
     thread_id: int | None = None  # Deprecated: use session_id instead
     session_id: str | None = Field(
@@ -33,6 +45,10 @@ class ChatRequest(BaseModel):
     query: str
     # history parameter removed - Lyzr manages conversation history via session_id
     pro_search: bool = False
+    search_mode: SearchMode | None = Field(
+        default=None,
+        description="simple, pro or auto (routed by query complexity). Overrides pro_search when set."
+    )
     time_range: str | None = None  # SearXNG time filter: "day", "week", "month", "year"
     start_date: str | None = Field(
         default=None,
@@ -43,12 +59,25 @@ class ChatRequest(BaseModel):
         description="End date for custom date range (format: YYYY-MM-DD). Appends 'before:' operator to query."
     )
     max_results: int = Field(default=10, ge=1, le=100)  # Number of results per query
+    related_queries: bool = Field(
+        default=True,
+        description="Generate follow-up questions. Turned off by admission control under load."
+    )
+    final_response: FinalResponseMode = Field(
+        default=FinalResponseMode.FULL,
+        description="full, digest or omit: how the answer already streamed as text chunks is repeated at the end."
+    )
 
 
 class RelatedQueries(BaseModel):
     related_questions: List[str] = Field(..., min_length=3, max_length=3)
 
 
+class QueryUnderstanding(BaseModel):
+    standalone_question: str
+    search_terms: str
+
+
 class SearchResult(BaseModel):
     title: str
     url: str
@@ -134,7 +163,9 @@ class StreamEndStream(ChatObject):
 
 class FinalResponseStream(ChatObject):
     event_type: StreamEvent = StreamEvent.FINAL_RESPONSE
-    message: str
+    message: str | None = None  # Left out when the client asked for a digest
+    digest: str | None = None  # sha256 hex digest of the message
+    length: int | None = None  # Characters in the message
 
 
 class ErrorStream(ChatObject):
@@ -194,6 +225,8 @@ class ChatResponseEvent(BaseModel):
         AgentFinishStream,
         AgentSearchFullResponseStream,
     ]
+    # Server-sent event bytes, encoded once for every client the event is sent to
+    _sse: Optional[bytes] = PrivateAttr(default=None)
 
 
 class ChatMessage(BaseModel):
@@ -0,0 +1,328 @@
+"""
+Optional enrichment of the top search results with their pages' main text.
+
+SearXNG only returns short snippets. When PAGE_FETCH_ENABLED is set, the top
+results' pages are fetched concurrently over a pooled client (bounded by a
+semaphore and an overall deadline), their main text is extracted in a
+worker process pool, and the extracted documents are cached by URL. Results
+whose page could not be fetched in time keep their snippet.
+
+Result URLs come from the web, so only http(s) pages on public addresses are
+fetched. The client's connections resolve the host, check every address and
+connect to the checked one, so a DNS answer can't change between the check
+and the connection; this holds for every redirect too, which are followed by
+hand so their scheme is checked as well. PAGE_FETCH_ALLOWED_NETWORKS lets
+through extra networks, e.g. a local stand-in site for tests.
+"""
+
+import asyncio
+import ipaddress
+import multiprocessing
+import os
+import socket
+from concurrent.futures import Executor, ProcessPoolExecutor
+from html.parser import HTMLParser
+from typing import Iterable, List, Optional
+
+import httpcore
+import httpx
+from dotenv import load_dotenv
+
+from cache import TTLCache
+from schemas import SearchResult
+from traffic import httpx_transport
+from utils import strtobool
+
+load_dotenv()
+
+PAGE_FETCH_ENABLED = strtobool(os.getenv("PAGE_FETCH_ENABLED", "false"))
+PAGE_FETCH_TOP_K = int(os.getenv("PAGE_FETCH_TOP_K", "3"))
+PAGE_FETCH_CONCURRENCY = int(os.getenv("PAGE_FETCH_CONCURRENCY", "8"))
+PAGE_FETCH_DEADLINE = float(os.getenv("PAGE_FETCH_DEADLINE", "2.5"))  # seconds for the whole stage
+PAGE_FETCH_MAX_BYTES = int(os.getenv("PAGE_FETCH_MAX_BYTES", str(1024 * 1024)))
+PAGE_TEXT_MAX_CHARS = int(os.getenv("PAGE_TEXT_MAX_CHARS", "8000"))
+PAGE_EXTRACT_WORKERS = int(os.getenv("PAGE_EXTRACT_WORKERS", "2"))
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "3600"))
+PAGE_CACHE_MAX_ENTRIES = int(os.getenv("PAGE_CACHE_MAX_ENTRIES", "1000"))
+# Comma-separated networks fetched from besides the public ones, e.g. "127.0.0.1/32"
+PAGE_FETCH_ALLOWED_NETWORKS = [
+    ipaddress.ip_network(network.strip(), strict=False)
+    for network in os.getenv("PAGE_FETCH_ALLOWED_NETWORKS", "").split(",")
+    if network.strip()
+]
+
+# Failed fetches are remembered briefly so popular dead links are not retried per request
+PAGE_FAILURE_TTL = 300.0
+PAGE_FETCH_MAX_REDIRECTS = 5
+
+# Blocks of fewer words than this are navigation, captions or boilerplate
+MIN_BLOCK_WORDS = 8
+
+_SKIPPED_TAGS = {
+    "script", "style", "noscript", "template", "svg", "iframe", "form",
+    "nav", "header", "footer", "aside", "button", "select",
+}
+_BLOCK_TAGS = {
+    "p", "div", "section", "article", "main", "li", "ul", "ol", "table", "tr", "td",
+    "th", "blockquote", "pre", "h1", "h2", "h3", "h4", "h5", "h6", "br", "dd", "dt",
+}
+_HEADING_TAGS = {"h1", "h2", "h3", "h4", "h5", "h6"}
+
+
+class _MainTextParser(HTMLParser):
+    """Collects text blocks, skipping boilerplate elements and link-heavy blocks."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.blocks: List[str] = []
+        self._skip_depth = 0
+        self._parts: List[str] = []
+        self._link_chars = 0
+        self._in_link = 0
+        self._in_heading = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+            self._in_heading = tag in _HEADING_TAGS
+        elif tag == "a":
+            self._in_link += 1
+
+    def handle_endtag(self, tag):
+        if tag in _SKIPPED_TAGS:
+            self._skip_depth = max(self._skip_depth - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self._flush()
+        elif tag == "a":
+            self._in_link = max(self._in_link - 1, 0)
+
+    def handle_data(self, data):
+        if self._skip_depth or not data.strip():
+            return
+        self._parts.append(data)
+        if self._in_link:
+            self._link_chars += len(data.strip())
+
+    def _flush(self):
+        text = " ".join(" ".join(self._parts).split())
+        is_heading = self._in_heading
+        link_chars = self._link_chars
+        self._parts, self._link_chars, self._in_heading = [], 0, False
+        if not text:
+            return
+        if link_chars > len(text) / 2:
+            return
+        if is_heading or len(text.split()) >= MIN_BLOCK_WORDS:
+            self.blocks.append(text)
+
+    def close(self):
+        super().close()
+        self._flush()
+
+
+def extract_main_text(html: str, max_chars: int = PAGE_TEXT_MAX_CHARS) -> str:
+    """Extract the readable main text of an HTML document (runs in the worker pool)."""
+    parser = _MainTextParser()
+    try:
+        parser.feed(html)
+        parser.close()
+    except Exception:
+        pass
+    # Drop trailing headings that introduce nothing
+    blocks = parser.blocks
+    while blocks and len(blocks[-1].split()) < MIN_BLOCK_WORDS:
+        blocks.pop()
+    return "\n".join(blocks)[:max_chars]
+
+
+_client: Optional[httpx.AsyncClient] = None
+_executor: Optional[Executor] = None
+_page_cache: TTLCache[str, str] = TTLCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_TTL)
+# Shared by all requests, so the bound holds for the whole process
+_fetch_semaphore = asyncio.Semaphore(PAGE_FETCH_CONCURRENCY)
+
+
+class BlockedURLError(Exception):
+    """The URL is not an http(s) page on a public address"""
+
+
+def is_allowed_address(address: str, allowed_networks: Iterable = ()) -> bool:
+    """Whether ``address`` is public (not private, loopback, link-local, reserved or multicast) or allowed."""
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if isinstance(ip, ipaddress.IPv6Address) and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    if any(ip in network for network in allowed_networks):
+        return True
+    return ip.is_global and not ip.is_multicast
+
+
+def check_url_scheme(url: httpx.URL) -> None:
+    """Raise BlockedURLError unless ``url`` is an http(s) URL with a host."""
+    if url.scheme not in ("http", "https") or not url.host:
+        raise BlockedURLError(f"unsupported URL {url}")
+
+
+class PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """
+    Connects only to the addresses a host resolves to that are public or allowed.
+
+    The addresses checked are the ones connected to, with no second lookup in
+    between. TLS is still verified against the host name, which httpcore
+    hands to the TLS handshake separately.
+    """
+
+    def __init__(self, allowed_networks: Iterable = (), backend: httpcore.AsyncNetworkBackend = None):
+        self.allowed_networks = list(allowed_networks)
+        self._backend = backend or httpcore.AnyIOBackend()
+
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        infos = await asyncio.wait_for(
+            asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM), timeout
+        )
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+        if not addresses or not all(is_allowed_address(address, self.allowed_networks) for address in addresses):
+            raise BlockedURLError(f"{host} is not a public address")
+        error: Optional[Exception] = None
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        raise BlockedURLError("pages are not fetched over unix sockets")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+def create_client(allowed_networks: Iterable = PAGE_FETCH_ALLOWED_NETWORKS) -> httpx.AsyncClient:
+    """A page fetching client connecting only to public addresses and ``allowed_networks``."""
+    transport = httpx.AsyncHTTPTransport()
+    # httpx doesn't take a network backend, so its connection pool is replaced by one with ours
+    transport._pool = httpcore.AsyncConnectionPool(
+        ssl_context=httpx.create_ssl_context(),
+        max_connections=PAGE_FETCH_CONCURRENCY * 4,
+        max_keepalive_connections=PAGE_FETCH_CONCURRENCY * 2,
+        keepalive_expiry=5.0,
+        network_backend=PublicAddressBackend(allowed_networks),
+    )
+    return httpx.AsyncClient(
+        timeout=httpx.Timeout(PAGE_FETCH_DEADLINE, connect=min(PAGE_FETCH_DEADLINE, 2.0)),
+        # Redirects are followed by fetch_page_text, checking every hop
+        follow_redirects=False,
+        headers={"User-Agent": "Mozilla/5.0 (compatible; PerplexityOSS/1.0)"},
+        transport=httpx_transport("pages", transport),
+    )
+
+
+def get_client() -> httpx.AsyncClient:
+    """Shared client so page fetches reuse pooled connections across requests."""
+    global _client
+    if _client is None:
+        _client = create_client()
+    return _client
+
+
+def get_executor() -> Executor:
+    """Worker processes for HTML extraction, kept off the event loop and the GIL."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=PAGE_EXTRACT_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+async def _fetch_html(url: str, client: httpx.AsyncClient) -> Optional[str]:
+    """The HTML of ``url`` after following its redirects, or None if it isn't an HTML page."""
+    request = client.build_request("GET", url)
+    for _ in range(PAGE_FETCH_MAX_REDIRECTS + 1):
+        check_url_scheme(request.url)
+        response = await client.send(request, stream=True)
+        try:
+            if response.is_redirect and response.next_request is not None:
+                request = response.next_request
+                continue
+            content_type = response.headers.get("content-type", "")
+            if response.status_code != 200 or "html" not in content_type:
+                return None
+
+            body = bytearray()
+            async for chunk in response.aiter_bytes():
+                body.extend(chunk)
+                if len(body) >= PAGE_FETCH_MAX_BYTES:
+                    break
+            return bytes(body).decode(response.encoding or "utf-8", errors="replace")
+        finally:
+            await response.aclose()
+    raise httpx.TooManyRedirects(f"more than {PAGE_FETCH_MAX_REDIRECTS} redirects", request=request)
+
+
+async def fetch_page_text(url: str, client: httpx.AsyncClient) -> Optional[str]:
+    """Fetch ``url`` and return its main text, or None if it is unavailable."""
+    cached = _page_cache.get(url)
+    if cached is not None:
+        return cached or None
+
+    try:
+        async with _fetch_semaphore:
+            html = await _fetch_html(url, client)
+        if html is None:
+            _page_cache.set(url, "", ttl_seconds=PAGE_FAILURE_TTL)
+            return None
+
+        loop = asyncio.get_running_loop()
+        text = await loop.run_in_executor(get_executor(), extract_main_text, html, PAGE_TEXT_MAX_CHARS)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Failed to fetch page {url}: {type(e).__name__} {e}")
+        _page_cache.set(url, "", ttl_seconds=PAGE_FAILURE_TTL)
+        return None
+
+    _page_cache.set(url, text)
+    return text or None
+
+
+async def enrich_search_results(
+    results: List[SearchResult],
+    top_k: int = PAGE_FETCH_TOP_K,
+    deadline: float = PAGE_FETCH_DEADLINE,
+    client: httpx.AsyncClient = None,
+    enabled: bool = PAGE_FETCH_ENABLED,
+) -> List[SearchResult]:
+    """
+    Return ``results`` with the top ``top_k`` snippets extended by their page's main text.
+
+    Pages not fetched and extracted within ``deadline`` seconds are skipped;
+    the input list is returned unchanged when enrichment is disabled.
+    """
+    if not enabled or not results or top_k <= 0:
+        return results
+
+    client = client or get_client()
+    tasks = {
+        asyncio.create_task(fetch_page_text(result.url, client)): index
+        for index, result in enumerate(results[:top_k])
+    }
+    done, pending = await asyncio.wait(tasks.keys(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+
+    enriched = list(results)
+    for task in done:
+        if task.cancelled() or task.exception() is not None:
+            continue
+        text = task.result()
+        if text:
+            index = tasks[task]
+            result = results[index]
+            enriched[index] = result.model_copy(update={"content": f"{result.content}\n{text}"})
+
+    print(f"📄 Enriched {sum(1 for a, b in zip(enriched, results) if a is not b)}/{len(tasks)} results with page text")
+    return enriched
@@ -2,8 +2,10 @@ import asyncio
 
 import httpx
 
+from metrics import metrics
 from schemas import SearchResponse, SearchResult
 from search.providers.base import SearchProvider
+from traffic import httpx_transport
 
 
 class SearxngSearchProvider(SearchProvider):
@@ -11,7 +13,14 @@ class SearxngSearchProvider(SearchProvider):
         self.host = host
 
     async def search(self, query: str, time_range: str = None, num_results: int = 10) -> SearchResponse:
-        async with httpx.AsyncClient(timeout=10.0) as client:
+        """
+        Search SearXNG for ``query``.
+
+        Errors are logged, counted as ``search.errors`` and answered with an
+        empty response, so a SearXNG hiccup degrades the answer instead of
+        failing the request. Empty responses are never cached.
+        """
+        async with httpx.AsyncClient(timeout=10.0, transport=httpx_transport("searxng")) as client:
             try:
                 link_results = await self.get_link_results(client, query, num_results=num_results, time_range=time_range)
                 # Skip image results to avoid timeout issues
@@ -54,6 +63,7 @@ class SearxngSearchProvider(SearchProvider):
                 if result.get("url")  # Only include results with URLs
             ]
         except Exception as e:
+            metrics.increment("search.errors")
             print(f"Failed to get link results: {e}")
             return []
 
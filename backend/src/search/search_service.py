@@ -1,16 +1,48 @@
 """
 Simplified search service using only SearXNG provider.
+
+Responses are kept in a process-wide TTL cache, so speculative searches and
+repeated step queries are answered without another SearXNG round trip.
+Paraphrased queries are answered from a ``SemanticCache`` tier checked after
+the exact key, and identical queries arriving while one is still being
+searched wait for that search instead of starting their own.
 """
 
+import asyncio
 import os
+from typing import Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
 from dotenv import load_dotenv
 from fastapi import HTTPException
 
+from cache import TTLCache
+from metrics import metrics
 from schemas import SearchResponse
 from search.providers.searxng import SearxngSearchProvider
+from semantic_cache import SEMANTIC_CACHE_ENABLED, SemanticCache
+from utils import strtobool
 
 load_dotenv()
 
+SEARCH_CACHE_ENABLED = strtobool(os.getenv("SEARCH_CACHE_ENABLED", "true"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "300"))
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "1000"))
+
+SearchCacheKey = Tuple[str, Optional[str], int]
+
+_search_cache: TTLCache[SearchCacheKey, SearchResponse] = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL)
+_semantic_search_cache: SemanticCache[SearchResponse] = SemanticCache(
+    "search", SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_TTL
+)
+
+_in_flight_searches: Dict[SearchCacheKey, "asyncio.Task[SearchResponse]"] = {}
+
+metrics.register_rate("search_cache.hit_rate", "search_cache.hits", "search_cache.lookups")
+
+# Query parameters that only track where a click came from
+_TRACKING_PARAMS = frozenset({"fbclid", "gclid", "msclkid", "mc_cid", "mc_eid", "ref", "ref_src"})
+
 
 def get_searxng_base_url():
     """Get SearXNG base URL from environment variables."""
@@ -29,6 +61,27 @@ def get_search_provider() -> SearxngSearchProvider:
     return SearxngSearchProvider(searxng_base_url)
 
 
+def canonical_url(url: str) -> str:
+    """
+    ``url`` without what doesn't change the page: scheme, ``www.``, fragment,
+    tracking parameters, parameter order and a trailing slash.
+    """
+    parts = urlsplit(url.strip())
+    host = parts.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    params = sorted(
+        (name, value)
+        for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith("utm_") and name.lower() not in _TRACKING_PARAMS
+    )
+    return urlunsplit(("", host, parts.path.rstrip("/"), urlencode(params), ""))
+
+
+def search_cache_key(query: str, time_range: str = None, num_results: int = 10) -> SearchCacheKey:
+    return " ".join(query.lower().split()), time_range or None, num_results
+
+
 async def perform_search(query: str, time_range: str = None, num_results: int = 10) -> SearchResponse:
     """
     Perform search using SearXNG provider.
@@ -41,10 +94,44 @@ async def perform_search(query: str, time_range: str = None, num_results: int =
     Returns:
         SearchResponse object containing search results
     """
+    key = search_cache_key(query, time_range, num_results)
+    if SEARCH_CACHE_ENABLED:
+        metrics.increment("search_cache.lookups")
+        cached = _search_cache.get(key)
+        if cached is None and SEMANTIC_CACHE_ENABLED:
+            cached = _semantic_search_cache.get(query, (time_range or None, num_results))
+        if cached is not None:
+            metrics.increment("search_cache.hits")
+            return cached
+
+    search = _in_flight_searches.get(key)
+    if search is None:
+        search = _in_flight_searches[key] = asyncio.create_task(_search(query, time_range, num_results))
+        search.add_done_callback(lambda task: _search_done(key, task))
+    else:
+        metrics.increment("search_cache.joined")
+    # A caller that is cancelled must not cancel the search for the others
+    return await asyncio.shield(search)
+
+
+def _search_done(key: SearchCacheKey, task: "asyncio.Task[SearchResponse]") -> None:
+    if _in_flight_searches.get(key) is task:
+        del _in_flight_searches[key]
+    # Searches whose callers were all cancelled may fail without anyone awaiting them
+    if not task.cancelled():
+        task.exception()
+
+
+async def _search(query: str, time_range: str = None, num_results: int = 10) -> SearchResponse:
     search_provider = get_search_provider()
 
     try:
         results = await search_provider.search(query, time_range=time_range, num_results=num_results)
+        # An empty response may be a SearXNG hiccup; it is not worth keeping for the TTL
+        if SEARCH_CACHE_ENABLED and results.results:
+            _search_cache.set(search_cache_key(query, time_range, num_results), results)
+            if SEMANTIC_CACHE_ENABLED:
+                _semantic_search_cache.set(query, results, (time_range or None, num_results))
         return results
     except Exception as e:
         print(f"Search error: {str(e)}")
@@ -0,0 +1,244 @@
+"""
+Similarity-based cache tier for paraphrased queries.
+
+Exact caches miss paraphrases such as "who is the ceo of openai" and "openai
+ceo". Queries are embedded locally by hashing their content words and
+character n-grams into a fixed-size vector (no external model), and the
+vectors of cached queries are rows of a NumPy matrix, so a lookup is one
+matrix-vector product. A cached value is reused when the best cosine
+similarity reaches SEMANTIC_CACHE_THRESHOLD.
+
+Search operators (``site:``, ``after:``) and tokens containing digits are not
+embedded but must match exactly, so "python 3.11" never reuses an answer about
+"python 3.12". The matrix has a fixed number of rows; expired entries are
+overwritten first, then the least recently used.
+
+The embedding ignores word order, so order is checked separately: the words
+following "than" and "from" must match exactly, and the content words two
+queries share must come in the same order unless one of them has a
+preposition such as "of" or "for" that explains the reordering ("ceo of
+openai" and "openai ceo"). "is java faster than python" therefore never
+reuses the answer to "is python faster than java".
+
+The tier is off unless SEMANTIC_CACHE_ENABLED is set, since a false hit
+serves a confident answer to another question.
+
+Hits and near misses (similarities within SEMANTIC_CACHE_LOG_MARGIN below the
+threshold) are counted in the metrics and, with SEMANTIC_CACHE_LOG_FILE set,
+appended as JSON lines; labelling the logged hits gives the precision of the
+threshold and labelling the near misses its recall.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+import zlib
+from typing import Generic, Hashable, List, Optional, Tuple, TypeVar
+
+import numpy as np
+
+from metrics import metrics
+from query_analyzer import STOP_WORDS
+from utils import strtobool
+
+SEMANTIC_CACHE_ENABLED = strtobool(os.getenv("SEMANTIC_CACHE_ENABLED", "false"))
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.9"))
+SEMANTIC_CACHE_DIMENSIONS = int(os.getenv("SEMANTIC_CACHE_DIMENSIONS", "1024"))
+SEMANTIC_CACHE_LOG_FILE = os.getenv("SEMANTIC_CACHE_LOG_FILE")
+SEMANTIC_CACHE_LOG_MARGIN = float(os.getenv("SEMANTIC_CACHE_LOG_MARGIN", "0.1"))
+
+NGRAM_SIZES = (3, 4)
+
+_TOKEN_RE = re.compile(r"\S+:\S+|\w+", re.UNICODE)
+# Stop words that change what is being asked
+_KEPT_WORDS = frozenset("no nor not before after against over under between more most few".split())
+# Words whose following content word is part of the question's meaning by position
+_ANCHOR_WORDS = frozenset("than from".split())
+# Prepositions that let a query reorder another's words ("ceo of openai", "openai ceo")
+_REORDER_WORDS = frozenset("of for in on at by with about".split())
+
+V = TypeVar("V")
+
+
+def query_features(query: str) -> Tuple[List[str], Tuple[str, ...], bool]:
+    """
+    The words of ``query`` to embed, the tokens that must match exactly, and
+    whether it has a preposition allowing another query to reorder its words.
+    """
+    words: List[str] = []
+    exact = set()
+    reorderable = False
+    anchor = None
+    for token in _TOKEN_RE.findall(query.lower()):
+        if ":" in token or any(char.isdigit() for char in token):
+            exact.add(token)
+        elif token in _ANCHOR_WORDS:
+            anchor = token
+        elif token not in STOP_WORDS or token in _KEPT_WORDS:
+            words.append(token)
+            if anchor is not None:
+                # "than java" and "than python" ask different questions
+                exact.add(f"{anchor}>{token}")
+                anchor = None
+        reorderable = reorderable or token in _REORDER_WORDS
+    return words, tuple(sorted(exact)), reorderable
+
+
+def same_word_order(first: List[str], second: List[str]) -> bool:
+    """Whether the words ``first`` and ``second`` share come in the same order."""
+    shared = set(first) & set(second)
+    return [word for word in dict.fromkeys(first) if word in shared] == [
+        word for word in dict.fromkeys(second) if word in shared
+    ]
+
+
+def embed_words(words: List[str], dimensions: int = SEMANTIC_CACHE_DIMENSIONS) -> np.ndarray:
+    """L2-normalised hashed bag of words and character n-grams, with sublinear counts."""
+    features = []
+    for word in words:
+        features.append(f"w:{word}")
+        padded = f" {word} "
+        for n in NGRAM_SIZES:
+            features.extend(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+    vector = np.zeros(dimensions, dtype=np.float32)
+    if not features:
+        return vector
+    # crc32 rather than hash() so vectors don't depend on the process' hash seed
+    ids = np.fromiter((zlib.crc32(feature.encode()) % dimensions for feature in features), dtype=np.int64)
+    np.add.at(vector, ids, 1.0)
+    np.log1p(vector, out=vector)
+    vector /= np.linalg.norm(vector)
+    return vector
+
+
+class SemanticCache(Generic[V]):
+    """
+    Fixed-capacity cache looked up by query similarity within a scope.
+
+    Only entries stored with an equal ``scope`` (for instance the search mode
+    and date filters) can answer a lookup. Thread-safe.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_entries: int = 1024,
+        ttl_seconds: float = 300.0,
+        threshold: float = SEMANTIC_CACHE_THRESHOLD,
+        dimensions: int = SEMANTIC_CACHE_DIMENSIONS,
+    ):
+        """
+        Initialize the cache.
+
+        Args:
+            name: Name used in the metrics and the log
+            max_entries: Rows of the vector matrix
+            ttl_seconds: Lifetime of an entry in seconds
+            threshold: Lowest cosine similarity of a hit
+            dimensions: Length of the query vectors
+        """
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        self.dimensions = dimensions
+        self._vectors = np.zeros((max_entries, dimensions), dtype=np.float32)
+        self._scope_hashes = np.zeros(max_entries, dtype=np.int64)
+        # Empty rows count as expired
+        self._expires = np.full(max_entries, -np.inf)
+        self._last_used = np.zeros(max_entries)
+        # query, scope, value, whether the query's words may be reordered, its words
+        self._entries: List[Optional[Tuple[str, Hashable, V, bool, List[str]]]] = [None] * max_entries
+        self._lock = threading.Lock()
+        metrics.register_rate(
+            f"semantic_cache.{name}.hit_rate", f"semantic_cache.{name}.hits", f"semantic_cache.{name}.lookups"
+        )
+
+    def get(self, query: str, scope: Hashable = None) -> Optional[V]:
+        """Return the value of the most similar cached query, or None below the threshold."""
+        words, exact, reorderable = query_features(query)
+        if not words:
+            return None
+        vector = embed_words(words, self.dimensions)
+        scope = (scope, exact)
+        now = time.monotonic()
+
+        with self._lock:
+            similarities = self._vectors @ vector
+            similarities[(self._scope_hashes != hash(scope)) | (self._expires < now)] = -1.0
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            entry = self._entries[best]
+            if entry is None or entry[1] != scope:
+                similarity = -1.0
+            hit = similarity >= self.threshold
+            reordered = hit and not (
+                reorderable or entry[3] or same_word_order(words, entry[4])
+            )
+            hit = hit and not reordered
+            if hit:
+                self._last_used[best] = now
+
+        metrics.increment(f"semantic_cache.{self.name}.lookups")
+        if reordered:
+            metrics.increment(f"semantic_cache.{self.name}.reordered")
+            print(f"🧲 Semantic {self.name} cache miss, words reordered: '{query}' ~ '{entry[0]}'")
+            self._log(query, entry[0], similarity, hit)
+            return None
+        if hit:
+            metrics.increment(f"semantic_cache.{self.name}.hits")
+            print(f"🧲 Semantic {self.name} cache hit ({similarity:.2f}): '{query}' ~ '{entry[0]}'")
+        elif similarity >= self.threshold - SEMANTIC_CACHE_LOG_MARGIN:
+            metrics.increment(f"semantic_cache.{self.name}.near_misses")
+        else:
+            return None
+        self._log(query, entry[0], similarity, hit)
+        return entry[2] if hit else None
+
+    def set(self, query: str, value: V, scope: Hashable = None, ttl_seconds: Optional[float] = None) -> None:
+        """Store ``value`` under ``query``, replacing an expired or the least recently used entry."""
+        words, exact, reorderable = query_features(query)
+        if not words:
+            return
+        vector = embed_words(words, self.dimensions)
+        scope = (scope, exact)
+        now = time.monotonic()
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+
+        with self._lock:
+            expired = np.flatnonzero(self._expires < now)
+            if len(expired):
+                slot = int(expired[0])
+            else:
+                slot = int(np.argmin(self._last_used))
+                metrics.increment(f"semantic_cache.{self.name}.evictions")
+            self._vectors[slot] = vector
+            self._scope_hashes[slot] = hash(scope)
+            self._expires[slot] = now + ttl
+            self._last_used[slot] = now
+            self._entries[slot] = (query, scope, value, reorderable, words)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._expires[:] = -np.inf
+            self._entries = [None] * self.max_entries
+
+    def _log(self, query: str, matched: str, similarity: float, hit: bool) -> None:
+        if not SEMANTIC_CACHE_LOG_FILE:
+            return
+        record = {
+            "time": time.time(),
+            "cache": self.name,
+            "query": query,
+            "matched": matched,
+            "similarity": round(similarity, 4),
+            "hit": hit,
+        }
+        try:
+            with open(SEMANTIC_CACHE_LOG_FILE, "a") as log_file:
+                log_file.write(json.dumps(record) + "\n")
+        except OSError as e:
+            print(f"Could not write semantic cache log: {e}")
@@ -0,0 +1,436 @@
+"""
+Record/replay harness for upstream traffic (Lyzr agents and SearXNG).
+
+TRAFFIC_MODE selects the behaviour:
+    off     - talk to the upstreams directly (default, zero overhead)
+    record  - talk to the upstreams and append every exchange (request payload,
+              status, headers, exact response chunks and their timing) to
+              TRAFFIC_DIR/<request_id>.jsonl
+    replay  - never touch the network; answer every upstream call from the
+              recordings in TRAFFIC_DIR, paced at TRAFFIC_REPLAY_SPEED
+              (1 = original timing, 10 = ten times faster, 0 = instant)
+
+Both upstream clients plug in through drop-in transports: the Lyzr client
+opens its POSTs through ``aiohttp_post`` and the SearXNG client passes
+``httpx_transport`` to its ``httpx.AsyncClient``.
+
+Replayed exchanges are matched on a key built from the service, method, URL
+and request body with volatile fields (session ids, user ids, timestamps)
+masked, so the same pipeline input maps onto the same recording.
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TRAFFIC_MODE = os.getenv("TRAFFIC_MODE", "off").strip().lower()
+TRAFFIC_DIR = Path(os.getenv("TRAFFIC_DIR", "/tmp/perplexity-traffic"))
+TRAFFIC_REPLAY_SPEED = float(os.getenv("TRAFFIC_REPLAY_SPEED", "1"))
+
+if TRAFFIC_MODE not in ("off", "record", "replay"):
+    print(f"⚠️ Unknown TRAFFIC_MODE '{TRAFFIC_MODE}', upstream traffic will not be recorded")
+    TRAFFIC_MODE = "off"
+
+# Request payload fields that differ between otherwise identical runs
+VOLATILE_FIELDS = {"session_id", "user_id"}
+
+# Matches the "%A, %B %d, %Y %I:%M %p" timestamps we put into prompts
+_DATETIME_RE = re.compile(
+    r"\b(?:Monday|Tuesday|Wednesday|Thursday|Friday|Saturday|Sunday), "
+    r"[A-Z][a-z]+ \d{1,2}, \d{4} \d{1,2}:\d{2} [AP]M\b"
+)
+
+_request_id: ContextVar[str] = ContextVar("traffic_request_id", default="unscoped")
+
+
+class TrafficReplayMiss(Exception):
+    """Raised in replay mode when no recording matches an upstream request."""
+
+
+def bind_request(request_id: str) -> None:
+    """Attribute upstream exchanges made from the current context to ``request_id``."""
+    _request_id.set(request_id)
+
+
+def _canonical_url(url: str) -> str:
+    parts = urlsplit(str(url))
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{parts.path}?{query}" if query else parts.path
+
+
+def exchange_key(service: str, method: str, url: str, body: Any = None) -> str:
+    """Stable identity of an upstream request, ignoring volatile fields."""
+    if isinstance(body, dict):
+        body = {k: v for k, v in body.items() if k not in VOLATILE_FIELDS}
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", errors="replace")
+    canonical = json.dumps(body, sort_keys=True, default=str)
+    canonical = _DATETIME_RE.sub("<datetime>", canonical)
+    raw = f"{service} {method.upper()} {_canonical_url(url)} {canonical}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class Exchange:
+    """One upstream request/response pair with chunk-level timing."""
+
+    def __init__(self, service: str, method: str, url: str, body: Any = None):
+        self.service = service
+        self.method = method.upper()
+        self.url = str(url)
+        self.body = body
+        self.key = exchange_key(service, method, url, body)
+        self.request_id = _request_id.get()
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.status: Optional[int] = None
+        self.headers: List[List[str]] = []
+        self.first_byte_seconds: Optional[float] = None
+        self.duration_seconds: Optional[float] = None
+        self.chunks: List[List[Any]] = []  # [offset_seconds, base64 bytes]
+
+    def set_response(self, status: int, headers: Any) -> None:
+        self.status = status
+        self.headers = [[str(k), str(v)] for k, v in headers.items()]
+        self.first_byte_seconds = time.perf_counter() - self._start
+
+    def add_chunk(self, data: bytes) -> None:
+        offset = time.perf_counter() - self._start
+        self.chunks.append([round(offset, 6), base64.b64encode(data).decode("ascii")])
+
+    def finish(self) -> None:
+        self.duration_seconds = time.perf_counter() - self._start
+
+    def to_dict(self) -> Dict[str, Any]:
+        body = self.body
+        if isinstance(body, bytes):
+            body = body.decode("utf-8", errors="replace")
+        return {
+            "key": self.key,
+            "request_id": self.request_id,
+            "service": self.service,
+            "method": self.method,
+            "url": self.url,
+            "request": body,
+            "status": self.status,
+            "headers": self.headers,
+            "started_at": self.started_at,
+            "first_byte_seconds": self.first_byte_seconds,
+            "duration_seconds": self.duration_seconds,
+            "chunks": self.chunks,
+        }
+
+
+class TrafficRecorder:
+    """Appends finished exchanges to one JSONL file per request."""
+
+    def __init__(self, output_dir: Path):
+        self.output_dir = output_dir
+        # Lyzr completions may run on executor threads with their own loop
+        self._lock = threading.Lock()
+
+    def write(self, exchange: Exchange) -> None:
+        exchange.finish()
+        safe_id = re.sub(r"[^A-Za-z0-9_.-]", "_", exchange.request_id)
+        line = json.dumps(exchange.to_dict())
+        try:
+            with self._lock:
+                self.output_dir.mkdir(parents=True, exist_ok=True)
+                with open(self.output_dir / f"{safe_id}.jsonl", "a") as f:
+                    f.write(line + "\n")
+        except Exception as e:
+            print(f"⚠️ Could not record {exchange.service} exchange: {e}")
+
+
+class RecordedExchange:
+    """A recorded exchange loaded for replay."""
+
+    def __init__(self, data: Dict[str, Any]):
+        self.service = data["service"]
+        self.status = data["status"] or 200
+        self.headers = [tuple(pair) for pair in data.get("headers", [])]
+        self.first_byte_seconds = data.get("first_byte_seconds") or 0.0
+        self.chunks = [
+            (offset, base64.b64decode(payload)) for offset, payload in data.get("chunks", [])
+        ]
+
+    @property
+    def body(self) -> bytes:
+        return b"".join(chunk for _, chunk in self.chunks)
+
+    async def wait_until(self, offset: float, started: float) -> None:
+        """Sleep until ``offset`` (scaled by the replay speed) has elapsed since ``started``."""
+        if TRAFFIC_REPLAY_SPEED <= 0:
+            return
+        delay = offset / TRAFFIC_REPLAY_SPEED - (time.perf_counter() - started)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def iter_chunks(self, started: float) -> AsyncIterator[bytes]:
+        for offset, chunk in self.chunks:
+            await self.wait_until(offset, started)
+            yield chunk
+
+
+class TrafficReplayStore:
+    """Index of every recording in a directory, keyed by exchange key."""
+
+    def __init__(self, source_dir: Path):
+        self.source_dir = source_dir
+        self._exchanges: Dict[str, List[RecordedExchange]] = {}
+        self._cursors: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        count = 0
+        for path in sorted(self.source_dir.glob("*.jsonl")):
+            with open(path) as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    self._exchanges.setdefault(data["key"], []).append(RecordedExchange(data))
+                    count += 1
+        print(f"✓ Loaded {count} recorded upstream exchanges from {self.source_dir}")
+
+    def lookup(self, key: str, description: str) -> RecordedExchange:
+        """
+        Return the next recording for ``key``.
+
+        Repeated identical requests are served in recording order, cycling
+        so that a recording set can be replayed any number of times.
+        """
+        with self._lock:
+            candidates = self._exchanges.get(key)
+            if not candidates:
+                raise TrafficReplayMiss(f"No recorded exchange matches {description}")
+            cursor = self._cursors.get(key, 0)
+            self._cursors[key] = cursor + 1
+            return candidates[cursor % len(candidates)]
+
+
+_recorder: Optional[TrafficRecorder] = None
+_replay_store: Optional[TrafficReplayStore] = None
+_init_lock = threading.Lock()
+
+
+def get_recorder() -> TrafficRecorder:
+    global _recorder
+    with _init_lock:
+        if _recorder is None:
+            _recorder = TrafficRecorder(TRAFFIC_DIR)
+        return _recorder
+
+
+def get_replay_store() -> TrafficReplayStore:
+    global _replay_store
+    with _init_lock:
+        if _replay_store is None:
+            _replay_store = TrafficReplayStore(TRAFFIC_DIR)
+        return _replay_store
+
+
+# ============================================================================
+# aiohttp (Lyzr agent API)
+# ============================================================================
+
+
+class _RecordingContent:
+    def __init__(self, content, exchange: Exchange):
+        self._content = content
+        self._exchange = exchange
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        async for chunk in self._content.iter_chunked(n):
+            self._exchange.add_chunk(chunk)
+            yield chunk
+
+
+class _RecordingResponse:
+    """Wraps an aiohttp response and copies everything read from it into the exchange."""
+
+    def __init__(self, response, exchange: Exchange):
+        self._response = response
+        self.status = response.status
+        self.headers = response.headers
+        self.content = _RecordingContent(response.content, exchange)
+        self._exchange = exchange
+
+    async def read(self) -> bytes:
+        body = await self._response.read()
+        self._exchange.add_chunk(body)
+        return body
+
+    async def text(self) -> str:
+        return (await self.read()).decode(self._response.get_encoding())
+
+    async def json(self) -> Any:
+        return json.loads(await self.text())
+
+
+class _ReplayedContent:
+    def __init__(self, exchange: RecordedExchange, started: float):
+        self._exchange = exchange
+        self._started = started
+
+    async def iter_chunked(self, n: int) -> AsyncIterator[bytes]:
+        async for chunk in self._exchange.iter_chunks(self._started):
+            yield chunk
+
+
+class _ReplayedResponse:
+    """Serves a recorded exchange through the subset of the aiohttp response API we use."""
+
+    def __init__(self, exchange: RecordedExchange, started: float):
+        self._exchange = exchange
+        self._started = started
+        self.status = exchange.status
+        self.headers = dict(exchange.headers)
+        self.content = _ReplayedContent(exchange, started)
+
+    async def read(self) -> bytes:
+        async for _ in self._exchange.iter_chunks(self._started):
+            pass
+        return self._exchange.body
+
+    async def text(self) -> str:
+        return (await self.read()).decode("utf-8")
+
+    async def json(self) -> Any:
+        return json.loads(await self.text())
+
+
+class _AiohttpExchange:
+    """Async context manager standing in for ``session.post(...)``."""
+
+    def __init__(self, service: str, session, url: str, kwargs: Dict[str, Any]):
+        self._service = service
+        self._session = session
+        self._url = url
+        self._kwargs = kwargs
+        self._context = None
+        self._exchange: Optional[Exchange] = None
+
+    async def __aenter__(self):
+        body = self._kwargs.get("json")
+
+        if TRAFFIC_MODE == "replay":
+            key = exchange_key(self._service, "POST", self._url, body)
+            recorded = get_replay_store().lookup(key, f"{self._service} POST {self._url}")
+            started = time.perf_counter()
+            await recorded.wait_until(recorded.first_byte_seconds, started)
+            return _ReplayedResponse(recorded, started)
+
+        self._exchange = Exchange(self._service, "POST", self._url, body)
+        self._context = self._session.post(self._url, **self._kwargs)
+        response = await self._context.__aenter__()
+        self._exchange.set_response(response.status, response.headers)
+        return _RecordingResponse(response, self._exchange)
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if self._context is not None:
+            try:
+                await self._context.__aexit__(exc_type, exc, tb)
+            finally:
+                get_recorder().write(self._exchange)
+        return False
+
+
+def aiohttp_post(service: str, session, url: str, **kwargs):
+    """
+    Drop-in replacement for ``session.post(url, **kwargs)``.
+
+    Returns the plain aiohttp context manager when traffic capture is off.
+    """
+    if TRAFFIC_MODE == "off":
+        return session.post(url, **kwargs)
+    return _AiohttpExchange(service, session, url, kwargs)
+
+
+# ============================================================================
+# httpx (SearXNG)
+# ============================================================================
+
+
+class RecordingTransport(httpx.AsyncBaseTransport):
+    """Forwards requests to a real transport and records the raw response bytes."""
+
+    def __init__(self, service: str, transport: httpx.AsyncBaseTransport = None):
+        self._service = service
+        self._transport = transport or httpx.AsyncHTTPTransport()
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        exchange = Exchange(self._service, request.method, str(request.url), body)
+        response = await self._transport.handle_async_request(request)
+        exchange.set_response(response.status_code, response.headers)
+        try:
+            chunks = []
+            async for chunk in response.aiter_raw():
+                exchange.add_chunk(chunk)
+                chunks.append(chunk)
+        finally:
+            await response.aclose()
+            get_recorder().write(exchange)
+
+        return httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=httpx.ByteStream(b"".join(chunks)),
+            extensions=response.extensions,
+            request=request,
+        )
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+class ReplayTransport(httpx.AsyncBaseTransport):
+    """Answers requests from recordings without touching the network."""
+
+    def __init__(self, service: str):
+        self._service = service
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        body = await request.aread()
+        key = exchange_key(self._service, request.method, str(request.url), body)
+        recorded = get_replay_store().lookup(
+            key, f"{self._service} {request.method} {request.url}"
+        )
+        started = time.perf_counter()
+        await recorded.wait_until(recorded.first_byte_seconds, started)
+        chunks = [chunk async for chunk in recorded.iter_chunks(started)]
+        return httpx.Response(
+            status_code=recorded.status,
+            headers=recorded.headers,
+            stream=httpx.ByteStream(b"".join(chunks)),
+            request=request,
+        )
+
+
+def httpx_transport(
+    service: str, transport: httpx.AsyncBaseTransport = None
+) -> Optional[httpx.AsyncBaseTransport]:
+    """
+    Transport for an ``httpx.AsyncClient``, recording or replaying the real
+    ``transport``; ``transport`` itself (None for httpx's default) when capture is off.
+    """
+    if TRAFFIC_MODE == "record":
+        return RecordingTransport(service, transport)
+    if TRAFFIC_MODE == "replay":
+        return ReplayTransport(service)
+    return transport
@@ -0,0 +1,68 @@
+"""
+Upstream token usage of a request.
+
+Every agent call counts the estimated tokens of its prompt (with the system
+prompt variables) and of its completion against the ``RequestUsage`` of the
+request it was made for. Calls made in the tasks the request spawns (planner,
+step search queries, answer, related questions) count too: tasks inherit the
+usage of the step that created them. Answers replayed from the cache or
+joined onto another request's pipeline make no calls of their own and cost
+nothing.
+
+The agents' own system prompts live upstream and aren't counted.
+"""
+
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, Optional, TypeVar
+
+from context_packing import estimate_tokens
+
+T = TypeVar("T")
+
+# The usage of the step being run, for the agent calls it and its tasks make
+_active_usage: ContextVar[Optional["RequestUsage"]] = ContextVar("active_usage", default=None)
+
+
+class RequestUsage:
+    """Estimated upstream tokens of one request."""
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+
+def record_prompt(prompt: str, system_prompt_variables: Optional[Dict[str, str]] = None) -> None:
+    """Count an agent call sending ``prompt`` against the active request, if any."""
+    usage = _active_usage.get()
+    if usage is None:
+        return
+    usage.calls += 1
+    usage.prompt_tokens += estimate_tokens(prompt)
+    for value in (system_prompt_variables or {}).values():
+        usage.prompt_tokens += estimate_tokens(str(value))
+
+
+def record_completion(text: str) -> None:
+    """Count ``text`` received from an agent against the active request, if any."""
+    usage = _active_usage.get()
+    if usage is not None:
+        usage.completion_tokens += estimate_tokens(text)
+
+
+async def metered(stream: AsyncIterator[T], usage: RequestUsage) -> AsyncIterator[T]:
+    """Pass ``stream`` through, counting the agent calls its steps make against ``usage``."""
+    iterator = stream.__aiter__()
+    while True:
+        token = _active_usage.set(usage)
+        try:
+            item = await iterator.__anext__()
+        except StopAsyncIteration:
+            return
+        finally:
+            _active_usage.reset(token)
+        yield item
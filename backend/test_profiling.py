@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Test script for the per-request profiler.
+Profiles a pro search against stand-in agents and searches, and checks that
+the work done in the tasks it spawns (searches, the answer) is in the profile.
+
+Usage:
+    python test_profiling.py
+"""
+
+import asyncio
+import json
+import os
+import pstats
+import sys
+import tempfile
+from pathlib import Path
+from types import SimpleNamespace
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+os.environ.setdefault("PLAN_CACHE_ENABLED", "false")
+os.environ.setdefault("SEARCH_CACHE_ENABLED", "false")
+
+
+class StandInAgent:
+    """Answers like a Lyzr agent without the network."""
+
+    has_json_schema_response = True
+
+    def __init__(self, stream_text: str = "", structured=None):
+        self.stream_text = stream_text
+        self.structured = structured
+
+    async def astream(self, prompt, system_prompt_variables=None, session_id=None, user_id=None):
+        async def completions():
+            for index in range(0, len(self.stream_text), 16):
+                await asyncio.sleep(0)
+                yield SimpleNamespace(delta=self.stream_text[index:index + 16])
+
+        return completions()
+
+    async def astructured_complete(self, response_model, prompt, system_prompt_variables=None, **kwargs):
+        await asyncio.sleep(0)
+        return response_model.model_validate(self.structured)
+
+
+class StandInAgents:
+    def __init__(self):
+        plan = {
+            "steps": [
+                {"id": 0, "step": "Search for python performance", "dependencies": []},
+                {"id": 1, "step": "Answer the question", "dependencies": [0]},
+            ]
+        }
+        self.planner = StandInAgent(stream_text=json.dumps(plan))
+        self.search_queries = StandInAgent(
+            structured={"steps": [{"step_id": 0, "search_queries": ["python performance"]}]}
+        )
+        self.answer = StandInAgent(stream_text="Python is interpreted, so it is slower. " * 10)
+        self.related = StandInAgent(
+            structured={"related_questions": ["is pypy faster?", "is go faster?", "is c faster?"]}
+        )
+
+    def get_query_planning_agent(self):
+        return self.planner
+
+    def get_search_query_agent(self):
+        return self.search_queries
+
+    def get_answer_generation_agent(self):
+        return self.answer
+
+    def get_related_questions_agent(self):
+        return self.related
+
+
+async def stand_in_search(query, time_range=None, num_results=10):
+    from schemas import SearchResponse, SearchResult
+
+    await asyncio.sleep(0.01)
+    return SearchResponse(
+        results=[
+            SearchResult(title=f"{query} {index}", url=f"https://example.com/{index}", content=f"{query} " * 20)
+            for index in range(5)
+        ]
+    )
+
+
+async def profile_pro_search(output_dir: Path) -> Path:
+    import agent_search
+    from profiling import RequestProfiler
+    from schemas import ChatRequest
+
+    agent_search.perform_search = stand_in_search
+    stream = agent_search.stream_pro_search_objects(
+        ChatRequest(query="is python slow", pro_search=True), StandInAgents(), "is python slow"
+    )
+    events = [event async for event in RequestProfiler("pro-search", output_dir).wrap(stream)]
+    assert events and events[-1].event == "stream-end", events[-1:]
+    return output_dir / "pro-search.prof"
+
+
+def test_profiles_spawned_tasks():
+    with tempfile.TemporaryDirectory() as output_dir:
+        prof_path = asyncio.run(profile_pro_search(Path(output_dir)))
+        profiled = {name for _, _, name in pstats.Stats(str(prof_path)).stats}
+        with open(Path(output_dir) / "pro-search.json") as f:
+            summary = json.load(f)
+
+    # Run in the tasks of merge_event_streams, StepSearch and the related questions
+    for frame in ("stand_in_search", "synthesize_answer", "generate_related_queries"):
+        assert frame in profiled, f"{frame} missing from the profile"
+    assert summary["tasks"] > 0
+    print(f"✓ Pro search profile covers its tasks ({summary['tasks']} tasks, {summary['slices']} slices)")
+
+
+if __name__ == "__main__":
+    test_profiles_spawned_tasks()
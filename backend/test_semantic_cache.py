@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Test script for the semantic cache tier.
+Checks that paraphrases reuse a cached value and that questions asking the
+reverse of a cached one (same words, other order) don't.
+
+Usage:
+    python test_semantic_cache.py
+"""
+
+import sys
+from pathlib import Path
+
+# Add src to path
+sys.path.insert(0, str(Path(__file__).parent / "src"))
+
+from semantic_cache import SemanticCache  # noqa: E402
+
+REVERSED_QUESTIONS = [
+    ("is python faster than java", "is java faster than python"),
+    ("flights from paris to london", "flights from london to paris"),
+    ("is java faster than python for web servers", "is python faster than java for web servers"),
+    ("dog bites man", "man bites dog"),
+]
+
+PARAPHRASES = [
+    ("who is the ceo of openai", "openai ceo"),
+    ("is python faster than java", "python faster than java?"),
+    ("how to learn python", "how do i learn python"),
+    ("weather in new york city", "new york city weather"),
+]
+
+
+def answer_to(cached: str, asked: str):
+    cache: SemanticCache[str] = SemanticCache("test", max_entries=8)
+    cache.set(cached, f"answer to {cached}")
+    return cache.get(asked)
+
+
+def test_reversed_questions_miss():
+    for cached, asked in REVERSED_QUESTIONS:
+        assert answer_to(cached, asked) is None, f"'{asked}' reused the answer to '{cached}'"
+    print(f"✓ {len(REVERSED_QUESTIONS)} reversed questions missed the cache")
+
+
+def test_paraphrases_hit():
+    for cached, asked in PARAPHRASES:
+        assert answer_to(cached, asked) == f"answer to {cached}", f"'{asked}' missed '{cached}'"
+    print(f"✓ {len(PARAPHRASES)} paraphrases hit the cache")
+
+
+if __name__ == "__main__":
+    test_reversed_questions_miss()
+    test_paraphrases_hit()
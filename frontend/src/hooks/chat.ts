@@ -154,6 +154,7 @@ export const useChat = () => {
         return;
       case StreamEvent.AGENT_QUERY_PLAN:
         const { steps } = eventItem.data as AgentQueryPlanStream;
+        // The plan is streamed step by step, keep the progress of known steps
         steps_details =
           steps?.map((step, index) => ({
             step: step,
@@ -161,9 +162,12 @@ export const useChat = () => {
             results: [],
             status: AgentSearchStepStatus.DEFAULT,
             step_number: index,
+            ...steps_details[index],
           })) ?? [];
 
-        steps_details[0].status = AgentSearchStepStatus.CURRENT;
+        if (steps_details[0]?.status === AgentSearchStepStatus.DEFAULT) {
+          steps_details[0].status = AgentSearchStepStatus.CURRENT;
+        }
         state.agent_response = {
           steps_details: steps_details,
         };
@@ -232,6 +236,7 @@ export const useChat = () => {
         images: [],
         agent_response: null,
       };
+      steps_details = [];
       addMessage({ role: MessageRole.USER, content: request.query });
       setIsStreamingProSearch(proMode);
 
@@ -240,6 +245,8 @@ export const useChat = () => {
         thread_id: threadId,  // Legacy, for backwards compatibility
         session_id: sessionId,  // New: for conversation history
         pro_search: proMode,
+        // The answer is built from the text chunks, no need to receive it twice
+        final_response: "omit",
       };
       // Get API key from localStorage
       const apiKey =